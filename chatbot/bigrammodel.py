@@ -0,0 +1,98 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Bigram language model of the responses, used for the MMI reranking of the beam search candidates.
+
+Same probabilities as nltk.ConditionalProbDist(nltk.ConditionalFreqDist(nltk.bigrams(responseWords)), MLEProbDist)
+but keyed on the vocabulary ids: the response tokens are matched exactly against the vocabulary, "<start>" (which
+separates the responses) and the tokens out of the vocabulary get their own ids.
+"""
+
+import numpy as np
+
+
+START_TOKEN = '<start>'
+
+
+class BigramModel:
+    """Sorted sparse array of the log-probabilities of the bigrams (key = prevId * nbIds + currId)
+    """
+    def __init__(self, keys, logProbs, vocabularySize):
+        """
+        Args:
+            keys (np.array): int64 sorted keys of the seen bigrams
+            logProbs (np.array): float64 log(P(curr|prev)) of each bigram
+            vocabularySize (int): size of the vocabulary the ids come from
+        """
+        self.keys = keys
+        self.logProbs = logProbs
+        self.vocabularySize = vocabularySize
+        self.startId = vocabularySize
+        self.unknownId = vocabularySize + 1
+        self.nbIds = vocabularySize + 2
+
+    @classmethod
+    def fromTokens(cls, tokens, word2id):
+        """Count the bigrams of the token stream
+        Args:
+            tokens (list<str>): the response tokens (with <start> before each response)
+            word2id (dict<str, int>): the vocabulary
+        """
+        model = cls(None, None, len(word2id))
+        ids = np.fromiter(
+            (model.startId if token == START_TOKEN else word2id.get(token, model.unknownId) for token in tokens),
+            dtype=np.int64,
+            count=len(tokens)
+        )
+        prevIds, currIds = ids[:-1], ids[1:]
+        prevCounts = np.bincount(prevIds, minlength=model.nbIds)  # All the following tokens (even unknown)
+
+        seen = currIds != model.unknownId  # Never scored, only needed for the counts of prev
+        keys, counts = np.unique(prevIds[seen] * model.nbIds + currIds[seen], return_counts=True)
+        model.keys = keys
+        model.logProbs = np.log(counts / prevCounts[keys // model.nbIds])
+        return model
+
+    @classmethod
+    def load(cls, fileName):
+        with np.load(fileName) as data:
+            return cls(data['keys'], data['logProbs'], int(data['vocabularySize']))
+
+    def save(self, fileName):
+        np.savez(fileName, keys=self.keys, logProbs=self.logProbs, vocabularySize=self.vocabularySize)
+
+    def penalties(self, candidates, lengths, maxWords):
+        """Compute the LM penalty of each candidate: the sum of log(P(word|previous word)) over its first words,
+        starting from <start> (the unseen bigrams are ignored)
+        Args:
+            candidates (np.array): int [nbCandidates, maxLength] word ids (padded)
+            lengths (np.array): int [nbCandidates], number of words of each candidate
+            maxWords (int): number of words scored for each candidate
+        Return:
+            np.array: float64 [nbCandidates] the penalties
+        """
+        candidates = np.asarray(candidates, dtype=np.int64)[:, :maxWords]
+        if candidates.shape[1] == 0 or len(self.keys) == 0:
+            return np.zeros(len(candidates))
+        prevIds = np.empty_like(candidates)
+        prevIds[:, 0] = self.startId
+        prevIds[:, 1:] = candidates[:, :-1]
+        keys = prevIds * self.nbIds + candidates
+
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        found &= np.arange(candidates.shape[1])[None, :] < np.asarray(lengths)[:, None]
+        return np.where(found, self.logProbs[positions], 0.0).sum(axis=1)
@@ -27,17 +27,29 @@ Train: python main.py --corpus healthy-comments
 -- healthy_flag 1 -> append word "healthy"/"unhealthy"
 --motivate_only 1 -> use only motivational data
 --advice_only 1 -> use only advice data
+--buckets 10 20 50 -> group the training samples by length (less padding)
+--dynamicEncoder 1 -> encode only the words of each input instead of all the padded steps (model dir suffix -dynamic)
+--decoderVocab 1 -> the decoder only uses the words of the responses (smaller output layer and beam search)
 
 Test: python main.py --corpus healthy-comments --test interactive
 --beam_search 0 -> use greedy search instead of beam search
 --beam_size 100 -> keep 100 candidate responses instead of only 10
 --all_data 1 -> use models trained on all data instead of 90% training data
+--earlyStop 1 -> stop decoding once all the candidates ended (instead of always running all the steps)
+--maxDecodeLength 30 -> decode at most 30 steps (default: maxLength + 2)
+--testBatchSize 64 -> decode 64 test sentences at once (--test all)
+
+Export: python main.py --corpus healthy-comments --exportModel (same options as for testing)
+-> freezes the testing graph of the last checkpoint into the model directory, loaded by --test daemon --frozenModel
+(no graph construction nor checkpoint restoring when the daemon starts), also exports the weights used by
+--test daemon --numpyModel (the model is run with numpy, no tensorflow session)
 
 With --corpus nutrition:
 --encode_food_descrips 1 -> uses USDA food description as input (not meal)
 --encode_food_ids 1 -> uses USDA food ID as input
 --encode_single_food_descrip 1 -> uses one USDA food description as input
 --match_encoder_decoder_input 1 -> uses same input as encoder for decoder
+--createDataset --nutritionVariants meal food-id food-descrip -> creates the datasets of several variants at once
 
 Evaluate with BLEU:
 
@@ -50,17 +62,16 @@ import argparse  # Command line parsing
 import configparser  # Saving the models parameters
 import datetime  # Chronometer
 import os  # Files management
+import shutil
 from tqdm import tqdm  # Progress bar
-import tensorflow as tf
-import csv
-import nltk
-import math
-import operator
 import json
 
-from chatbot.textdata import TextData
-from chatbot.model import Model
-from chatbot.healthydata import load_usda_vecs, HealthyData
+from chatbot.textdata import TextData, BatchPrefetcher
+from chatbot.frozenmodel import FrozenModel, exportFrozenModel, frozenModelExists, GRAPH_OPTIONS, VOCAB_FILENAME, DECODER_VOCAB_FILENAME, BIGRAMS_FILENAME
+from chatbot.npmodel import NumpyModel, exportWeights, WEIGHTS_FILENAME
+from chatbot.mappeddata import loadVocabulary, saveVocabulary
+from chatbot.bigrammodel import BigramModel
+from chatbot.healthydata import load_usda_vecs, load_amt_table, HealthyData
 
 
 class Chatbot:
@@ -84,6 +95,7 @@ class Chatbot:
         # Task specific object
         self.textData = None  # Dataset
         self.model = None  # Sequence to sequence model
+        self.bigramModel = None  # Language model of the responses (for MMI)
 
         # Tensorflow utilities for convenience saving/logging
         self.writer = None
@@ -103,6 +115,7 @@ class Chatbot:
         self.TEST_IN_NAME = 'data/test/samples.txt'
         self.TEST_OUT_SUFFIX = '_predictions.txt'
         self.REFERENCES_SUFFIX = '_reference.txt'
+        self.FROZEN_DIR_NAME = 'frozen'  # Inside the model directory
         self.SENTENCES_PREFIX = ['Q: ', 'A: ']
 
     @staticmethod
@@ -134,6 +147,9 @@ class Chatbot:
         globalArgs.add_argument('--watsonMode', action='store_true', help='Inverse the questions and answer when training (the network try to guess the question)')
         globalArgs.add_argument('--device', type=str, default=None, help='\'gpu\' or \'cpu\' (Warning: make sure you have enough free RAM), allow to choose on which hardware run the model')
         globalArgs.add_argument('--seed', type=int, default=None, help='random seed for replication')
+        globalArgs.add_argument('--exportModel', action='store_true', help='if present, the program will only restore the model and export its frozen testing graph and its weights with the vocabulary (see --frozenModel and --numpyModel)')
+        globalArgs.add_argument('--frozenModel', action='store_true', help='on daemon mode, load the graph exported with --exportModel instead of creating the model and restoring the checkpoint (faster startup)')
+        globalArgs.add_argument('--numpyModel', action='store_true', help='on daemon mode, run the weights exported with --exportModel with numpy instead of tensorflow (fastest startup, no session)')
 
         # Dataset options
         datasetArgs = parser.add_argument_group('Dataset options')
@@ -146,10 +162,15 @@ class Chatbot:
         datasetArgs.add_argument('--motivate_only', type=int, default=0, help='only use the first AMT response, the motivational support')
         datasetArgs.add_argument('--advice_only', type=int, default=0, help='only use the 2nd AMT response, the advice part')
         datasetArgs.add_argument('--datasetTag', type=str, default=None, help='add a tag to the dataset (file where to load the vocabulary and the precomputed samples, not the original corpus). Useful to manage multiple versions')  # The samples are computed from the corpus if it does not exist already. There are saved in \'data/samples/\'
-        datasetArgs.add_argument('--ratioDataset', type=float, default=1.0, help='ratio of dataset used to avoid using the whole dataset')  # Not implemented, useless ?
+        datasetArgs.add_argument('--ratioDataset', type=float, default=1.0, help='ratio of dataset used to avoid using the whole dataset (stratified subsample, depends on --seed)')
         datasetArgs.add_argument('--maxLength', type=int, default=10, help='maximum length of the sentence (for input and output), define number of maximum step of the RNN')
         datasetArgs.add_argument('--augment', type=int, default=0, help='whether to include additional meals with similar foods')
         datasetArgs.add_argument('--finetune', type=int, default=0, help='whether to continue training on nutrition data')
+        datasetArgs.add_argument('--numWorkers', type=int, default=1, help='number of processes tokenizing the corpus when creating the dataset (1 to extract serially)')
+        datasetArgs.add_argument('--tokenCacheSize', type=int, default=100000, help='number of extracted texts kept in cache when creating the dataset (0 to disable)')
+        datasetArgs.add_argument('--vocabularySize', type=int, default=0, help='maximum number of words in the vocabulary, the least frequent ones are replaced by <unknown> (0 for no limit)')
+        datasetArgs.add_argument('--minCount', type=int, default=1, help='minimum number of occurrences of a word to be kept in the vocabulary')
+        datasetArgs.add_argument('--nutritionVariants', type=str, nargs='+', default=None, help='with --createDataset, create the datasets of all the given nutrition variants at once: food-descrip, single-food-descrip, food-id or meal (optionally with the -match-decoder suffix)')
         datasetArgs.add_argument('--all_data', type=int, default=0, help='whether to use the full model trained on all data')
 
         # Network options (Warning: if modifying something here, also make the change on save/loadParams() )
@@ -159,10 +180,15 @@ class Chatbot:
         nnArgs.add_argument('--embeddingSize', type=int, default=64, help='embedding size of the word representation')
         nnArgs.add_argument('--softmaxSamples', type=int, default=0, help='Number of samples in the sampled softmax loss function. A value of 0 deactivates sampled softmax')
         nnArgs.add_argument('--attention', type=int, default=0, help='whether to use RNN with attention')
+        nnArgs.add_argument('--dynamicEncoder', type=int, default=0, help='whether to only encode the valid steps of each input (dynamic_rnn, no attention on the padding), the model directory gets a -dynamic suffix')
+        nnArgs.add_argument('--decoderVocab', type=int, default=0, help='whether the decoder has its own vocabulary, restricted to the words of the targets (the encoder keeps the full vocabulary)')
         nnArgs.add_argument('--food_context', type=int, default=0, help='whether to use decoder with food context vec')
         nnArgs.add_argument('--first_step', type=int, default=0, help='whether to limit food context vec to first decode step and input zeros for the rest')
         nnArgs.add_argument('--beam_search', type=int, default=1, help='whether to decode using beam search')
         nnArgs.add_argument('--beam_size', type=int, default=10, help='number of candidate paths to keep on beam during beam search decode')
+        nnArgs.add_argument('--earlyStop', type=int, default=0, help='when testing, whether to stop decoding as soon as all the candidates emitted <eos>')
+        nnArgs.add_argument('--maxDecodeLength', type=int, default=0, help='when testing, maximum number of decoding steps (0 for maxLength + 2, as when training)')
+        nnArgs.add_argument('--testBatchSize', type=int, default=32, help='when testing on the test set, number of sentences decoded by the same network run')
         nnArgs.add_argument('--MMI', type=int, default=0, help='whether to rank decoded candidates with MMI criterion')
         nnArgs.add_argument('--lambda_wt', type=float, default=0.1, help='weight controlling how much to penalize target response in final MMI score')
         nnArgs.add_argument('--gamma_wt', type=int, default=1, help='number words in target to penalize/weight for length term of MMI score')
@@ -173,6 +199,9 @@ class Chatbot:
         trainingArgs.add_argument('--saveEvery', type=int, default=1000, help='nb of mini-batch step before creating a model checkpoint')
         trainingArgs.add_argument('--batchSize', type=int, default=10, help='mini-batch size')
         trainingArgs.add_argument('--learningRate', type=float, default=0.001, help='Learning rate')
+        trainingArgs.add_argument('--prefetch', type=int, default=0, help='number of batches prepared in background while training (0 to disable)')
+        trainingArgs.add_argument('--prefetchThreads', type=int, default=1, help='number of threads preparing the batches when prefetch is set')
+        trainingArgs.add_argument('--buckets', type=int, nargs='+', default=None, help='sentence lengths of the buckets used to group the training samples (ex: --buckets 10 20 50), the last bucket is always maxLength')
 
         return parser.parse_args(args)
 
@@ -182,13 +211,16 @@ class Chatbot:
         """
         print('Welcome to DeepQA v0.1 !')
         print()
-        print('TensorFlow detected: v{}'.format(tf.__version__))
 
         # General initialisation
 
         self.args = self.parseArgs(args)
+        if not self.args.rootDir:
+            self.args.rootDir = os.getcwd()  # Use the current working directory
+        if self.args.exportModel:
+            self.args.test = Chatbot.TestMode.DAEMON  # The exported graph is the one used for testing
         if self.args.corpus == 'nutrition':
-            self.args.maxLength = 100
+            self.args.maxLength = TextData.NUTRITION_MAX_LENGTH
             if self.args.encode_food_descrips:
                 self.MODEL_DIR_BASE = 'save/food-meal-model'
                 self.SENTENCES_PREFIX = ['Input food: ', 'Output meal: ']
@@ -204,7 +236,7 @@ class Chatbot:
 
         elif self.args.corpus == 'healthy-comments':
             self.args.maxLength = 100
-            self.args.usda_vecs = load_usda_vecs()
+            self.args.usda_vecs = load_usda_vecs(cache_dir=os.path.join(self.args.rootDir, 'data/samples/'))
             if self.args.all_data:
                 self.MODEL_DIR_BASE = 'save_allData/healthy-comments'
             else:
@@ -235,6 +267,12 @@ class Chatbot:
         if self.args.first_step:
             self.MODEL_DIR_BASE += '-firstStep'
 
+        if self.args.dynamicEncoder:
+            self.MODEL_DIR_BASE += '-dynamic'
+
+        if self.args.decoderVocab:
+            self.MODEL_DIR_BASE += '-decoderVocab'
+
         if self.args.augment:
             self.MODEL_DIR_BASE += '-augment'
 
@@ -259,14 +297,31 @@ class Chatbot:
             self.args.model = Ranker()
         '''
 
-        if not self.args.rootDir:
-            self.args.rootDir = os.getcwd()  # Use the current working directory
-
         #tf.logging.set_verbosity(tf.logging.INFO) # DEBUG, INFO, WARN (default), ERROR, or FATAL
 
         self.loadModelParams()  # Update the self.modelDir and self.globStep, for now, not used when loading Model (but need to be called before _getSummaryName)
 
-        self.textData = TextData(self.args)
+        if self.args.createDataset and self.args.nutritionVariants:
+            TextData.createNutritionVariants(self.args)
+            print('Datasets created! Thanks for using this program')
+            return
+
+        if self.args.test == Chatbot.TestMode.DAEMON and (self.args.frozenModel or self.args.numpyModel):
+            self.loadExportedModel()
+            print('Daemon mode, running in background...')
+            return  # No model to create nor restore
+
+        # Only imported when the graph is built (the exported models can be run without them)
+        import tensorflow as tf
+        from chatbot.model import Model
+        print('TensorFlow detected: v{}'.format(tf.__version__))
+
+        decoderVocabulary = None
+        decoderVocabularyName = os.path.join(self.modelDir, DECODER_VOCAB_FILENAME)
+        if self.args.decoderVocab and not self.args.reset and not self.args.createDataset and os.path.exists(decoderVocabularyName):
+            decoderVocabulary = loadVocabulary(decoderVocabularyName)  # Decoder ids of the saved model
+
+        self.textData = TextData(self.args, decoderVocabulary=decoderVocabulary)
         # TODO: Add a mode where we can force the input of the decoder // Try to visualize the predictions for
         # each word of the vocabulary / decoder input
         # TODO: For now, the model are trained for a specific dataset (because of the maxLength which define the
@@ -277,8 +332,8 @@ class Chatbot:
             return  # No need to go further
 
         if self.args.MMI:
-            # create bigram language model for MMI scoring of decoder output
-            self.probDist = nltk.ConditionalProbDist(nltk.ConditionalFreqDist(nltk.bigrams(self.textData.responseWords)), nltk.MLEProbDist)
+            # bigram language model for MMI scoring of decoder output
+            self.bigramModel = self.textData.getBigramModel()
 
         with tf.device(self.getDevice()):
             self.model = Model(self.args, self.textData)
@@ -303,6 +358,12 @@ class Chatbot:
         if self.args.test != Chatbot.TestMode.ALL:
             self.managePreviousModel(self.sess)
 
+        if self.args.exportModel:
+            self.exportModel()
+            self.sess.close()
+            print('Model exported! Thanks for using this program')
+            return
+
         if self.args.test:
             if self.args.test == Chatbot.TestMode.INTERACTIVE:
                 self.mainTestInteractive(self.sess)
@@ -331,7 +392,6 @@ class Chatbot:
 
         self.textData.makeLighter(self.args.ratioDataset)  # Limit the number of training samples
 
-        mergedSummaries = tf.summary.merge_all()  # Define the summary operator (Warning: Won't appear on the tensorboard graph)
         if self.globStep == 0:  # Not restoring from previous run
             self.writer.add_graph(sess.graph)  # First time only
 
@@ -345,16 +405,20 @@ class Chatbot:
                 print()
                 print("----- Epoch {}/{} ; (lr={}) -----".format(e+1, self.args.numEpochs, self.args.learningRate))
 
-                batches = self.textData.getBatches()
+                # The batches are created during the epoch (eventually in background)
+                batchesIds = self.textData.getBatchesIds()
+                if self.args.prefetch:
+                    steps = BatchPrefetcher(batchesIds, self._prepareStep, self.args.prefetch, self.args.prefetchThreads)
+                else:
+                    steps = (self._prepareStep(batchIds) for batchIds in batchesIds)
 
                 # TODO: Also update learning parameters eventually
 
                 tic = datetime.datetime.now()
-                for nextBatch in tqdm(batches, desc="Training"):
+                for ops, feedDict in tqdm(steps, total=len(batchesIds), desc="Training"):
                     # Training pass
-                    ops, feedDict = self.model.step(nextBatch)
-                    assert len(ops) == 2  # training, loss
-                    _, loss, summary = sess.run(ops + (mergedSummaries,), feedDict)
+                    assert len(ops) == 3  # training, loss, summary (of the batch bucket)
+                    _, loss, summary = sess.run(ops, feedDict)
                     self.writer.add_summary(summary, self.globStep)
                     self.globStep += 1
 
@@ -370,6 +434,15 @@ class Chatbot:
 
         self._saveSession(sess)  # Ultimate saving before complete exit
 
+    def _prepareStep(self, batchIds):
+        """ Create the batch and the operators for a training step
+        Args:
+            batchIds ((int, list<int>)): the bucket and the sample ids of the batch
+        Return:
+            (ops), dict: the operators to run and the associated feed dictionary
+        """
+        return self.model.step(self.textData.getBatch(batchIds))
+
     def predictTestset(self, sess):
         """ Try predicting the sentences from the samples.txt file.
         The sentences are saved on the modelDir under the same name
@@ -383,26 +456,13 @@ class Chatbot:
             return
 
         if self.args.corpus == 'healthy-comments':
-            lines = []
             responses = None
-            responses_motivate = []
-            responses_advice = []
             corpusDir = '/usr/users/korpusik/nutrition/Talia_data/'
-            files = ['salad1.csv', 'salad2.csv', 'salad3.csv', 'dinner1.csv', 'dinner2.csv', 'dinner3.csv', 'pasta1.csv', 'pasta2.csv', 'pasta3.csv', 'pasta4.csv']
-            count = 0
-            for filen in files:
-                csvfile = open(corpusDir + filen)
-                reader = csv.DictReader(csvfile)
-            
-                for row in reader:
-                    count += 1
-                    # use every 10th line for testing
-                    if count % 10 != 0:
-                        continue
-                    #print(row['Input.meal_response'])
-                    lines.append(row['Input.meal_response'])
-                    responses_motivate.append(row['Answer.description1'])
-                    responses_advice.append(row['Answer.description2'])
+            # use every 10th line for testing
+            table = load_amt_table(corpusDir, os.path.join(self.args.rootDir, 'data/samples/amt-table.npz'))
+            lines = table['meal'][table['is_test']].tolist()
+            responses_motivate = table['description1'][table['is_test']].tolist()
+            responses_advice = table['description2'][table['is_test']].tolist()
             assert len(lines) == len(responses_motivate) == len(responses_advice)
         else:
             # Loading the file to predict
@@ -414,6 +474,7 @@ class Chatbot:
         meal_response_map = {} # maps meals to list of candidate responses
         for modelName in sorted(modelList):  # TODO: Natural sorting
             print('Restoring previous model from {}'.format(modelName))
+            self._checkDecoderVocabulary(modelName)
             self.saver.restore(sess, modelName)
             print('Testing...')
 
@@ -429,29 +490,30 @@ class Chatbot:
                 reference_f = open(modelName[:-len(self.MODEL_EXT)] + self.REFERENCES_SUFFIX, 'w')
             with open(saveName, 'w') as f:
                 nbIgnored = 0
-                for i, line in enumerate(tqdm(lines, desc='Sentences')):
-                    question = line[:-1]  # Remove the endl character
-                    if responses:
-                        response = responses[i]
-                        reference_f.write(response+'\n')
-                    elif self.args.corpus == 'healthy-comments':
-                        reference_f1.write(responses_motivate[i]+'\n')
-                        reference_f2.write(responses_advice[i]+'\n')
-                        meal_f.write(question+'\n')
-
-                    answer, predict_responses = self.singlePredict(question)
-                    if not answer:
-                        nbIgnored += 1
-                        continue  # Back to the beginning, try again
-                    
-                    output = self.textData.sequence2str(answer, clean=True)
-                    predict_responses = [self.textData.sequence2str(reply, clean=True) for reply in predict_responses]
-                    meal_response_map[question] = predict_responses
-                    predString = '{x[0]}{0}\n{x[1]}{1}\n\n'.format(question, output, x=self.SENTENCES_PREFIX)
-                    if self.args.verbose:
-                        tqdm.write(predString)
-                    f.write(output+'\n')
-                    
+                for start in tqdm(range(0, len(lines), self.args.testBatchSize), desc='Batches'):
+                    questions = [line[:-1] for line in lines[start:start + self.args.testBatchSize]]  # Remove the endl character
+                    predictions = self.batchPredict(questions)  # All the questions of the batch are decoded at once
+                    for i, (question, (answer, predict_responses)) in enumerate(zip(questions, predictions), start):
+                        if responses:
+                            response = responses[i]
+                            reference_f.write(response+'\n')
+                        elif self.args.corpus == 'healthy-comments':
+                            reference_f1.write(responses_motivate[i]+'\n')
+                            reference_f2.write(responses_advice[i]+'\n')
+                            meal_f.write(question+'\n')
+
+                        if not answer:
+                            nbIgnored += 1
+                            continue  # Back to the beginning, try again
+
+                        output = self.textData.sequence2str(answer, clean=True)
+                        predict_responses = [self.textData.sequence2str(reply, clean=True) for reply in predict_responses]
+                        meal_response_map[question] = predict_responses
+                        predString = '{x[0]}{0}\n{x[1]}{1}\n\n'.format(question, output, x=self.SENTENCES_PREFIX)
+                        if self.args.verbose:
+                            tqdm.write(predString)
+                        f.write(output+'\n')
+
                 print('Prediction finished, {}/{} sentences ignored (too long)'.format(nbIgnored, len(lines)))
             if self.args.corpus == 'healthy-comments':
                 reference_f1.close()
@@ -505,93 +567,90 @@ class Chatbot:
             question (str): the raw input sentence
             questionSeq (List<int>): output argument. If given will contain the input batch sequence
         Return:
-            list <int>: the word ids corresponding to the answer
+            list <int>: the word ids corresponding to the answer (None if the sentence is too long)
+            list <list<int>>: the distinct candidates, best first (only the answer with greedy decoding)
         """
         # Create the input batch
         batch = self.textData.sentence2enco(question)
         if not batch:
-            return None
+            return None, []
         if questionSeq is not None:  # If the caller want to have the real input
             questionSeq.extend(batch.encoderSeqs)
 
-        # Run the model
-        ops, feedDict = self.model.step(batch, self.args.match_encoder_decoder_input)
-        output = self.sess.run(ops[0], feedDict)  # TODO: Summarize the output too (histogram, ...)
-        candidates = []
+        return self._predictBatch(batch)[0]
+
+    def batchPredict(self, questions):
+        """ Predict the sentences, all decoded by the same network run
+        Args:
+            questions (list<str>): the raw input sentences
+        Return:
+            list<(list<int>, list<list<int>>)>: the answer and the candidates of each sentence, as returned by
+                singlePredict() (None and no candidates if the sentence is too long)
+        """
+        batch, positions = self.textData.sentences2enco(questions)
+        predictions = self._predictBatch(batch) if batch else []
+        return [predictions[pos] if pos is not None else (None, []) for pos in positions]
+
+    def _predictBatch(self, batch):
+        """ Run the model on the batch and extract the answer of each query
+        Args:
+            batch (Batch): the encoded questions
+        Return:
+            list<(list<int>, list<list<int>>)>: the answer and the candidates of each query of the batch
+        """
+        if isinstance(self.model, NumpyModel):  # Same outputs, computed without session
+            output = self.model.predict(batch)
+        else:
+            ops, feedDict = self.model.step(batch, self.args.match_encoder_decoder_input)
+            output = self.sess.run(ops[0], feedDict)  # TODO: Summarize the output too (histogram, ...)
+
+        predictions = []
+        batchSize = batch.encoderSeqs.shape[1]
         if self.args.beam_search:
-            # print all candidates in beam
-            probs, path, symbol, output = output[-1], output[-3], output[-2], output[:-3]
-            #print('probs', probs)
-            #print('path', path)
-            #print('symbol', symbol)
-            
-            paths = []
-            log_probs = [] # total log prob of each candidate path
-            num_steps = len(path)
-            lastTokenIndex = [num_steps]*self.args.beam_size
-            for kk in range(self.args.beam_size):
-                paths.append([])
-                log_probs.append(0.0)
-                for i in range(num_steps-1):
-                    if symbol[i][kk] == self.textData.eosToken:
-                        lastTokenIndex[kk] = i
-                        break
-            curr = list(range(self.args.beam_size))
-            for i in range(num_steps-1, -1, -1):
-                for kk in range(self.args.beam_size):
-                    if i > lastTokenIndex[kk]:
-                        continue
-                    paths[kk].append(symbol[i][curr[kk]])
-                    log_probs[kk] = log_probs[kk] + probs[i][curr[kk]]
-                    curr[kk] = path[i][curr[kk]]
-
-            #print ("Replies ---------------------->")
-            reply_score_map = {}
-            best_score = None
-            for kk in range(self.args.beam_size):
-                foutputs = [int(logit) for logit in paths[kk][::-1]]
-                candidates.append(foutputs)
-                #print(foutputs)
-                reply = self.textData.sequence2str(foutputs, clean=True)
-                if reply in reply_score_map:
-                    continue
-                if self.args.MMI:
-                    length_term = self.args.gamma_wt * len(paths[kk])
-                    log_LM_penalty = 0.0
-                    prevWord = "<start>"
-                    for wordID in foutputs[:self.args.gamma_wt]:
-                        currWord = self.textData.id2word[wordID]
-                        bigramP = self.probDist[prevWord].prob(currWord)
-                        # TODO: try Kneser-Ney smoothing
-                        if bigramP > 0:
-                            log_LM_penalty += math.log(bigramP)
-                        prevWord = currWord
-                    # TODO: try with product of probs instead of sum of logs
-                    LM_term = self.args.lambda_wt * log_LM_penalty
-                    score = log_probs[kk] - LM_term + length_term
-                    reply_score_map[reply] = score
-                    #print(score, log_probs[kk], LM_term, length_term, reply)
-                else:
-                    print(reply)
-                    score = log_probs[kk]
-                    reply_score_map[reply] = log_probs[kk]
-                if kk == 0:
-                    answer = foutputs
-                    best_score = score
-                elif score > best_score:
-                    answer = foutputs
-                    best_score = score
-            # rerank replies based on MMI scores
-            if self.args.MMI:
-                sorted_replies = sorted(reply_score_map.items(), key=operator.itemgetter(1), reverse=True)
-                for i, (reply, score) in enumerate(sorted_replies):
-                    if self.args.test == 'interactive':
-                        print(i, score, reply)
+            probs, path, symbol = output[-1], output[-3], output[-2]  # [nbSteps, batchSize, beamSize]
+            for q in range(batchSize):
+                candidates = self._rankCandidates(path[:, q], symbol[:, q], probs[:, q])
+                predictions.append((candidates[0], candidates))
         else:
-            answer = self.textData.deco2sentence(output)
-            candidates.append(answer)
+            for q in range(batchSize):
+                answer = self.textData.deco2sentence([out[q] for out in output])
+                predictions.append((answer, [answer]))
+        return predictions
 
-        return answer, candidates
+    def _rankCandidates(self, path, symbol, probs):
+        """ Extract the candidates of the beam search of one query and rank them
+        Args:
+            path, symbol, probs (np.array): the [nbSteps, beamSize] outputs of the beam search
+        Return:
+            list <list<int>>: the distinct candidates, best first
+        """
+        # All the candidates of the beam, with their total log prob
+        sequences, lengths, log_probs = self.textData.beam2sequences(path, symbol, probs)
+        replies = [sequences[kk, :lengths[kk]].tolist() for kk in range(len(sequences))]
+
+        if self.args.MMI:
+            # TODO: try Kneser-Ney smoothing
+            # TODO: try with product of probs instead of sum of logs
+            log_LM_penalties = self.bigramModel.penalties(sequences, lengths, self.args.gamma_wt)
+            length_terms = self.args.gamma_wt * lengths
+            scores = log_probs - self.args.lambda_wt * log_LM_penalties + length_terms
+        else:
+            scores = log_probs
+
+        # Rank the distinct replies (the first candidate of each reply is kept, the ties keep the beam order)
+        seen = set()
+        distinct = []
+        for kk, reply in enumerate(replies):
+            key = self.textData.sequenceKey(reply)
+            if key not in seen:
+                seen.add(key)
+                distinct.append(kk)
+        ranked = sorted(distinct, key=lambda kk: -scores[kk])
+
+        if self.args.verbose or (self.args.MMI and self.args.test == 'interactive'):
+            for i, kk in enumerate(ranked):
+                print(i, scores[kk], self.textData.sequence2str(replies[kk], clean=True))
+        return [replies[kk] for kk in ranked]
 
     def daemonPredict(self, sentence):
         """ Return the answer to a given sentence (same as singlePredict() but with additional cleaning)
@@ -600,18 +659,82 @@ class Chatbot:
         Return:
             str: the human readable sentence
         """
-        return self.textData.sequence2str(
-            self.singlePredict(sentence),
-            clean=True
-        )
+        answer, _ = self.singlePredict(sentence)
+        if not answer:
+            return ''
+        return self.textData.sequence2str(answer, clean=True)
+
+    def daemonPredictBatch(self, sentences):
+        """ Return the answers to the given sentences, decoded together (same as daemonPredict() for each sentence)
+        Args:
+            sentences (list<str>): the raw input sentences
+        Return:
+            list<str>: the human readable sentences
+        """
+        return [
+            self.textData.sequence2str(answer, clean=True) if answer else ''
+            for answer, _ in self.batchPredict(sentences)
+        ]
 
     def daemonClose(self):
         """ A utility function to close the daemon when finish
         """
         print('Exiting the daemon mode...')
-        self.sess.close()
+        if self.sess is not None:  # No session with the numpy model
+            self.sess.close()
         print('Daemon closed.')
 
+    def exportModel(self):
+        """ Export the restored testing graph and its weights with the vocabulary on the model directory, to be loaded
+        by loadExportedModel()
+        """
+        if not os.path.exists(self._getModelName()):
+            raise RuntimeError('No model to export found in \'{}\'. Please train a model first'.format(self.modelDir))
+        exportDir = os.path.join(self.modelDir, self.FROZEN_DIR_NAME)
+        print('Exporting the frozen model to {}...'.format(exportDir))
+        os.makedirs(exportDir, exist_ok=True)
+
+        import tensorflow as tf
+
+        variables = tf.trainable_variables()
+        exportWeights(
+            os.path.join(exportDir, WEIGHTS_FILENAME),
+            {variable.op.name: value for variable, value in zip(variables, self.sess.run(variables))},
+            {option: getattr(self.args, option) for option in GRAPH_OPTIONS},
+            int(self.textData.toDecoderIds(self.textData.eosToken))
+        )
+        exportFrozenModel(exportDir, self.sess, self.model, self.textData, self.bigramModel)  # Last (signature)
+
+    def loadExportedModel(self):
+        """ Load the exported testing graph (or the numpy model with --numpyModel) and its vocabulary (see
+        exportModel()), used instead of the dataset and the model created from the parameters
+        """
+        exportDir = os.path.join(self.modelDir, self.FROZEN_DIR_NAME)
+        if not frozenModelExists(exportDir):
+            raise RuntimeError('No exported model found in \'{}\'. Please export the model first (--exportModel)'.format(exportDir))
+
+        if self.args.numpyModel:
+            self.model = NumpyModel(os.path.join(exportDir, WEIGHTS_FILENAME))
+        else:
+            self.model = FrozenModel(exportDir, self.getDevice())
+            self.sess = self.model.sess
+        for option, value in self.model.options.items():  # The batches should match the exported graph
+            setattr(self.args, option, value)
+        decoderVocabulary = None
+        if self.args.decoderVocab:
+            decoderVocabulary = loadVocabulary(os.path.join(exportDir, DECODER_VOCAB_FILENAME))
+        self.textData = TextData(
+            self.args,
+            vocabulary=loadVocabulary(os.path.join(exportDir, VOCAB_FILENAME)),
+            decoderVocabulary=decoderVocabulary
+        )
+
+        if self.args.MMI:
+            bigramsName = os.path.join(exportDir, BIGRAMS_FILENAME)
+            if not os.path.exists(bigramsName):
+                raise RuntimeError('The model has been exported without the MMI language model, re-export it with --MMI 1')
+            self.bigramModel = BigramModel.load(bigramsName)
+
     def managePreviousModel(self, sess):
         """ Restore or reset the model, depending of the parameters
         If the destination directory already contains some file, it will handle the conflict as following:
@@ -637,6 +760,7 @@ class Chatbot:
             # Analysing directory content
             elif os.path.exists(modelName):  # Restore the model
                 print('Restoring previous model from {}'.format(modelName))
+                self._checkDecoderVocabulary(modelName)
                 self.saver.restore(sess, modelName)  # Will crash when --reset is not activated and the model has not been saved yet
                 print('Model restored.')
             elif self._getModelList():
@@ -650,7 +774,10 @@ class Chatbot:
                 fileList = [os.path.join(self.modelDir, f) for f in os.listdir(self.modelDir)]
                 for f in fileList:
                     print('Removing {}'.format(f))
-                    os.remove(f)
+                    if os.path.isdir(f):  # Ex: the exported model
+                        shutil.rmtree(f)
+                    else:
+                        os.remove(f)
 
         else:
             print('No previous model found, starting from clean directory: {}'.format(self.modelDir))
@@ -665,6 +792,21 @@ class Chatbot:
         self.saver.save(sess, self._getModelName())  # TODO: Put a limit size (ex: 3GB for the modelDir)
         tqdm.write('Model saved.')
 
+    def _checkDecoderVocabulary(self, modelName):
+        """ Check that the decoder vocabulary has the size of the one the model has been saved with (--decoderVocab)
+        Args:
+            modelName (str): the model to restore
+        """
+        import tensorflow as tf
+
+        if self.textData.decoderWordIds is None:
+            return
+        for name, shape in tf.train.NewCheckpointReader(modelName).get_variable_to_shape_map().items():
+            if '_decoder/' in name and name.endswith('/embedding') and shape[0] != self.textData.getDecoderVocabularySize():
+                raise RuntimeError('The decoder vocabulary ({} words) does not match the one of the model \'{}\' ({} words). Was the dataset modified?'.format(
+                    self.textData.getDecoderVocabularySize(), modelName, shape[0]
+                ))
+
     def _getModelList(self):
         """ Return the list of the model files inside the model directory
         """
@@ -723,6 +865,8 @@ class Chatbot:
         # For now, not arbitrary  independent maxLength between encoder and decoder
         self.args.maxLengthEnco = self.args.maxLength
         self.args.maxLengthDeco = self.args.maxLength + 2
+        if self.args.test and self.args.maxDecodeLength:  # The decoder variables do not depend on its length
+            self.args.maxLengthDeco = self.args.maxDecodeLength
 
         if self.args.watsonMode:
             self.SENTENCES_PREFIX.reverse()
@@ -753,6 +897,9 @@ class Chatbot:
         with open(os.path.join(self.modelDir, self.CONFIG_FILENAME), 'w') as configFile:
             config.write(configFile)
 
+        if self.textData.decoderWordIds is not None:  # Restored when testing or resuming the training
+            saveVocabulary(os.path.join(self.modelDir, DECODER_VOCAB_FILENAME), self.textData.getDecoderVocabulary())
+
     def _getSummaryName(self):
         """ Parse the argument to decide were to save the summary, at the same place that the model
         The folder could already contain logs if we restore the training, those will be merged
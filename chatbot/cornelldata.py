@@ -21,84 +21,116 @@ http://www.cs.cornell.edu/~cristian/Cornell_Movie-Dialogs_Corpus.html
 
 """
 
+import os
+import numpy as np
+
+
 class CornellData:
     """
-
+    The text of the lines is stored as a single utf-8 byte array (with the offset of each line) and the conversations
+    as arrays of line indexes, the conversation objects are only created when iterating over them
     """
 
-    def __init__(self, dirName):
+    def __init__(self, dirName, cacheFile=None):
         """
         Args:
             dirName (string): directory where to load the corpus
+            cacheFile (string): where to save the parsed corpus (dirName/cornell-index.npz by default), reloaded as long
+                as the corpus files are not modified
         """
-        self.lines = {}
-        self.conversations = []
-
         MOVIE_LINES_FIELDS = ["lineID","characterID","movieID","character","text"]
         MOVIE_CONVERSATIONS_FIELDS = ["character1ID","character2ID","movieID","utteranceIDs"]
 
-        self.lines = self.loadLines(dirName + "movie_lines.txt", MOVIE_LINES_FIELDS)
-        self.conversations = self.loadConversations(dirName + "movie_conversations.txt", MOVIE_CONVERSATIONS_FIELDS)
+        linesFile = dirName + "movie_lines.txt"
+        conversationsFile = dirName + "movie_conversations.txt"
+        cacheFile = cacheFile or os.path.join(dirName, "cornell-index.npz")
 
-        # TODO: Cleaner program (merge copy-paste) !!
+        if os.path.exists(cacheFile) and os.path.getmtime(cacheFile) >= max(os.path.getmtime(linesFile), os.path.getmtime(conversationsFile)):
+            with np.load(cacheFile) as data:
+                self.index = dict(data)
+        else:
+            self.index = {}
+            self.loadLines(linesFile, MOVIE_LINES_FIELDS)
+            self.loadConversations(conversationsFile, MOVIE_CONVERSATIONS_FIELDS)
+            np.savez(cacheFile, **self.index)
 
     def loadLines(self, fileName, fields):
         """
         Args:
             fileName (str): file to load
             field (set<str>): fields to extract
-        Return:
-            dict<dict<str>>: the extracted fields for each line
         """
-        lines = {}
+        lineIds = []
+        texts = []
 
         with open(fileName, 'r', encoding='iso-8859-1') as f:  # TODO: Solve Iso encoding pb !
             for line in f:
                 values = line.split(" +++$+++ ")
 
-                # Extract fields
-                lineObj = {}
-                for i, field in enumerate(fields):
-                    lineObj[field] = values[i]
+                lineIds.append(values[fields.index("lineID")])
+                texts.append(values[fields.index("text")].encode('utf-8'))
 
-                lines[lineObj['lineID']] = lineObj
+        textOffsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=textOffsets[1:])
 
-        return lines
+        self.index["lineIds"] = np.array(lineIds)
+        self.index["textBytes"] = np.frombuffer(b''.join(texts), dtype=np.uint8)
+        self.index["textOffsets"] = textOffsets
 
     def loadConversations(self, fileName, fields):
         """
         Args:
             fileName (str): file to load
             field (set<str>): fields to extract
-        Return:
-            dict<dict<str>>: the extracted fields for each line
         """
-        conversations = []
+        lineIndexes = {lineId: i for i, lineId in enumerate(self.index["lineIds"].tolist())}
+        convLines = []
+        convLengths = []
+        movieIds = []
 
         with open(fileName, 'r', encoding='iso-8859-1') as f:  # TODO: Solve Iso encoding pb !
             for line in f:
                 values = line.split(" +++$+++ ")
 
-                # Extract fields
-                convObj = {}
-                for i, field in enumerate(fields):
-                    convObj[field] = values[i]
+                lineIds = values[fields.index("utteranceIDs")][2:-3].split("', '")
 
-                lineIds = convObj["utteranceIDs"][2:-3].split("', '")
+                # Reassemble lines
+                convLines.extend(lineIndexes[lineId] for lineId in lineIds)
+                convLengths.append(len(lineIds))
+                movieIds.append(values[fields.index("movieID")])
 
-                #print(convObj["utteranceIDs"])
-                #for lineId in lineIds:
-                    #print(lineId, end=' ')
-                #print()
+        convOffsets = np.zeros(len(convLengths) + 1, dtype=np.int64)
+        np.cumsum(convLengths, out=convOffsets[1:])
 
-                # Reassemble lines
-                convObj["lines"] = []
-                for lineId in lineIds:
-                    convObj["lines"].append(self.lines[lineId])
+        self.index["convLines"] = np.array(convLines, dtype=np.int32)
+        self.index["convOffsets"] = convOffsets
+        self.index["movieIds"] = np.array(movieIds)
 
-                conversations.append(convObj)
+    def getLineText(self, lineIndex):
+        """Decode the text of the line
+        """
+        start, end = self.index["textOffsets"][lineIndex:lineIndex+2]
+        return self.index["textBytes"][start:end].tobytes().decode('utf-8')
 
-        return conversations
+    def getConversation(self, convIndex):
+        """
+        Return:
+            dict: the conversation, with its lines ({"lineID", "text"})
+        """
+        start, end = self.index["convOffsets"][convIndex:convIndex+2]
+        return {
+            "movieID": str(self.index["movieIds"][convIndex]),
+            "lines": [
+                {"lineID": str(self.index["lineIds"][lineIndex]), "text": self.getLineText(lineIndex)}
+                for lineIndex in self.index["convLines"][start:end]
+            ]
+        }
+
+    def getNbConversations(self):
+        return len(self.index["convOffsets"]) - 1
 
     def getConversations(self):
-        return self.conversations
+        """Generate the conversations one by one
+        """
+        for convIndex in range(self.getNbConversations()):
+            yield self.getConversation(convIndex)
@@ -72,6 +72,55 @@ import tensorflow as tf
 
 linear = core_rnn_cell_impl._linear  # pylint: disable=protected-access
 
+def _tile_beam(tensor, beam_size):
+  """Repeat each row of the tensor for each hypothesis of the beam.
+  The hypotheses of a query are contiguous: row q * beam_size + k of the result
+  is the k-th hypothesis of the query q.
+  """
+  shape = tensor.get_shape().with_rank_at_least(1)
+  tiled = array_ops.tile(array_ops.expand_dims(tensor, 1),
+                         [1, beam_size] + [1] * (shape.ndims - 1))
+  tiled = array_ops.reshape(
+      tiled, array_ops.concat([[-1], array_ops.shape(tensor)[1:]], 0))
+  tiled.set_shape([None] + shape[1:].as_list())
+  return tiled
+
+def _embedding_encoder(cell, encoder_inputs, num_encoder_symbols,
+                       embedding_size, dtype=None, encoder_lengths=None):
+  """Embed and encode the inputs.
+  Args:
+    cell: core_rnn_cell.RNNCell defining the cell function and size.
+    encoder_inputs: A list of 1D int32 Tensors of shape [batch_size], or if
+      encoder_lengths is given, a 2D int32 Tensor [max_time x batch_size]
+      (time-major, padded at the end).
+    num_encoder_symbols: Integer; number of symbols on the encoder side.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    dtype: The dtype of the initial RNN state.
+    encoder_lengths: None or 1D int32 Tensor [batch_size], the length of each
+      input. If given, the encoder is run by dynamic_rnn which only computes
+      the valid steps of each input (instead of the unrolled static_rnn).
+  Returns:
+    A tuple of the form (encoder_outputs, encoder_state), where
+    encoder_outputs is a 3D Tensor [batch_size x max_time x cell.output_size]
+    (zeros after the end of each input with encoder_lengths).
+  """
+  encoder_cell = core_rnn_cell.EmbeddingWrapper(
+      cell, embedding_classes=num_encoder_symbols,
+      embedding_size=embedding_size)
+  if encoder_lengths is None:
+    encoder_outputs, encoder_state = core_rnn.static_rnn(
+        encoder_cell, encoder_inputs, dtype=dtype)
+    top_states = [
+        array_ops.reshape(e, [-1, 1, cell.output_size]) for e in encoder_outputs
+    ]
+    return array_ops.concat(top_states, 1), encoder_state
+
+  # The inputs of dynamic_rnn need a depth: [max_time x batch_size x 1]
+  encoder_outputs, encoder_state = rnn.dynamic_rnn(
+      encoder_cell, array_ops.expand_dims(encoder_inputs, 2),
+      sequence_length=encoder_lengths, dtype=dtype, time_major=True)
+  return array_ops.transpose(encoder_outputs, [1, 0, 2]), encoder_state
+
 '''
 Code taken from https://github.com/pbhatia243/Neural_Conversation_Models
 '''
@@ -95,16 +144,16 @@ def _extract_beam_search(embedding, beam_size, num_symbols, embedding_size,  out
     probs  = tf.log(tf.nn.softmax(prev))
 
     if i > 1:
-
-        probs = tf.reshape(probs + log_beam_probs[-1],
+        # All the continuations of the hypotheses of each query
+        probs = tf.reshape(probs + tf.reshape(log_beam_probs[-1], [-1, 1]),
                                [-1, beam_size * num_symbols])
 
-    best_probs, indices = tf.nn.top_k(probs, beam_size)
-    indices = tf.stop_gradient(tf.squeeze(tf.reshape(indices, [-1, 1])))
-    best_probs = tf.stop_gradient(tf.reshape(best_probs, [-1, 1]))
+    best_probs, indices = tf.nn.top_k(probs, beam_size)  # [batch_size x beam_size]
+    indices = tf.stop_gradient(indices)
+    best_probs = tf.stop_gradient(best_probs)
 
     symbols = indices % num_symbols # Which word in vocabulary.
-    beam_parent = indices // num_symbols # Which hypothesis it came from.
+    beam_parent = indices // num_symbols # Which hypothesis of the query it came from.
 
     beam_symbols.append(symbols)
     beam_path.append(beam_parent)
@@ -113,8 +162,8 @@ def _extract_beam_search(embedding, beam_size, num_symbols, embedding_size,  out
     # Note that gradients will not propagate through the second parameter of
     # embedding_lookup.
 
-    emb_prev = embedding_ops.embedding_lookup(embedding, symbols)
-    emb_prev  = tf.reshape(emb_prev,[beam_size,embedding_size])
+    emb_prev = embedding_ops.embedding_lookup(embedding, tf.reshape(symbols, [-1]))
+    emb_prev  = tf.reshape(emb_prev,[-1,embedding_size])
 
     if not update_embedding:
       emb_prev = array_ops.stop_gradient(emb_prev)
@@ -148,11 +197,123 @@ def _extract_argmax_and_embed(embedding,
 
   return loop_function
 
+def _early_stop_decode(embedding, num_symbols, eos_id, output_projection=None,
+                       beam_search=True, beam_size=10):
+  """Get a decode_function running the decoder until all the sequences ended.
+  The steps following the first one are run in a tf.while_loop, which stops as
+  soon as all the sequences (or all the hypotheses of the beam) emitted eos.
+  With beam search, a finished hypothesis can only be followed by eos (without
+  changing its log probability), so it is kept frozen in the beam.
+  Args:
+    embedding: embedding tensor for symbols.
+    num_symbols: Integer, how many symbols come into the embedding.
+    eos_id: Integer, the symbol ending a sequence.
+    output_projection: None or a pair (W, B). If provided, each output will
+      first be multiplied by W and added B.
+    beam_search: Boolean; if True, decode with a beam search instead of
+      greedily.
+    beam_size: Integer, number of hypotheses kept by the beam search.
+  Returns:
+    A decode function.
+      Signature -- decode_function(step_function, prev, carry, num_steps)
+        * step_function(inp, carry) = (output, carry) runs one step of the
+          decoder, carry being its (possibly nested) state,
+        * prev is the 2D Tensor output of the first step,
+        * carry is the state after the first step (already repeated for
+          each hypothesis with beam search),
+        * num_steps is the maximum number of steps (first one included).
+      With beam search, it returns the (beam_path, beam_symbols,
+      log_beam_probs) 3D Tensors [num_steps-1 x batch_size x beam_size] of the
+      unrolled beam decoders, the 3D Tensor of the (projected) outputs of all the steps
+      [num_steps x batch_size x num_symbols] otherwise, followed by the last
+      carry.
+  """
+  def project(prev):
+    if output_projection is not None:
+      prev = nn_ops.xw_plus_b(prev, output_projection[0], output_projection[1])
+    return prev
+
+  def extract_beam(prev, log_probs=None, finished=None):
+    probs = tf.log(tf.nn.softmax(project(prev)))
+    if log_probs is not None:
+      frozen_probs = tf.zeros_like(probs) + tf.log(
+          tf.one_hot(eos_id, num_symbols))
+      probs = tf.where(tf.reshape(finished, [-1]), frozen_probs, probs)
+      probs = tf.reshape(probs + tf.reshape(log_probs, [-1, 1]),
+                         [-1, beam_size * num_symbols])
+    best_probs, indices = tf.nn.top_k(probs, beam_size)
+    return indices % num_symbols, indices // num_symbols, best_probs
+
+  def decode_function(step_function, prev, carry, num_steps):
+    scope = variable_scope.get_variable_scope()
+
+    def run_step(symbols, carry):
+      with variable_scope.variable_scope(scope, reuse=True):
+        return step_function(embedding_ops.embedding_lookup(
+            embedding, array_ops.reshape(symbols, [-1])), carry)
+
+    if beam_search:
+      symbols, parents, log_probs = extract_beam(prev)
+      beam_path = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+      beam_symbols = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+      log_beam_probs = tf.TensorArray(log_probs.dtype, size=0,
+                                      dynamic_size=True)
+
+      def cond(i, symbols, log_probs, carry, beam_path, beam_symbols,
+               log_beam_probs):
+        return math_ops.logical_and(
+            i < num_steps - 1,
+            math_ops.logical_not(
+                math_ops.reduce_all(math_ops.equal(symbols, eos_id))))
+
+      def body(i, symbols, log_probs, carry, beam_path, beam_symbols,
+               log_beam_probs):
+        prev, carry = run_step(symbols, carry)
+        finished = math_ops.equal(symbols, eos_id)
+        symbols, parents, log_probs = extract_beam(prev, log_probs, finished)
+        return (i + 1, symbols, log_probs, carry,
+                beam_path.write(i, parents),
+                beam_symbols.write(i, symbols),
+                log_beam_probs.write(i, log_probs))
+
+      _, _, _, carry, beam_path, beam_symbols, log_beam_probs = (
+          control_flow_ops.while_loop(
+              cond, body,
+              [tf.constant(1), symbols, log_probs, carry,
+               beam_path.write(0, parents),
+               beam_symbols.write(0, symbols),
+               log_beam_probs.write(0, log_probs)]))
+      return (beam_path.stack(), beam_symbols.stack(), log_beam_probs.stack(),
+              carry)
+
+    logits = project(prev)
+    outputs = tf.TensorArray(logits.dtype, size=0, dynamic_size=True)
+    finished = math_ops.equal(math_ops.argmax(logits, 1), eos_id)
+
+    def cond(i, logits, finished, carry, outputs):
+      return math_ops.logical_and(
+          i < num_steps, math_ops.logical_not(math_ops.reduce_all(finished)))
+
+    def body(i, logits, finished, carry, outputs):
+      prev, carry = run_step(math_ops.argmax(logits, 1), carry)
+      logits = project(prev)
+      finished = math_ops.logical_or(
+          finished, math_ops.equal(math_ops.argmax(logits, 1), eos_id))
+      return i + 1, logits, finished, carry, outputs.write(i, logits)
+
+    _, _, _, carry, outputs = control_flow_ops.while_loop(
+        cond, body,
+        [tf.constant(1), logits, finished, carry, outputs.write(0, logits)])
+    return outputs.stack(), carry
+
+  return decode_function
+
 def rnn_decoder(decoder_inputs,
                 initial_state,
                 cell,
                 loop_function=None,
-                scope=None):
+                scope=None,
+                decode_function=None):
   """RNN decoder for the sequence-to-sequence model.
   Args:
     decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -167,6 +328,10 @@ def rnn_decoder(decoder_inputs,
         * i is an integer, the step number (when advanced control is needed),
         * next is a 2D Tensor of shape [batch_size x input_size].
     scope: VariableScope for the created subgraph; defaults to "rnn_decoder".
+    decode_function: If not None (with loop_function), the steps following the
+      first one are run by decode_function(step_function, prev, carry,
+      num_steps), see _early_stop_decode, and outputs is the 3D Tensor of all
+      the outputs.
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -190,11 +355,16 @@ def rnn_decoder(decoder_inputs,
       outputs.append(output)
       if loop_function is not None:
         prev = output
+        if decode_function is not None:
+          outputs, state = decode_function(cell, prev, state,
+                                           len(decoder_inputs))
+          break
   return outputs, state, None, None, None
 
 
 def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
-                scope=None,output_projection=None, beam_size=10):
+                scope=None,output_projection=None, beam_size=10,
+                decode_function=None):
   """RNN decoder for the sequence-to-sequence model.
   Args:
     decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -209,6 +379,9 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
         * i is an integer, the step number (when advanced control is needed),
         * next is a 2D Tensor of shape [batch_size x input_size].
     scope: VariableScope for the created subgraph; defaults to "rnn_decoder".
+    decode_function: If not None (with loop_function), the steps following the
+      first one are run by decode_function(step_function, prev, carry,
+      num_steps), see _early_stop_decode.
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -242,18 +415,20 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
         prev = output
       
       if i==0 and loop_function is not None:
-          states =[]
-          for kk in range(beam_size):
-                states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
+          state = _tile_beam(state, beam_size)
        
       if output_projection:
         outputs.append(tf.argmax(nn_ops.xw_plus_b(
           output, output_projection[0], output_projection[1]), dimension=1))
       else:
         outputs.append(output)
+
+      if loop_function is not None and decode_function is not None:
+        beam_path, beam_symbols, log_beam_probs, state = decode_function(
+            cell, prev, state, len(decoder_inputs))
+        return outputs, state, beam_path, beam_symbols, log_beam_probs
   if loop_function is not None:
-    return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
+    return outputs, state, tf.stack(beam_path), tf.stack(beam_symbols), tf.stack(log_beam_probs)
   else:
     return outputs, state, None, None, None
 
@@ -261,7 +436,8 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
 def embedding_rnn_decoder(decoder_inputs, initial_state, cell, num_symbols,
                           embedding_size, output_projection=None,
                           feed_previous=False,
-                          update_embedding_for_previous=True, scope=None, beam_search=True, beam_size=10 ):
+                          update_embedding_for_previous=True, scope=None, beam_search=True, beam_size=10,
+                          eos_id=None):
   """RNN decoder with embedding and a pure-decoding option.
   Args:
     decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs).
@@ -286,6 +462,9 @@ def embedding_rnn_decoder(decoder_inputs, initial_state, cell, num_symbols,
       no effect if feed_previous=False.
     scope: VariableScope for the created subgraph; defaults to
       "embedding_rnn_decoder".
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -318,23 +497,31 @@ def embedding_rnn_decoder(decoder_inputs, initial_state, cell, num_symbols,
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
 
+    decode_function = None
+    if feed_previous and eos_id is not None:
+        decode_function = _early_stop_decode(
+        embedding, num_symbols, eos_id, output_projection, beam_search,
+        beam_size)
+
     emb_inp = [
         embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
 
 
     if beam_search:
         return beam_rnn_decoder(emb_inp, initial_state, cell,
-                       loop_function=loop_function,output_projection=output_projection, beam_size=beam_size)
+                       loop_function=loop_function,output_projection=output_projection, beam_size=beam_size,
+                       decode_function=decode_function)
 
     else:
         return  rnn_decoder(emb_inp, initial_state, cell,
-                       loop_function=loop_function)
+                       loop_function=loop_function, decode_function=decode_function)
 
 def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
                           num_encoder_symbols, num_decoder_symbols,
                           embedding_size, output_projection=None,
                           feed_previous=False, dtype=dtypes.float32,
-                          scope=None, beam_search=True, beam_size=10):
+                          scope=None, beam_search=True, beam_size=10, eos_id=None,
+                          encoder_lengths=None):
   """Embedding RNN sequence-to-sequence model.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -361,6 +548,12 @@ def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
       rnn cells (default: tf.float32).
     scope: VariableScope for the created subgraph; defaults to
       "embedding_rnn_seq2seq"
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
+    encoder_lengths: None or 1D int32 Tensor [batch_size]; if given,
+      encoder_inputs is a 2D int32 Tensor [max_time x batch_size] padded at
+      the end, only the valid steps of each input are encoded (dynamic_rnn).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -372,10 +565,9 @@ def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
   """
   with variable_scope.variable_scope(scope or "embedding_rnn_seq2seq"):
     # Encoder.
-    encoder_cell = core_rnn_cell.EmbeddingWrapper(
-        cell, embedding_classes=num_encoder_symbols,
-        embedding_size=embedding_size)
-    _, encoder_state = core_rnn.static_rnn(encoder_cell, encoder_inputs, dtype=dtype)
+    _, encoder_state = _embedding_encoder(
+        cell, encoder_inputs, num_encoder_symbols, embedding_size, dtype=dtype,
+        encoder_lengths=encoder_lengths)
     print(encoder_state)
 
     # Decoder.
@@ -386,7 +578,8 @@ def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
     return embedding_rnn_decoder(
           decoder_inputs, encoder_state, cell, num_decoder_symbols,
           embedding_size, output_projection=output_projection,
-          feed_previous=feed_previous, beam_search=beam_search, beam_size=beam_size)
+          feed_previous=feed_previous, beam_search=beam_search, beam_size=beam_size,
+          eos_id=eos_id)
 
 def beam_attention_decoder(decoder_inputs, 
                            initial_state, 
@@ -400,7 +593,9 @@ def beam_attention_decoder(decoder_inputs,
                            initial_state_attention=False,
                            first_step=False,
                            output_projection=None,
-                           beam_size=10):
+                           beam_size=10,
+                           decode_function=None,
+                           attention_lengths=None):
   """RNN decoder with attention for the sequence-to-sequence model.
   In this context "attention" means that, during decoding, the RNN can look up
   information in the additional tensor attention_states, and it does this by
@@ -429,6 +624,11 @@ def beam_attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    decode_function: If not None (with loop_function), the steps following the
+      first one are run by decode_function(step_function, prev, carry,
+      num_steps), see _early_stop_decode.
+    attention_lengths: None or 1D int32 Tensor [batch_size], number of valid
+      entries of attention_states (the attention ignores the next ones).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -482,6 +682,12 @@ def beam_attention_decoder(decoder_inputs,
       v.append(
           variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
 
+    # Valid entries of attention_states (repeated for each hypothesis with beam
+    # search, like hidden)
+    attn_mask = None
+    if attention_lengths is not None:
+      attn_mask = array_ops.sequence_mask(attention_lengths, attn_length)
+
     state = initial_state
     if loop_function is not None:
       state_size =  int(initial_state.get_shape().with_rank(2)[1])
@@ -507,6 +713,9 @@ def beam_attention_decoder(decoder_inputs,
           # Attention mask is a softmax of v^T * tanh(...).
           s = math_ops.reduce_sum(v[a] * math_ops.tanh(hidden_features[a] + y),
                                   [2, 3])
+          if attn_mask is not None:  # No attention on the padding
+            s = array_ops.where(attn_mask, s,
+                                array_ops.ones_like(s) * s.dtype.min)
           a = nn_ops.softmax(s)
           # Now calculate the attention-weighted vector d.
           d = math_ops.reduce_sum(
@@ -514,6 +723,17 @@ def beam_attention_decoder(decoder_inputs,
           ds.append(array_ops.reshape(d, [-1, attn_size]))
       return ds
 
+    def step_function(inp, carry):
+      """Run one decoder step (after the first one) on the embedded input."""
+      state, attns = carry
+      input_size = inp.get_shape().with_rank(2)[1]
+      x = linear([inp] + attns, input_size, True)
+      cell_output, state = cell(x, state)
+      attns = attention(state)
+      with variable_scope.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + attns, output_size, True)
+      return output, (state, attns)
+
     outputs = []
     prev = None
     batch_attn_size = array_ops.stack([batch_size, attn_size])
@@ -562,19 +782,25 @@ def beam_attention_decoder(decoder_inputs,
       if loop_function is not None:
         prev = output
         if i == 0:
-          states =[]
-          for kk in range(beam_size):
-            states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
+          state = _tile_beam(state, beam_size)
+          hidden = _tile_beam(hidden, beam_size)
+          hidden_features = [_tile_beam(h, beam_size) for h in hidden_features]
+          if attn_mask is not None:
+            attn_mask = _tile_beam(attn_mask, beam_size)
           with variable_scope.variable_scope(variable_scope.get_variable_scope(), reuse=True):
             attns = attention(state)
         outputs.append(tf.argmax(nn_ops.xw_plus_b(
           output, output_projection[0], output_projection[1]), dimension=1))
+        if decode_function is not None:
+          beam_path, beam_symbols, log_beam_probs, (state, _) = (
+              decode_function(step_function, prev, (state, attns),
+                              len(decoder_inputs)))
+          return outputs, state, beam_path, beam_symbols, log_beam_probs
       else:
         outputs.append(output)
 
   if loop_function is not None:
-    return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
+    return outputs, state, tf.stack(beam_path), tf.stack(beam_symbols), tf.stack(log_beam_probs)
   else:
     return outputs, state, None, None, None
 
@@ -594,7 +820,9 @@ def beam_embedding_attention_decoder(decoder_inputs,
                                      initial_state_attention=False,
                                      first_step=False,
                                      beam_search=True,
-                                     beam_size=10):
+                                     beam_size=10,
+                                     eos_id=None,
+                                     attention_lengths=None):
 
   """RNN decoder with embedding and attention and a pure-decoding option.
   Args:
@@ -628,6 +856,11 @@ def beam_embedding_attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
+    attention_lengths: None or 1D int32 Tensor [batch_size], number of valid
+      entries of attention_states (the attention ignores the next ones).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -657,6 +890,11 @@ def beam_embedding_attention_decoder(decoder_inputs,
       loop_function = _extract_argmax_and_embed(
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
+    decode_function = None
+    if feed_previous and eos_id is not None:
+      decode_function = _early_stop_decode(
+        embedding, num_symbols, eos_id, output_projection, beam_search,
+        beam_size)
     emb_inp = [
         embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs
     ]
@@ -672,10 +910,14 @@ def beam_embedding_attention_decoder(decoder_inputs,
         initial_state_attention=initial_state_attention,
         first_step=first_step,
         output_projection=output_projection,
-        beam_size=beam_size)
+        beam_size=beam_size,
+        decode_function=decode_function,
+        attention_lengths=attention_lengths)
     else:
       return attention_decoder(
-            emb_inp, initial_state, attention_states, cell, output_size=output_size, num_heads=num_heads, loop_function=loop_function, initial_state_attention=initial_state_attention, output_projection=output_projection)
+            emb_inp, initial_state, attention_states, cell, output_size=output_size, num_heads=num_heads, loop_function=loop_function, initial_state_attention=initial_state_attention, output_projection=output_projection,
+            decode_function=decode_function,
+            attention_lengths=attention_lengths)
 
 def embedding_attention_seq2seq(encoder_inputs,
                                 decoder_inputs,
@@ -691,7 +933,9 @@ def embedding_attention_seq2seq(encoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_id=None,
+                                encoder_lengths=None):
   """Embedding sequence-to-sequence model with attention.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -724,6 +968,13 @@ def embedding_attention_seq2seq(encoder_inputs,
     initial_state_attention: If False (default), initial attentions are zero.
       If True, initialize the attentions from the initial state and attention
       states.
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
+    encoder_lengths: None or 1D int32 Tensor [batch_size]; if given,
+      encoder_inputs is a 2D int32 Tensor [max_time x batch_size] padded at
+      the end, only the valid steps of each input are encoded (dynamic_rnn) and
+      the attention ignores the padding.
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -737,18 +988,10 @@ def embedding_attention_seq2seq(encoder_inputs,
     dtype = scope.dtype
     # Encoder.
     encoder_cell = copy.deepcopy(cell)
-    encoder_cell = core_rnn_cell.EmbeddingWrapper(
-        encoder_cell,
-        embedding_classes=num_encoder_symbols,
-        embedding_size=embedding_size)
-    encoder_outputs, encoder_state = core_rnn.static_rnn(
-        encoder_cell, encoder_inputs, dtype=dtype)
-
-    # First calculate a concatenation of encoder outputs to put attention on.
-    top_states = [
-        array_ops.reshape(e, [-1, 1, cell.output_size]) for e in encoder_outputs
-    ]
-    attention_states = array_ops.concat(top_states, 1)
+    # The encoder outputs are the states to put attention on.
+    attention_states, encoder_state = _embedding_encoder(
+        encoder_cell, encoder_inputs, num_encoder_symbols, embedding_size,
+        dtype=dtype, encoder_lengths=encoder_lengths)
 
     # Decoder.
     output_size = None
@@ -771,7 +1014,9 @@ def embedding_attention_seq2seq(encoder_inputs,
           initial_state_attention=initial_state_attention,
           first_step=first_step,
           beam_search=beam_search,
-          beam_size=beam_size)
+          beam_size=beam_size,
+          eos_id=eos_id,
+          attention_lengths=encoder_lengths)
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
     def decoder(feed_previous_bool):
@@ -823,7 +1068,9 @@ def attention_decoder_context(decoder_inputs,
                       first_step=False,
                       output_projection=None,
                       beam_search=True,
-                      beam_size=10):
+                      beam_size=10,
+                      decode_function=None,
+                      attention_lengths=None):
   """RNN decoder with attention for the sequence-to-sequence model.
   In this context "attention" means that, during decoding, the RNN can look up
   information in the additional tensor attention_states, and it does this by
@@ -833,6 +1080,8 @@ def attention_decoder_context(decoder_inputs,
   details). It is recommended for complex sequence-to-sequence tasks.
   Args:
     decoder_inputs: A list of 2D Tensors [batch_size x input_size].
+    decoder_context: 2D Tensor [batch_size x context_size], combined with the
+      input of each decoder step.
     initial_state: 2D Tensor [batch_size x cell.state_size].
     attention_states: 3D Tensor [batch_size x attn_length x attn_size].
     cell: core_rnn_cell.RNNCell defining the cell function and size.
@@ -852,6 +1101,14 @@ def attention_decoder_context(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    first_step: If True, the context is only given to the first step (zeros
+      for the next ones).
+    decode_function: If not None (with loop_function), the steps following the
+      first one are run by decode_function(step_function, prev, carry,
+      num_steps), see _early_stop_decode. Without beam search, outputs is then
+      the 3D Tensor of all the outputs.
+    attention_lengths: None or 1D int32 Tensor [batch_size], number of valid
+      entries of attention_states (the attention ignores the next ones).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -906,6 +1163,12 @@ def attention_decoder_context(decoder_inputs,
       v.append(
           variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
 
+    # Valid entries of attention_states (repeated for each hypothesis with beam
+    # search, like hidden)
+    attn_mask = None
+    if attention_lengths is not None:
+      attn_mask = array_ops.sequence_mask(attention_lengths, attn_length)
+
     state = initial_state
     if loop_function is not None and beam_search:
       state_size =  int(initial_state.get_shape().with_rank(2)[1])
@@ -931,6 +1194,9 @@ def attention_decoder_context(decoder_inputs,
           # Attention mask is a softmax of v^T * tanh(...).
           s = math_ops.reduce_sum(v[a] * math_ops.tanh(hidden_features[a] + y),
                                   [2, 3])
+          if attn_mask is not None:  # No attention on the padding
+            s = array_ops.where(attn_mask, s,
+                                array_ops.ones_like(s) * s.dtype.min)
           a = nn_ops.softmax(s)
           # Now calculate the attention-weighted vector d.
           d = math_ops.reduce_sum(
@@ -959,7 +1225,26 @@ def attention_decoder_context(decoder_inputs,
 
     log_beam_probs, beam_path, beam_symbols = [],[],[]
 
-    for i, (inp, context) in enumerate(zip(decoder_inputs, decoder_context)):
+    # Context of the next steps (computed once): zeros if only given to the
+    # first step, repeated for each hypothesis when decoding with beam search
+    next_context = decoder_context
+    if loop_function is not None and beam_search:
+      next_context = _tile_beam(decoder_context, beam_size)
+    if first_step:
+      next_context = array_ops.zeros_like(next_context)
+
+    def step_function(inp, carry):
+      """Run one decoder step (after the first one) on the embedded input."""
+      state, attns = carry
+      input_size = inp.get_shape().with_rank(2)[1]
+      x = linear([inp] + [next_context] + attns, input_size, True)
+      cell_output, state = cell(x, state)
+      attns = attention(state)
+      with variable_scope.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + attns, output_size, True)
+      return output, (state, attns)
+
+    for i, inp in enumerate(decoder_inputs):
       if i > 0:
         variable_scope.get_variable_scope().reuse_variables()
       # If loop_function is set, we use it instead of decoder_inputs.
@@ -975,18 +1260,7 @@ def attention_decoder_context(decoder_inputs,
         raise ValueError("Could not infer input size from input: %s" % inp.name)
 
       # *** linearly combine embedded decoder input w/ food context vector ***
-      #if (i == 0 and first_step) or (not first_step):
-      #  x = linear([inp] + [context] + attns, input_size, True)
-      
-      if loop_function is not None and beam_search and i > 0:
-        context_size = int(context.get_shape().with_rank(2)[1])
-        context_list=[]
-        #print('context orig shape', context.shape, context[0].shape)
-        for kk in range(beam_size):
-          context_list.append(context)
-        context = tf.reshape(tf.concat(context_list, 1), [-1, context_size]) 
-        #print('context shape', context.shape)
-      #print('output size', output_size)
+      context = decoder_context if i == 0 else next_context
       x = linear([inp] + [context] + attns, input_size, True)
       
       # Run the RNN.
@@ -1004,10 +1278,11 @@ def attention_decoder_context(decoder_inputs,
       if loop_function is not None:
         prev = output
         if i == 0 and beam_search:
-          states = []
-          for kk in range(beam_size):
-            states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
+          state = _tile_beam(state, beam_size)
+          hidden = _tile_beam(hidden, beam_size)
+          hidden_features = [_tile_beam(h, beam_size) for h in hidden_features]
+          if attn_mask is not None:
+            attn_mask = _tile_beam(attn_mask, beam_size)
           with variable_scope.variable_scope(variable_scope.get_variable_scope(), reuse=True):
             attns = attention(state)
 
@@ -1017,8 +1292,18 @@ def attention_decoder_context(decoder_inputs,
       else:
         outputs.append(output)
 
+      if loop_function is not None and decode_function is not None:
+        if beam_search:
+          beam_path, beam_symbols, log_beam_probs, (state, _) = (
+              decode_function(step_function, prev, (state, attns),
+                              len(decoder_inputs)))
+          return outputs, state, beam_path, beam_symbols, log_beam_probs
+        outputs, (state, _) = decode_function(
+            step_function, prev, (state, attns), len(decoder_inputs))
+        return outputs, state, None, None, None
+
     if loop_function is not None and beam_search:
-      return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
+      return outputs, state, tf.stack(beam_path), tf.stack(beam_symbols), tf.stack(log_beam_probs)
     else:
       return outputs, state, None, None, None
 
@@ -1032,7 +1317,9 @@ def attention_decoder(decoder_inputs,
                       dtype=None,
                       scope=None,
                       initial_state_attention=False,
-                      output_projection=None):
+                      output_projection=None,
+                      decode_function=None,
+                      attention_lengths=None):
   """RNN decoder with attention for the sequence-to-sequence model.
   In this context "attention" means that, during decoding, the RNN can look up
   information in the additional tensor attention_states, and it does this by
@@ -1061,6 +1348,12 @@ def attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    decode_function: If not None (with loop_function), the steps following the
+      first one are run by decode_function(step_function, prev, carry,
+      num_steps), see _early_stop_decode, and outputs is the 3D Tensor of all
+      the outputs.
+    attention_lengths: None or 1D int32 Tensor [batch_size], number of valid
+      entries of attention_states (the attention ignores the next ones).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -1114,6 +1407,11 @@ def attention_decoder(decoder_inputs,
       v.append(
           variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
 
+    # Valid entries of attention_states
+    attn_mask = None
+    if attention_lengths is not None:
+      attn_mask = array_ops.sequence_mask(attention_lengths, attn_length)
+
     state = initial_state
 
     def attention(query):
@@ -1133,6 +1431,9 @@ def attention_decoder(decoder_inputs,
           # Attention mask is a softmax of v^T * tanh(...).
           s = math_ops.reduce_sum(v[a] * math_ops.tanh(hidden_features[a] + y),
                                   [2, 3])
+          if attn_mask is not None:  # No attention on the padding
+            s = array_ops.where(attn_mask, s,
+                                array_ops.ones_like(s) * s.dtype.min)
           a = nn_ops.softmax(s)
           # Now calculate the attention-weighted vector d.
           d = math_ops.reduce_sum(
@@ -1140,6 +1441,17 @@ def attention_decoder(decoder_inputs,
           ds.append(array_ops.reshape(d, [-1, attn_size]))
       return ds
 
+    def step_function(inp, carry):
+      """Run one decoder step (after the first one) on the embedded input."""
+      state, attns = carry
+      input_size = inp.get_shape().with_rank(2)[1]
+      x = linear([inp] + attns, input_size, True)
+      cell_output, state = cell(x, state)
+      attns = attention(state)
+      with variable_scope.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + attns, output_size, True)
+      return output, (state, attns)
+
     outputs = []
     prev = None
     batch_attn_size = array_ops.stack([batch_size, attn_size])
@@ -1179,6 +1491,10 @@ def attention_decoder(decoder_inputs,
         prev = output
 
       outputs.append(output)
+      if loop_function is not None and decode_function is not None:
+        outputs, (state, _) = decode_function(
+            step_function, prev, (state, attns), len(decoder_inputs))
+        break
 
   return outputs, state, None, None, None
 
@@ -1199,10 +1515,13 @@ def embedding_attention_decoder(decoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_id=None,
+                                attention_lengths=None):
   """RNN decoder with embedding and attention and a pure-decoding option.
   Args:
     decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs).
+    decoder_context: 2D Tensor [batch_size x context_size] (food embedding).
     initial_state: 2D Tensor [batch_size x cell.state_size].
     attention_states: 3D Tensor [batch_size x attn_length x attn_size].
     cell: core_rnn_cell.RNNCell defining the cell function.
@@ -1232,6 +1551,11 @@ def embedding_attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
+    attention_lengths: None or 1D int32 Tensor [batch_size], number of valid
+      entries of attention_states (the attention ignores the next ones).
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -1261,6 +1585,11 @@ def embedding_attention_decoder(decoder_inputs,
       loop_function = _extract_argmax_and_embed(
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
+    decode_function = None
+    if feed_previous and eos_id is not None:
+      decode_function = _early_stop_decode(
+        embedding, num_symbols, eos_id, output_projection, beam_search,
+        beam_size)
     emb_inp = [
         embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs
     ]
@@ -1277,7 +1606,9 @@ def embedding_attention_decoder(decoder_inputs,
         first_step=first_step,
         output_projection=output_projection,
         beam_search=beam_search,
-        beam_size=beam_size)
+        beam_size=beam_size,
+        decode_function=decode_function,
+        attention_lengths=attention_lengths)
 
 
 def embedding_attention_context_seq2seq(encoder_inputs,
@@ -1295,7 +1626,9 @@ def embedding_attention_context_seq2seq(encoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_id=None,
+                                encoder_lengths=None):
   """Embedding sequence-to-sequence model with attention.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -1309,6 +1642,8 @@ def embedding_attention_context_seq2seq(encoder_inputs,
   Args:
     encoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
     decoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
+    decoder_context: 2D float Tensor [batch_size x context_size] (food
+      embedding), shared by all the decoder steps.
     cell: core_rnn_cell.RNNCell defining the cell function and size.
     num_encoder_symbols: Integer; number of symbols on the encoder side.
     num_decoder_symbols: Integer; number of symbols on the decoder side.
@@ -1328,6 +1663,13 @@ def embedding_attention_context_seq2seq(encoder_inputs,
     initial_state_attention: If False (default), initial attentions are zero.
       If True, initialize the attentions from the initial state and attention
       states.
+    eos_id: If not None and feed_previous, the decoding stops as soon as all
+      the sequences emitted this symbol (tf.while_loop) instead of always
+      running len(decoder_inputs) steps.
+    encoder_lengths: None or 1D int32 Tensor [batch_size]; if given,
+      encoder_inputs is a 2D int32 Tensor [max_time x batch_size] padded at
+      the end, only the valid steps of each input are encoded (dynamic_rnn) and
+      the attention ignores the padding.
   Returns:
     A tuple of the form (outputs, state), where:
       outputs: A list of the same length as decoder_inputs of 2D Tensors with
@@ -1341,18 +1683,10 @@ def embedding_attention_context_seq2seq(encoder_inputs,
     dtype = scope.dtype
     # Encoder.
     encoder_cell = copy.deepcopy(cell)
-    encoder_cell = core_rnn_cell.EmbeddingWrapper(
-        encoder_cell,
-        embedding_classes=num_encoder_symbols,
-        embedding_size=embedding_size)
-    encoder_outputs, encoder_state = core_rnn.static_rnn(
-        encoder_cell, encoder_inputs, dtype=dtype)
-
-    # First calculate a concatenation of encoder outputs to put attention on.
-    top_states = [
-        array_ops.reshape(e, [-1, 1, cell.output_size]) for e in encoder_outputs
-    ]
-    attention_states = array_ops.concat(top_states, 1)
+    # The encoder outputs are the states to put attention on.
+    attention_states, encoder_state = _embedding_encoder(
+        encoder_cell, encoder_inputs, num_encoder_symbols, embedding_size,
+        dtype=dtype, encoder_lengths=encoder_lengths)
 
     # Decoder.
     output_size = None
@@ -1376,7 +1710,9 @@ def embedding_attention_context_seq2seq(encoder_inputs,
           initial_state_attention=initial_state_attention,
           first_step=first_step,
           beam_search=beam_search,
-          beam_size=beam_size)
+          beam_size=beam_size,
+          eos_id=eos_id,
+          attention_lengths=encoder_lengths)
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
     def decoder(feed_previous_bool):
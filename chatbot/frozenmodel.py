@@ -0,0 +1,170 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Frozen inference graph. The testing graph is pruned to the nodes computing its outputs and the variables are replaced
+by constants holding their trained values, so the daemon can load it without building the model in python nor
+restoring a checkpoint.
+
+Content of the export directory:
+ * graph.pb: the frozen GraphDef
+ * signature.json: format version, names of the input/output tensors and the options the graph has been built with
+ * vocab.txt: one word per line (the line number is the word id)
+ * decoder_vocab.txt: the words of the decoder vocabulary, in the order of the decoder ids (only with --decoderVocab)
+ * bigrams.npz: the bigram model of the responses, used by the MMI ranking (optional)
+ * weights.npz: the trained weights for the numpy model (see npmodel.py)
+
+Tensorflow is only imported when exporting or loading the graph, so the numpy model can read the export directory
+without it.
+"""
+
+import os
+import json
+
+from chatbot.mappeddata import saveVocabulary
+
+
+FORMAT_VERSION = 1
+
+GRAPH_FILENAME = 'graph.pb'
+SIGNATURE_FILENAME = 'signature.json'
+VOCAB_FILENAME = 'vocab.txt'
+DECODER_VOCAB_FILENAME = 'decoder_vocab.txt'
+BIGRAMS_FILENAME = 'bigrams.npz'
+
+# Options fixed by the graph or needed to create its inputs and read its outputs (restored when loading)
+GRAPH_OPTIONS = [
+    'maxLength', 'maxLengthEnco', 'maxLengthDeco',
+    'attention', 'food_context', 'first_step', 'dynamicEncoder', 'match_encoder_decoder_input',
+    'decoderVocab', 'beam_search', 'beam_size', 'earlyStop'
+]
+
+
+def exportFrozenModel(dirName, sess, model, textData, bigramModel=None):
+    """Freeze the testing graph with the current values of the variables and save it with its vocabulary
+    Args:
+        dirName (str): the export directory (created if necessary)
+        sess (tf.Session): the session where the model has been restored
+        model (Model): the testing model (created with args.test)
+        textData (TextData): the dataset the model has been trained on
+        bigramModel (BigramModel): the language model used by MMI (optional)
+    """
+    import tensorflow as tf
+
+    assert model.args.test, 'Only the testing graph can be exported'
+    os.makedirs(dirName, exist_ok=True)
+
+    singleOutput = not isinstance(model.outputs, list)
+    outputs = [model.outputs] if singleOutput else model.outputs
+    inputs = {
+        'encoderInputs': model.encoderInputs,
+        'encoderLengths': model.encoderLengths,
+        'decoderInputs': model.decoderInputs,
+        'decoderContext': model.decoderContext
+    }
+
+    # Only the nodes needed to compute the outputs are kept (no loss, optimizer or other buckets)
+    graphDef = tf.graph_util.convert_variables_to_constants(
+        sess,
+        sess.graph.as_graph_def(),
+        [output.op.name for output in outputs]
+    )
+    with tf.gfile.GFile(os.path.join(dirName, GRAPH_FILENAME), 'wb') as f:
+        f.write(graphDef.SerializeToString())
+
+    saveVocabulary(
+        os.path.join(dirName, VOCAB_FILENAME),
+        [textData.id2word[wordId] for wordId in range(textData.getVocabularySize())]
+    )
+
+    if textData.decoderWordIds is not None:
+        saveVocabulary(os.path.join(dirName, DECODER_VOCAB_FILENAME), textData.getDecoderVocabulary())
+
+    if bigramModel is not None:
+        bigramModel.save(os.path.join(dirName, BIGRAMS_FILENAME))
+
+    signature = {  # Written last, so an interrupted export is not considered as a valid one
+        'version': FORMAT_VERSION,
+        'inputs': {name: tensor.name for name, tensor in inputs.items() if tensor is not None},
+        'outputs': [output.name for output in outputs],
+        'singleOutput': singleOutput,
+        'options': {option: getattr(model.args, option) for option in GRAPH_OPTIONS}
+    }
+    with open(os.path.join(dirName, SIGNATURE_FILENAME), 'w') as f:
+        json.dump(signature, f, indent=2)
+
+
+def frozenModelExists(dirName):
+    """Check if a model has been exported on the given directory
+    """
+    return os.path.exists(os.path.join(dirName, SIGNATURE_FILENAME))
+
+
+class FrozenModel:
+    """Testing model loaded from an exported frozen graph. Same interface as Model for the predictions (outputs and
+    step()), with its own graph and session
+    """
+    def __init__(self, dirName, device=None):
+        """
+        Args:
+            dirName (str): the export directory
+            device (str): the device where to place the graph (ex: '/cpu:0'), None to let tensorflow choose
+        """
+        import tensorflow as tf
+
+        print('Loading frozen model from {}...'.format(dirName))
+
+        with open(os.path.join(dirName, SIGNATURE_FILENAME), 'r') as f:
+            self.signature = json.load(f)
+        if self.signature.get('version') != FORMAT_VERSION:
+            raise UserWarning('Present export version {0} does not match {1}. You should re-export the model \'{2}\''.format(self.signature.get('version'), FORMAT_VERSION, dirName))
+        self.options = self.signature['options']
+
+        graphDef = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(dirName, GRAPH_FILENAME), 'rb') as f:
+            graphDef.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device(device):
+            tf.import_graph_def(graphDef, name='')
+        self.sess = tf.Session(graph=self.graph)
+
+        # Placeholders and outputs, as in Model
+        inputs = self.signature['inputs']
+        getTensor = lambda name: self.graph.get_tensor_by_name(inputs[name]) if name in inputs else None
+        self.encoderInputs = getTensor('encoderInputs')
+        self.encoderLengths = getTensor('encoderLengths')
+        self.decoderInputs = getTensor('decoderInputs')
+        self.decoderContext = getTensor('decoderContext')
+
+        outputs = [self.graph.get_tensor_by_name(name) for name in self.signature['outputs']]
+        self.outputs = outputs[0] if self.signature['singleOutput'] else outputs
+
+    def step(self, batch, match_encoder_decoder_input=False):
+        """ Same as Model.step() in testing mode
+        Args:
+            batch (Batch): the encoded questions
+        Return:
+            (ops), dict: the (outputs,) operator with the associated feed dictionary
+        """
+        feedDict = {}
+        feedDict[self.encoderInputs] = batch.encoderSeqs
+        if self.encoderLengths is not None:
+            feedDict[self.encoderLengths] = batch.encoderLengths
+        feedDict[self.decoderInputs] = batch.decoderSeqs  # Only the first decoder input (<go>) is used
+        if self.decoderContext is not None:
+            feedDict[self.decoderContext] = batch.context
+
+        return (self.outputs,), feedDict
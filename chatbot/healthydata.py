@@ -14,44 +14,303 @@ import nltk
 import numpy as np
 import string
 import xlrd
-import queue
 import random
 
 
-def find_neighbor(food, vec, usda_vecs):
-    neighbors_q = queue.PriorityQueue()
-    usda_foods = set() # prevent repeats
-    if type(usda_vecs) == dict:
-        usda_vecs = usda_vecs.items()
-    for usda_food, usda_vec in usda_vecs:
-        if food == usda_food or usda_food == 0:
-            continue
-        dist = nltk.cluster.util.euclidean_distance(np.array(vec), np.array(usda_vec))
-        #print(usda_food)
-        if ' '.join(usda_food) not in usda_foods:
-            neighbors_q.put((dist, usda_food))
-            usda_foods.add(' '.join(usda_food))
-    return neighbors_q
+class FoodNeighborIndex:
+    """Nearest neighbors of the USDA foods, computed with matrix products over the stacked embeddings
+    """
+    def __init__(self, foods, vecs):
+        """
+        Args:
+            foods (list<str>): the food ids
+            vecs (np.array): the [nb foods, embedding size] embeddings
+        """
+        self.foods = list(foods)
+        self.food_index = {food: i for i, food in enumerate(self.foods)}
+        self.vecs = np.ascontiguousarray(vecs, dtype=np.float64)
+        self.sq_norms = np.einsum('ij,ij->i', self.vecs, self.vecs)
+
+    @classmethod
+    def from_vecs(cls, usda_vecs):
+        """Build the index from the embeddings of load_usda_vecs (or a dict food id => vector)
+        """
+        foods = [food for food in usda_vecs if food != 0]
+        if isinstance(usda_vecs, UsdaVectors):
+            return cls(foods, usda_vecs.gather(foods))
+        return cls(foods, np.array([usda_vecs[food] for food in foods], dtype=np.float64))
+
+    def query(self, vecs, k=1, exclude=None):
+        """Return the k nearest foods (euclidean distance) of each query vector
+        The candidates are selected with the expansion |a|^2 - 2a.b + |b|^2 (with some margin for its rounding
+        errors), then ranked on their exact distance (ties ordered by food id, as find_neighbor did)
+        Args:
+            vecs (np.array): [nb queries, embedding size]
+            k (int): number of neighbors
+            exclude (list<str>): for each query, a food to ignore (ex: the query food itself), or None
+        Return:
+            list<list<(float, str)>>: the (distance, food) of the neighbors of each query, closest first
+        """
+        vecs = np.atleast_2d(np.asarray(vecs, dtype=np.float64))
+        query_sq_norms = np.einsum('ij,ij->i', vecs, vecs)
+        sq_dists = self.sq_norms[None, :] - 2 * vecs.dot(self.vecs.T) + query_sq_norms[:, None]
+        if exclude is not None:
+            for row, food in enumerate(exclude):
+                if food in self.food_index:
+                    sq_dists[row, self.food_index[food]] = np.inf
 
+        k = min(k, len(self.foods))
+        neighbors = []
+        for vec, vec_sq_norm, row in zip(vecs, query_sq_norms, sq_dists):
+            kth = np.partition(row, k - 1)[k - 1]
+            margin = 1e-9 * (vec_sq_norm + self.sq_norms.max())
+            candidates = np.flatnonzero((row <= kth + margin) & np.isfinite(row))
+            dists = [np.sqrt(np.dot(self.vecs[i] - vec, self.vecs[i] - vec)) for i in candidates]
+            ranked = sorted(zip(dists, candidates), key=lambda neighbor: (neighbor[0], self.foods[neighbor[1]]))
+            neighbors.append([(float(dist), self.foods[i]) for dist, i in ranked[:k]])
+        return neighbors
 
+    def nearest(self, food, vec):
+        """Return the closest other food
+        """
+        return self.query([vec], k=1, exclude=[food])[0][0][1]
+
+
+
+USDA_MODEL = '/usr/users/korpusik/USDA-encoder-data/models/allfood/allfood_matcher_lowercase_nousdacnn_aligned'
 
-def load_usda_vecs():
-    load_model = '/usr/users/korpusik/USDA-encoder-data/models/allfood/allfood_matcher_lowercase_nousdacnn_aligned'
-    foods = open(load_model+'_foods').readlines()
+
+class UsdaVectors:
+    """Read-only dict of the USDA food embeddings (food id => float32 vector), backed by a memory mapped matrix
+    """
+    def __init__(self, foods, vecs):
+        """
+        Args:
+            foods (list<str>): the food id of each row
+            vecs (np.array): the float32 [nb foods, embedding size] embeddings
+        """
+        self.foods = foods
+        self.food_index = {}
+        for row, food in enumerate(foods):
+            self.food_index[food] = row  # Last one kept on duplicates (as with a dict)
+        self.vecs = vecs
+
+    def __getitem__(self, food):
+        return self.vecs[self.food_index[food]]
+
+    def __contains__(self, food):
+        return food in self.food_index
+
+    def __len__(self):
+        return len(self.food_index)
+
+    def __iter__(self):
+        return iter(self.food_index)
+
+    def keys(self):
+        return self.food_index.keys()
+
+    def items(self):
+        for food, row in self.food_index.items():
+            yield food, self.vecs[row]
+
+    def get(self, food, default=None):
+        if food in self.food_index:
+            return self[food]
+        return default
+
+    def gather(self, foods):
+        """Return the embeddings of the given foods
+        Return:
+            np.array: the float32 [len(foods), embedding size] embeddings
+        """
+        return self.vecs[[self.food_index[food] for food in foods]]
+
+
+USDA_SOURCES = {  # Format of the embeddings => (files of the embeddings, name of the converted files)
+    'text': (['_foods', '_embeddings'], '_vecs'),
+    'dict': (['_vecs_dict'], '_vecs_dict')
+}
+
+
+def read_usda_vecs(load_model=USDA_MODEL, source='text'):
+    """Read the embeddings from their original files
+    Args:
+        source (str): 'text' for the _foods and _embeddings files, 'dict' for the pickled _vecs_dict (food id =>
+            vector, used by MealData)
+    Return:
+        list<str>, np.array: the food ids and their float32 [nb foods, embedding size] embeddings
+    """
+    if source == 'dict':
+        vecs_dict = pickle.load(open(load_model+'_vecs_dict', 'rb'), encoding='latin1')
+        return [str(food) for food in vecs_dict], np.array(list(vecs_dict.values()), dtype=np.float32)
+    foods = [food.strip() for food in open(load_model+'_foods').readlines()]
     embeds = open(load_model+'_embeddings').readlines()
-    usda_vecs = {}
-    for food, embed in zip(foods, embeds):
-        food = food.strip()
-        embed = embed.strip()
-        usda_vecs[food] = [np.float64(val) for val in embed.split(' ')]
-    #usda_vecs = pickle.load(open(load_model+'_vecs_dict', 'rb'))
-    return usda_vecs
+    foods = foods[:len(embeds)]  # Same as zip(foods, embeds)
+    return foods, np.array([embed.strip().split(' ') for embed in embeds[:len(foods)]], dtype=np.float32)
+
+
+def _usda_cache_prefix(load_model, source, cache_dir):
+    prefix = USDA_SOURCES[source][1]
+    if cache_dir is None:  # Next to the embeddings
+        return load_model + prefix
+    return os.path.join(cache_dir, os.path.basename(load_model) + prefix)
 
 
+def convert_usda_vecs(load_model=USDA_MODEL, source='text', cache_dir=None):
+    """Convert the embeddings (see read_usda_vecs) into the binary format used by load_usda_vecs (ex: _vecs.npy and
+    _vecs_foods.txt for the text files)
+    Args:
+        cache_dir (str): where to save the converted files (next to the embeddings if None)
+    """
+    foods, vecs = read_usda_vecs(load_model, source)
+    cache_prefix = _usda_cache_prefix(load_model, source, cache_dir)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_prefix+'.npy', vecs)
+    with open(cache_prefix+'_foods.txt', 'w') as f:  # Written last (only used if complete)
+        f.write('\n'.join(foods) + '\n')
+
+
+def load_usda_vecs(load_model=USDA_MODEL, source='text', cache_dir=None):
+    """Load the USDA food embeddings (converted to the binary format the first time, and again when the original files
+    are more recent)
+    Args:
+        source (str): the original embeddings (see read_usda_vecs)
+        cache_dir (str): where to save the converted files (next to the embeddings if None). When it cannot be
+            written (ex: read-only directory), the embeddings are read from the original files on each call
+    Return:
+        UsdaVectors: the embedding of each food id
+    """
+    cache_prefix = _usda_cache_prefix(load_model, source, cache_dir)
+    cache_file = cache_prefix+'_foods.txt'
+    if not os.path.exists(cache_file) or any(
+            os.path.getmtime(load_model+filen) > os.path.getmtime(cache_file)
+            for filen in USDA_SOURCES[source][0] if os.path.exists(load_model+filen)):
+        print('Converting the USDA embeddings...')
+        try:
+            convert_usda_vecs(load_model, source, cache_dir)
+        except OSError as e:
+            print('Warning: the converted embeddings cannot be saved ({}), loading them from {}'.format(e, load_model))
+            return UsdaVectors(*read_usda_vecs(load_model, source))
+    foods = open(cache_file).read().split('\n')[:-1]
+    vecs = np.load(cache_prefix+'.npy', mmap_mode='r')
+    assert len(foods) == len(vecs)
+    return UsdaVectors(foods, vecs)
+
+
+AMT_FILES = ['salad1.csv', 'salad2.csv', 'salad3.csv', 'dinner1.csv', 'dinner2.csv', 'dinner3.csv', 'pasta1.csv', 'pasta2.csv', 'pasta3.csv', 'pasta4.csv', 'healthybatch1results.xls', 'moreEncouragingResponses1.xls', 'healthyfeedbackattempt1results_encouraging.xls']
+NUTRIENTS = ['energy', 'protein', 'fat', 'chol', 'sodium', 'carbs', 'fiber', 'sugars']
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_amt_file(filename):
+    """Parse one AMT results file (xls or csv)
+    Return:
+        dict<str, list>: the columns (see load_amt_table)
+    """
+    if filename[-3:] == 'xls':
+        book = xlrd.open_workbook(filename)
+        sheet = book.sheet_by_name(book.sheet_names()[0])
+        labels = sheet.row_values(0)
+        rows = [dict(zip(labels, sheet.row_values(idx))) for idx in range(1, sheet.nrows)]
+    else:
+        with open(filename) as csvfile:
+            rows = list(csv.DictReader(csvfile))
+
+    columns = {name: [] for name in ['meal', 'description1', 'description2', 'has_description2', 'selected', 'food_ids', 'food_names', 'nutrients']}
+    for row in rows:
+        columns['meal'].append(row['Input.meal_response'])
+        columns['description1'].append(row['Answer.description1'])
+        columns['has_description2'].append('Answer.description2' in row)
+        columns['description2'].append(row.get('Answer.description2') or '')
+        columns['selected'].append(row['Answer.selected'])
+        food_ids = []
+        for itemNum in ['1', '2', '3']:
+            foodID = row['Input.FoodID'+itemNum]
+            if filename[-3:] == 'xls':
+                foodID = str(int(foodID))
+            food_ids.append(foodID)
+        columns['food_ids'].append(food_ids)
+        columns['food_names'].append([row['Input.foodName'+itemNum] for itemNum in ['1', '2', '3']])
+        columns['nutrients'].append([[_to_float(row['Input.'+nutrient+itemNum]) for nutrient in NUTRIENTS] for itemNum in ['1', '2', '3']])
+    return columns
+
+
+def load_amt_table(dirName, cache_file=None):
+    """Load all the AMT files (AMT_FILES) as a single columnar table, parsed once and then loaded from the cache
+    Args:
+        dirName (str): directory of the AMT files
+        cache_file (str): the .npz cache (no cache if None), recreated when an AMT file is more recent
+    Return:
+        dict<str, np.array>: the columns, one row per AMT answer:
+            file_id (index in AMT_FILES), meal, description1, description2, has_description2, selected,
+            food_ids [n, 3], food_names [n, 3], nutrients [n, 3, len(NUTRIENTS)] and is_test (every 10th csv row,
+            kept for testing)
+    """
+    if cache_file and os.path.exists(cache_file):
+        cache_time = os.path.getmtime(cache_file)
+        if all(os.path.getmtime(dirName + filen) <= cache_time for filen in AMT_FILES if os.path.exists(dirName + filen)):
+            with np.load(cache_file) as data:
+                return dict(data)
+
+    table = {}
+    file_ids = []
+    for file_id, filen in enumerate(AMT_FILES):
+        columns = parse_amt_file(dirName + filen)
+        for name, values in columns.items():
+            table.setdefault(name, []).extend(values)
+        file_ids.extend([file_id] * len(columns['meal']))
+    table = {name: np.array(values) for name, values in table.items()}
+    table['file_id'] = np.array(file_ids, dtype=np.int16)
+    table['nutrients'] = table['nutrients'].astype(np.float32)
+
+    # Test split: every 10th row (counted over all the files in order), only for the csv files
+    is_csv = np.array([filen[-3:] != 'xls' for filen in AMT_FILES])[table['file_id']]
+    table['is_test'] = ((np.arange(len(file_ids)) + 1) % 10 == 0) & is_csv
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        np.savez(cache_file, **table)
+    return table
+
+
+class RowView:
+    """Read-only sequence of values[index[i]], without copying the values
+    """
+    __slots__ = ('values', 'index')
+
+    def __init__(self, values, index):
+        self.values = values
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RowView(self.values, self.index[i])
+        return self.values[self.index[i]]
+
+    def __iter__(self):
+        for i in self.index:
+            yield self.values[i]
+
 
 class HealthyData:
+    """The AMT answers are stored once per meal entry (meal, foods, label and float32 embedding sum) and each
+    sample (one response sentence) only references its entry
+    """
 
     class Food:
+        __slots__ = ('foodID', 'name', 'energy', 'protein', 'fat', 'chol', 'sodium', 'carbs', 'fiber', 'sugar')
+
         def __init__(self, ID, name, energy, protein, fat, chol, sodium, carbs, fiber, sugar):
             self.foodID = ID
             self.name = name
@@ -64,65 +323,51 @@ class HealthyData:
             self.fiber = fiber
             self.sugar = sugar
 
-    def __init__(self, dirName, usda_vecs, healthy_flag = False, augment = False, motivate_only = False, advice_only = False, all_data = False):
+    def __init__(self, dirName, usda_vecs, healthy_flag = False, augment = False, motivate_only = False, advice_only = False, all_data = False, cache_file = None):
         """
         Args:
             dirName (string): directory where to load the corpus
+            cache_file (string): where to cache the parsed AMT files (see load_amt_table)
         """
         self.healthy_flag = healthy_flag
-        self.meals = []
-        self.foodEmbeddings = []
-        self.responses = []
-        self.foods = [] # saves a list of Food objects, for each meal
-        self.healthyLabels = [] # 0 for unhealthy, 1 for healthy
-        self.usda = json.load(open('/usr/users/korpusik/USDA-encoder-data/models/allfood/allfood_matcher_lowercase_nousdacnn_aligned_usda'))
+        self.meals = [] # meal text of each entry
+        self.foods = [] # saves a tuple of Food objects, for each entry
+        self.healthyLabels = [] # 0 for unhealthy, 1 for healthy (for each entry)
+        self.foodEmbeddings = [] # sum of the food embeddings of each entry (float32 matrix once loaded)
+        self.responses = [] # response of each sample
+        self.sampleEntries = [] # entry (meal) of each sample
+        self.usda = json.load(open(USDA_MODEL+'_usda'))
 
         # TODO: append vector of features indicating nutrition facts
 
-        files = ['salad1.csv', 'salad2.csv', 'salad3.csv', 'dinner1.csv', 'dinner2.csv', 'dinner3.csv', 'pasta1.csv', 'pasta2.csv', 'pasta3.csv', 'pasta4.csv', 'healthybatch1results.xls', 'moreEncouragingResponses1.xls', 'healthyfeedbackattempt1results_encouraging.xls']
+        files = AMT_FILES
         if all_data:
             files = files = ['healthybatch1results.xls', 'moreEncouragingResponses1.xls', 'salad1.csv', 'salad2.csv', 'salad3.csv', 'dinner1.csv', 'dinner2.csv', 'dinner3.csv', 'pasta1.csv', 'pasta2.csv', 'pasta3.csv', 'pasta4.csv']
 
-        count = 0
+        table = load_amt_table(dirName, cache_file)
+
+        if augment:
+            neighbor_index = FoodNeighborIndex.from_vecs(usda_vecs)
+            neighbors = {}  # Same foods in many rows
+
         for filen in files:
-            # process excel file to match csv
-            if filen[-3:] == 'xls':
-                book = xlrd.open_workbook(dirName + filen)
-                sheet = book.sheet_by_name(book.sheet_names()[0])
-                labels = sheet.row_values(0)
-                reader = [sheet.row_values(idx) for idx in range(1, sheet.nrows)]
-            else:
-                csvfile = open(dirName + filen)
-                reader = csv.DictReader(csvfile)
-            for row in reader:
-                count += 1
+            for idx in np.flatnonzero(table['file_id'] == AMT_FILES.index(filen)):
                 # skip every 10th line (for testing only)
-                if not all_data and count % 10 == 0 and filen[-3:] != 'xls':
-                    print('skipping test sent', row['Input.meal_response'])
+                if not all_data and table['is_test'][idx]:
+                    print('skipping test sent', table['meal'][idx])
                     continue
 
                 # split different sentences into different data samples
-                if filen[-3:] == 'xls':
-                    meal = row[labels.index('Input.meal_response')]
-                    if advice_only:
-                        responses = []
-                    else:
-                        responses = nltk.sent_tokenize(row[labels.index('Answer.description1')])
+                meal = str(table['meal'][idx])
+                if advice_only:
+                    responses = []
                 else:
-                    meal = row['Input.meal_response']
-                    if advice_only:
-                        responses = []
-                    else:
-                        responses = nltk.sent_tokenize(row['Answer.description1'])
+                    responses = nltk.sent_tokenize(str(table['description1'][idx]))
                 #print(meal)
 
                 # check if Turker wrote two different responses
-                if filen[-3:] == 'xls' and not motivate_only:
-                    if 'Answer.description2' in labels:
-                        responses.extend(nltk.sent_tokenize(row[labels.index('Answer.description2')]))
-                elif not motivate_only:
-                    if 'Answer.description2' in row:
-                        responses.extend(nltk.sent_tokenize(row['Answer.description2']))
+                if not motivate_only and table['has_description2'][idx]:
+                    responses.extend(nltk.sent_tokenize(str(table['description2'][idx])))
 
                 # add responses w/o punctuation (keeping exclamation points)
                 new_responses = []
@@ -131,39 +376,16 @@ class HealthyData:
                     new_responses.append(''.join(ch for ch in response if (ch not in string.punctuation or ch== '!')))
                 responses = new_responses
 
-                if filen[-3:] == 'xls':
-                    label = row[labels.index('Answer.selected')]
-                else:
-                    label = row['Answer.selected']
+                label = table['selected'][idx]
 
                 # get three eaten foods, with nutrients
                 foodList = []
                 foodIDs = []
                 neighborIDs = [] # nearest neighbor to each food
-                for itemNum in ['1', '2', '3']:
-                    if filen[-3:] == 'xls':
-                        foodID = row[labels.index('Input.FoodID'+itemNum)]
-                        foodID = str(int(foodID))
-                        name = row[labels.index('Input.foodName'+itemNum)]
-                        energy = row[labels.index('Input.energy'+itemNum)]
-                        protein = row[labels.index('Input.protein'+itemNum)]
-                        fat = row[labels.index('Input.fat'+itemNum)]
-                        chol = row[labels.index('Input.chol'+itemNum)]
-                        sodium = row[labels.index('Input.sodium'+itemNum)]
-                        carbs = row[labels.index('Input.carbs'+itemNum)]
-                        fiber = row[labels.index('Input.fiber'+itemNum)]
-                        sugar = row[labels.index('Input.sugars'+itemNum)]
-                    else:
-                        foodID = row['Input.FoodID'+itemNum]
-                        name = row['Input.foodName'+itemNum]
-                        energy = row['Input.energy'+itemNum]
-                        protein = row['Input.protein'+itemNum]
-                        fat = row['Input.fat'+itemNum]
-                        chol = row['Input.chol'+itemNum]
-                        sodium = row['Input.sodium'+itemNum]
-                        carbs = row['Input.carbs'+itemNum]
-                        fiber = row['Input.fiber'+itemNum]
-                        sugar = row['Input.sugars'+itemNum]
+                for item in range(3):
+                    foodID = str(table['food_ids'][idx, item])
+                    name = str(table['food_names'][idx, item])
+                    energy, protein, fat, chol, sodium, carbs, fiber, sugar = table['nutrients'][idx, item]
                     food = self.Food(foodID, name, energy, protein, fat, chol, sodium, carbs, fiber, sugar)
                     foodList.append(food)
                     foodIDs.append(foodID)
@@ -173,8 +395,9 @@ class HealthyData:
                         if foodID not in usda_vecs:
                             print('skip unk food', foodIDs[0])
                             continue
-                        neighbors_q = find_neighbor(foodID, usda_vecs[foodID], usda_vecs)
-                        neighbor = neighbors_q.get()[1]
+                        if foodID not in neighbors:
+                            neighbors[foodID] = neighbor_index.nearest(foodID, usda_vecs[foodID])
+                        neighbor = neighbors[foodID]
                         neighborIDs.append(neighbor)
                         print( neighbor, self.usda[neighbor] )
 
@@ -187,44 +410,50 @@ class HealthyData:
                 elif foodIDs[2] not in usda_vecs:
                     print('skip unk food', foodIDs[2])
                     continue
+                foodList = tuple(foodList)
                 embeddingSum = np.sum([usda_vecs[foodID] for foodID in foodIDs], axis=0)
 
                 # add data examples
-                for response in responses:
-                    self.responses.append(response)
-                    self.meals.append(meal)
-                    self.healthyLabels.append(0 if label=="$(unhealthy)" else 1)
-                    self.foods.append(foodList)
-                    self.foodEmbeddings.append(embeddingSum)
+                self.addEntry(meal, foodList, 0 if label=="$(unhealthy)" else 1, embeddingSum, responses)
 
                 # add example with neighbor embedding sum instead
                 if augment:
                     neighborEmbeddingSum = np.sum([usda_vecs[foodID] for foodID in neighborIDs], axis=0)
-                    for response in responses:
-                        self.responses.append(response)
-                        self.meals.append(meal)
-                        self.healthyLabels.append(0 if label=="$(unhealthy)" else 1)
-                        self.foods.append(foodList)
-                        self.foodEmbeddings.append(neighborEmbeddingSum)
-
-        print(self.meals[:2])
+                    self.addEntry(meal, foodList, 0 if label=="$(unhealthy)" else 1, neighborEmbeddingSum, responses)
+
+        self.foodEmbeddings = np.array(self.foodEmbeddings, dtype=np.float32)
+        self.healthyLabels = np.array(self.healthyLabels, dtype=np.int8)
+        self.sampleEntries = np.array(self.sampleEntries, dtype=np.int32)
+
+        print(list(self.getMeals()[:2]))
         print(self.responses[:2])
-        print(self.healthyLabels[:2])
-        print([food.foodID for food in self.foods[0]])
-        print(self.foodEmbeddings[-1], len(self.foodEmbeddings[-1]))
-        assert len(self.meals) == len(self.responses) == len(self.foods)
-        assert len(self.foods) == len(self.healthyLabels) == len(self.foodEmbeddings)
-        print(len(self.meals))
-
-    
+        print(list(self.getLabels()[:2]))
+        print([food.foodID for food in self.getFoods()[0]])
+        print(self.getFoodEmb()[-1], len(self.getFoodEmb()[-1]))
+        assert len(self.meals) == len(self.foods) == len(self.healthyLabels) == len(self.foodEmbeddings)
+        assert len(self.responses) == len(self.sampleEntries)
+        print(len(self.responses))
+
+    def addEntry(self, meal, foods, label, embeddingSum, responses):
+        """Add a meal entry and one sample for each of its responses
+        """
+        entry = len(self.meals)
+        self.meals.append(meal)
+        self.foods.append(foods)
+        self.healthyLabels.append(label)
+        self.foodEmbeddings.append(embeddingSum)
+        for response in responses:
+            self.responses.append(response)
+            self.sampleEntries.append(entry)
+
     def getMeals(self):
         if not self.healthy_flag:
-            return self.meals
+            return RowView(self.meals, self.sampleEntries)
         else:
             # append healthy/unhealthy at the end of the meal
             meals_plus_healthy = [meal + " healthy" if label else meal + " unhealthy" for (meal, label) in zip(self.meals, self.healthyLabels)]
             print(meals_plus_healthy[0])
-            return meals_plus_healthy
+            return RowView(meals_plus_healthy, self.sampleEntries)
 
     def getResponses(self):
         return self.responses
@@ -237,13 +466,13 @@ class HealthyData:
         return wordList
 
     def getFoods(self):
-        return self.foods
+        return RowView(self.foods, self.sampleEntries)
 
     def getFoodEmb(self):
-        return self.foodEmbeddings
+        return RowView(self.foodEmbeddings, self.sampleEntries)
 
     def getFoodIDs(self):
-        return [' '.join([food.foodID for food in foodList]) for foodList in self.foods]
+        return RowView([' '.join([food.foodID for food in foodList]) for foodList in self.foods], self.sampleEntries)
 
     def getLabels(self):
-        return self.healthyLabels
+        return RowView(self.healthyLabels, self.sampleEntries)
@@ -0,0 +1,214 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Binary format of the dataset. The vocabulary and the samples are saved as flat files inside a directory and memory
+mapped when loaded, so the samples are only read from the disk when used (nothing to unpickle at startup).
+
+Content of the directory:
+ * meta.json: format version and sizes
+ * vocab.txt: one word per line (the line number is the word id)
+ * inputs.npy, targets.npy: int32 concatenation of all the input/target sequences
+ * inputs_offsets.npy, targets_offsets.npy: int64 [nbSamples+1], position of each sequence in the previous arrays
+ * context.npy: float32 [nbSamples, contextSize], food embedding context of each sample (optional)
+ * response_words.txt: one token per line, tokens of the responses used by the MMI language model (optional)
+ * labels.npy: int8 [nbSamples], healthy/unhealthy label of each sample (optional)
+"""
+
+import os
+import json
+import numpy as np
+
+
+FORMAT_VERSION = 1
+
+META_FILENAME = 'meta.json'
+VOCAB_FILENAME = 'vocab.txt'
+RESPONSE_WORDS_FILENAME = 'response_words.txt'
+
+
+class MappedSamples:
+    """Read-only list of samples [input, target(, context)] backed by memory mapped arrays
+    The returned sequences are views on the mapped files (no copy), they should not be modified
+    """
+    def __init__(self, dirName, meta):
+        """
+        Args:
+            dirName (str): the dataset directory
+            meta (dict): the content of the meta file
+        """
+        self.nbSamples = meta['nbSamples']
+        self.inputs = _loadArray(dirName, 'inputs', meta['nbInputWords'])
+        self.inputOffsets = _loadArray(dirName, 'inputs_offsets', self.nbSamples + 1)
+        self.targets = _loadArray(dirName, 'targets', meta['nbTargetWords'])
+        self.targetOffsets = _loadArray(dirName, 'targets_offsets', self.nbSamples + 1)
+        self.context = None
+        if meta['contextSize']:
+            self.context = _loadArray(dirName, 'context', self.nbSamples)
+
+    def __len__(self):
+        return self.nbSamples
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.nbSamples
+        if not 0 <= i < self.nbSamples:
+            raise IndexError('Sample index out of range: {}'.format(i))
+        sample = [
+            self.inputs[self.inputOffsets[i]:self.inputOffsets[i+1]],
+            self.targets[self.targetOffsets[i]:self.targetOffsets[i+1]]
+        ]
+        if self.context is not None:
+            sample.append(self.context[i])
+        return sample
+
+    def __iter__(self):
+        for i in range(self.nbSamples):
+            yield self[i]
+
+
+def _loadArray(dirName, name, size):
+    """Memory map a saved array (empty arrays are simply loaded)
+    """
+    fileName = os.path.join(dirName, name + '.npy')
+    return np.load(fileName, mmap_mode='r' if size else None)
+
+
+def _flattenSequences(sequences):
+    """Concatenate the sequences and compute their offsets
+    Return:
+        np.array, np.array: the int32 words and the int64 offsets
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    words = np.empty(int(offsets[-1]), dtype=np.int32)
+    for seq, start, end in zip(sequences, offsets[:-1], offsets[1:]):
+        words[start:end] = seq
+    return words, offsets
+
+
+def mappedDatasetExists(dirName):
+    """Check if a binary dataset has been saved on the given directory
+    """
+    return os.path.exists(os.path.join(dirName, META_FILENAME))
+
+
+def saveMappedDataset(dirName, id2word, samples, responseWords=None, labels=None):
+    """Save the vocabulary and the samples to the binary format
+    Args:
+        dirName (str): the dataset directory (created if necessary)
+        id2word (dict<int, str>): the vocabulary (the ids should go from 0 to len(id2word)-1)
+        samples (list<Obj>): the samples [input, target(, context)]
+        responseWords (list<str>): the response tokens (optional)
+        labels (list<int>): the label of each sample (optional)
+    """
+    os.makedirs(dirName, exist_ok=True)
+
+    saveVocabulary(os.path.join(dirName, VOCAB_FILENAME), [id2word[wordId] for wordId in range(len(id2word))])
+
+    inputs, inputOffsets = _flattenSequences([sample[0] for sample in samples])
+    targets, targetOffsets = _flattenSequences([sample[1] for sample in samples])
+    np.save(os.path.join(dirName, 'inputs.npy'), inputs)
+    np.save(os.path.join(dirName, 'inputs_offsets.npy'), inputOffsets)
+    np.save(os.path.join(dirName, 'targets.npy'), targets)
+    np.save(os.path.join(dirName, 'targets_offsets.npy'), targetOffsets)
+
+    contextSize = 0
+    if samples and all(len(sample) > 2 for sample in samples):
+        context = np.asarray([sample[2] for sample in samples], dtype=np.float32)
+        contextSize = context.shape[1]
+        np.save(os.path.join(dirName, 'context.npy'), context)
+
+    if responseWords is not None:
+        with open(os.path.join(dirName, RESPONSE_WORDS_FILENAME), 'w', encoding='utf-8') as f:
+            for word in responseWords:
+                f.write(word + '\n')
+
+    if labels is not None:
+        assert len(labels) == len(samples)
+        np.save(os.path.join(dirName, 'labels.npy'), np.asarray(labels, dtype=np.int8))
+
+    meta = {  # Written last, so an interrupted save is not considered as a valid dataset
+        'version': FORMAT_VERSION,
+        'vocabularySize': len(id2word),
+        'nbSamples': len(samples),
+        'nbInputWords': len(inputs),
+        'nbTargetWords': len(targets),
+        'contextSize': contextSize,
+        'responseWords': responseWords is not None,
+        'labels': labels is not None
+    }
+    with open(os.path.join(dirName, META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def loadMappedDataset(dirName):
+    """Load the vocabulary and map the samples of a binary dataset
+    Args:
+        dirName (str): the dataset directory
+    Return:
+        list<str>: the vocabulary (the word of each id)
+        MappedSamples: the samples
+        str: the file containing the response tokens (None if not saved)
+        np.array: the label of each sample (None if not saved)
+    """
+    with open(os.path.join(dirName, META_FILENAME), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise UserWarning('Present dataset version {0} does not match {1}. You should recreate the dataset \'{2}\''.format(meta.get('version'), FORMAT_VERSION, dirName))
+
+    words = loadVocabulary(os.path.join(dirName, VOCAB_FILENAME))
+    assert len(words) == meta['vocabularySize']
+
+    responseWordsFile = None
+    if meta['responseWords']:
+        responseWordsFile = os.path.join(dirName, RESPONSE_WORDS_FILENAME)
+
+    labels = None
+    if meta.get('labels'):
+        labels = np.load(os.path.join(dirName, 'labels.npy'))
+
+    return words, MappedSamples(dirName, meta), responseWordsFile, labels
+
+
+def loadVocabulary(fileName):
+    """Load a vocabulary file (one word per line)
+    Return:
+        list<str>: the word of each id
+    """
+    with open(fileName, 'r', encoding='utf-8') as f:
+        words = f.read().split('\n')  # Not splitlines() which also split on some unicode characters
+    if words and words[-1] == '':
+        words.pop()
+    return words
+
+
+def saveVocabulary(fileName, words):
+    """Save a vocabulary file (one word per line)
+    Args:
+        words (list<str>): the word of each id
+    """
+    with open(fileName, 'w', encoding='utf-8') as f:
+        for word in words:
+            f.write(word + '\n')
+
+
+def loadResponseWords(fileName):
+    """Load the response tokens
+    Return:
+        list<str>: the tokens
+    """
+    return loadVocabulary(fileName)  # Same one token per line format
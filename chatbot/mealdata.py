@@ -7,10 +7,19 @@ Date: 11/28/16
 import sys
 import os
 import re
-import pickle
+import multiprocessing
 
-import spacy.en
-nlp = spacy.en.English()
+from chatbot.healthydata import load_usda_vecs
+
+nlp = None  # spaCy model, only loaded when needed (see get_nlp)
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        import spacy.en
+        # Only the tokenizer is used: no tagger, parser, entity recognizer, matcher nor word vectors to load
+        nlp = spacy.en.English(tagger=False, parser=False, entity=False, matcher=False, add_vectors=False)
+    return nlp
 
 def get_matching_toks(alignment, usda_id, meal):
     matching_tokens = []
@@ -19,39 +28,54 @@ def get_matching_toks(alignment, usda_id, meal):
             matching_tokens.append(meal[token_index])
     return matching_tokens
 
-def spacy_tokenize(in_str):
-    tokens = nlp(in_str)
-    return [token.orth_ for token in tokens], [token.lemma_ for token in tokens]
+def spacy_tokenize_batch(in_strs, batch_size=1000):
+    # only the tokenizer runs
+    return [[token.orth_ for token in doc] for doc in get_nlp().tokenizer.pipe(in_strs, batch_size=batch_size)]
+
+def tokenize_meals(meals, num_workers=1, batch_size=1000):
+    """Tokenize all the meals, by batches, optionally on multiple processes (each one loads its own spaCy model)
+    """
+    if num_workers <= 1 or len(meals) <= batch_size:
+        return spacy_tokenize_batch(meals, batch_size)
+    chunks = [meals[i:i+batch_size] for i in range(0, len(meals), batch_size)]
+    with multiprocessing.Pool(num_workers) as pool:
+        tokens = pool.map(spacy_tokenize_batch, chunks)
+    return [meal_tokens for chunk in tokens for meal_tokens in chunk]
 
 
 
 class MealData:
 
-    def __init__(self, dirName):
+    def __init__(self, dirName, num_workers=1, cache_dir=None):
         """
         Args:
             dirName (string): directory where to load the corpus
+            num_workers (int): number of processes tokenizing the meals
+            cache_dir (string): where to save the converted embeddings (see load_usda_vecs)
         """
         meal_lines = open(dirName + 'allfood_diaries_all.txt').readlines()
         self.meals = []
         alignments = open('alignments_allfood_all_cnn_segmenter').readlines()
-        self.usda_vecs = pickle.load(open('/usr/users/korpusik/USDA-encoder-data/models/allfood/allfood_matcher_lowercase_nousdacnn_aligned_vecs_dict', 'rb'), encoding='latin1')
+        self.usda_vecs = load_usda_vecs(source='dict', cache_dir=cache_dir)  # The _vecs_dict, memory mapped
         self.food_IDs = [] # list of food ID lists per meal diary
         self.food_descrips = [] # list of food descriptions per meal diary
         self.single_food_descrips = [] # list of single food descriptions
         self.alignments = [] # list of aligned segments per food item
 
         # load USDA foods (try encoding foods, decoding meals)
+        food_lines = open(dirName + 'allfood_food_IDs_all.txt').readlines()
+        meals = [re.sub(' +', ' ', meal.strip()) for meal in meal_lines[:len(food_lines)]]
+        all_meal_tokens = tokenize_meals(meals, num_workers)
+
         alignment_index = 0
-        for foods in open(dirName + 'allfood_food_IDs_all.txt').readlines():
+        for foods in food_lines:
             food_IDs = []
             food_descrips = []
             alignment = alignments[alignment_index].strip().split()
-            meal = meal_lines[alignment_index].strip()
-            meal = re.sub(' +', ' ', meal)
+            meal = meals[alignment_index]
             
             # skip meals with diff num tokens than alignments
-            meal_tokens, lemmas = spacy_tokenize(meal)
+            meal_tokens = all_meal_tokens[alignment_index]
             if len(alignment) != len(meal_tokens):
                 print('mismatched lengths', alignment, meal_tokens)
                 print(alignment_index, len(alignment), len(meal_tokens))
@@ -101,9 +125,9 @@ class MealData:
         return self.alignments
 
     def getEmbeddings(self):
-        # get learned embeddings for each food ID
+        # get learned embeddings for each food ID (float32 [nb foods, embedding size] array per meal)
         self.embeddings = []
         for food_id_list in self.getFoodIDs():
-            embedding_list = [self.usda_vecs[food_id] for food_id in food_id_list]
+            embedding_list = self.usda_vecs.gather(food_id_list)
             self.embeddings.append(embedding_list)
         return self.embeddings
@@ -89,16 +89,19 @@ class Model:
         self.args = args  # Keep track of the parameters of the model
         self.dtype = tf.float32
 
-        # Placeholders
+        # Placeholders (time-major tensors [maxLength, batchSize], unstacked in the graph for each bucket)
         self.encoderInputs  = None
+        self.encoderLengths = None  # Length of each input (only with the dynamic encoder)
         self.decoderInputs  = None  # Same that decoderTarget plus the <go>
         self.decoderTargets = None
         self.decoderWeights = None  # Adjust the learning to the target sentence size
-        self.decoderContext = None
+        self.decoderContext = None  # Food embedding, same for all decoder steps
 
-        # Main operators
-        self.lossFct = None
-        self.optOp = None
+        # Main operators (one for each bucket)
+        self.buckets = None  # List of the (encoder length, decoder length) of each bucket
+        self.lossFcts = []
+        self.lossSummaries = []
+        self.optOps = []
         self.outputs = None  # Outputs of the network, list of probability for each words
 
         # Construct the graphs
@@ -109,14 +112,17 @@ class Model:
         """
 
         # TODO: Create name_scopes (for better graph visualisation)
-        # TODO: Use buckets (better perfs)
+
+        # The decoder can have its own (smaller) vocabulary (--decoderVocab), the encoder always use the full one
+        encoderVocabularySize = self.textData.getVocabularySize()
+        decoderVocabularySize = self.textData.getDecoderVocabularySize()
 
         # Parameters of sampled softmax (needed for attention mechanism and a large vocabulary size)
         outputProjection = None
         # Sampled softmax only makes sense if we sample less than vocabulary size.
-        if 0 < self.args.softmaxSamples < self.textData.getVocabularySize():
+        if 0 < self.args.softmaxSamples < decoderVocabularySize:
             outputProjection = ProjectionOp(
-                (self.args.hiddenSize, self.textData.getVocabularySize()),
+                (self.args.hiddenSize, decoderVocabularySize),
                 scope='softmax_projection',
                 dtype=self.dtype
             )
@@ -136,7 +142,7 @@ class Model:
                         inputs=localInputs,
                         labels=labels,
                         num_sampled=self.args.softmaxSamples,  # The number of classes to randomly sample per batch
-                        num_classes=self.textData.getVocabularySize()),  # The number of classes
+                        num_classes=decoderVocabularySize),  # The number of classes
                     self.dtype)
 
         # Creation of the rnn cell
@@ -147,15 +153,17 @@ class Model:
         # Network input (placeholders)
 
         with tf.name_scope('placeholder_encoder'):
-            self.encoderInputs  = [tf.placeholder(tf.int32,   [None, ]) for _ in range(self.args.maxLengthEnco)]  # Batch size * sequence length * input dim
+            self.encoderInputs  = tf.placeholder(tf.int32,   [None, None], name='inputs')  # Sequence length * batch size
+            if self.args.dynamicEncoder:
+                self.encoderLengths = tf.placeholder(tf.int32, [None], name='lengths')
 
         with tf.name_scope('placeholder_decoder'):
-            self.decoderInputs  = [tf.placeholder(tf.int32,   [None, ], name='inputs') for _ in range(self.args.maxLengthDeco)]  # Same sentence length for input and output (Right ?)
-            self.decoderTargets = [tf.placeholder(tf.int32,   [None, ], name='targets') for _ in range(self.args.maxLengthDeco)]
-            self.decoderWeights = [tf.placeholder(tf.float32, [None, ], name='weights') for _ in range(self.args.maxLengthDeco)]
+            self.decoderInputs  = tf.placeholder(tf.int32,   [None, None], name='inputs')  # Same sentence length for input and output (Right ?)
+            self.decoderTargets = tf.placeholder(tf.int32,   [None, None], name='targets')
+            self.decoderWeights = tf.placeholder(tf.float32, [None, None], name='weights')
 
-            if self.args.corpus == 'healthy-comments':
-                self.decoderContext = [tf.placeholder(tf.float32, [None, 64,], name='context') for _ in range(self.args.maxLengthDeco)]
+            if self.args.food_context:
+                self.decoderContext = tf.placeholder(tf.float32, [None, 64,], name='context')
 
         # Define the network
         # Here we use an embedding model, it takes integer as input and convert them into word vector for
@@ -169,69 +177,97 @@ class Model:
             rnn_model = embedding_rnn_seq2seq
             #rnn_model = tf.contrib.legacy_seq2seq.embedding_rnn_seq2seq
 
+        # When testing with early stop, the decoder stops as soon as all the sequences emitted <eos>
+        eosId = int(self.textData.toDecoderIds(self.textData.eosToken)) if self.args.test and self.args.earlyStop else None
 
-        if self.args.food_context:
-            decoderOutputs, states, beamPath, beamSymbols, beamProbs = rnn_model(
-                self.encoderInputs,  # List<[batch=?, inputDim=1]>, list of size args.maxLength
-                self.decoderInputs,  # For training, we force the correct output (feed_previous=False)
-                self.decoderContext,
-                encoDecoCell,
-                self.textData.getVocabularySize(),
-                self.textData.getVocabularySize(),  # Both encoder and decoder have the same number of class
-                embedding_size=self.args.embeddingSize,  # Dimension of each word
-                output_projection=outputProjection.getWeights() if outputProjection else None,
-                feed_previous=bool(self.args.test),  # When we test (self.args.test), we use previous output as next input (feed_previous)
-                first_step=self.args.first_step,
-                beam_search=bool(self.args.beam_search),
-                beam_size=self.args.beam_size
-            )
-        else:
-            decoderOutputs, states, beamPath, beamSymbols, beamProbs = rnn_model(
-                self.encoderInputs,
-                self.decoderInputs,
-                encoDecoCell,
-                self.textData.getVocabularySize(),
-                self.textData.getVocabularySize(),
-                embedding_size=self.args.embeddingSize,
-                output_projection=outputProjection.getWeights() if outputProjection else None,
-                feed_previous=bool(self.args.test),
-                beam_search=bool(self.args.beam_search),
-                beam_size=self.args.beam_size
-            )
-            print(len(decoderOutputs))
-
-        # For testing only
+        # One unrolled network is created for each bucket, all sharing the same variables (the testing graph only use
+        # the largest one)
         if self.args.test:
-            self.outputs = decoderOutputs
-            if self.args.beam_search:
-                self.outputs.append(beamPath)
-                self.outputs.append(beamSymbols)
-                self.outputs.append(beamProbs)
-            elif self.args.attention or self.args.food_context:
-                self.outputs = [outputProjection(out) for out in decoderOutputs]
-            
-            # TODO: Attach a summary to visualize the output
-
-        # For training only
+            self.buckets = [(self.args.maxLengthEnco, self.args.maxLengthDeco)]
         else:
-            # Finally, we define the loss function
-            self.lossFct = tf.contrib.legacy_seq2seq.sequence_loss(
-                decoderOutputs,
-                self.decoderTargets,
-                self.decoderWeights,
-                self.textData.getVocabularySize(),
-                softmax_loss_function= sampledSoftmax if outputProjection else None  # If None, use default SoftMax
-            )
-            tf.summary.scalar('loss', self.lossFct)  # Keep track of the cost
+            self.buckets = self.textData.getBuckets()
 
-            # Initialize the optimizer
+            # Initialize the optimizer (shared by all buckets)
             opt = tf.train.AdamOptimizer(
                 learning_rate=self.args.learningRate,
                 beta1=0.9,
                 beta2=0.999,
                 epsilon=1e-08
             )
-            self.optOp = opt.minimize(self.lossFct)
+
+        for bucketId, (encoLength, decoLength) in enumerate(self.buckets):
+            # The legacy decoders work with a list of tensors (one for each step), except the dynamic encoder which
+            # directly takes the inputs (padded at the end, up to the longest input of the batch)
+            with tf.name_scope('bucket_{}'.format(bucketId)):
+                if self.args.dynamicEncoder:
+                    encoderInputs = self.encoderInputs
+                else:
+                    encoderInputs = tf.unstack(self.encoderInputs[:encoLength], num=encoLength)
+                decoderInputs = tf.unstack(self.decoderInputs[:decoLength], num=decoLength)
+
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True if bucketId > 0 else None):
+                if self.args.food_context:
+                    decoderOutputs, states, beamPath, beamSymbols, beamProbs = rnn_model(
+                        encoderInputs,  # List<[batch=?, inputDim=1]>, list of size args.maxLength
+                        decoderInputs,  # For training, we force the correct output (feed_previous=False)
+                        self.decoderContext,
+                        encoDecoCell,
+                        encoderVocabularySize,
+                        decoderVocabularySize,  # Same number of class for the encoder and the decoder, unless --decoderVocab
+                        embedding_size=self.args.embeddingSize,  # Dimension of each word
+                        output_projection=outputProjection.getWeights() if outputProjection else None,
+                        feed_previous=bool(self.args.test),  # When we test (self.args.test), we use previous output as next input (feed_previous)
+                        first_step=self.args.first_step,
+                        beam_search=bool(self.args.beam_search),
+                        beam_size=self.args.beam_size,
+                        eos_id=eosId,
+                        encoder_lengths=self.encoderLengths
+                    )
+                else:
+                    decoderOutputs, states, beamPath, beamSymbols, beamProbs = rnn_model(
+                        encoderInputs,
+                        decoderInputs,
+                        encoDecoCell,
+                        encoderVocabularySize,
+                        decoderVocabularySize,
+                        embedding_size=self.args.embeddingSize,
+                        output_projection=outputProjection.getWeights() if outputProjection else None,
+                        feed_previous=bool(self.args.test),
+                        beam_search=bool(self.args.beam_search),
+                        beam_size=self.args.beam_size,
+                        eos_id=eosId,
+                        encoder_lengths=self.encoderLengths
+                    )
+
+                # For testing only
+                if self.args.test:
+                    self.outputs = decoderOutputs
+                    if self.args.beam_search:
+                        self.outputs.append(beamPath)
+                        self.outputs.append(beamSymbols)
+                        self.outputs.append(beamProbs)
+                    elif self.args.earlyStop:
+                        pass  # Single tensor [nbSteps, batchSize, vocabularySize], already projected
+                    elif self.args.attention or self.args.food_context:
+                        self.outputs = [outputProjection(out) for out in decoderOutputs]
+
+                    # TODO: Attach a summary to visualize the output
+
+                # For training only
+                else:
+                    # Finally, we define the loss function
+                    lossFct = tf.contrib.legacy_seq2seq.sequence_loss(
+                        decoderOutputs,
+                        tf.unstack(self.decoderTargets[:decoLength], num=decoLength),
+                        tf.unstack(self.decoderWeights[:decoLength], num=decoLength),
+                        self.textData.getVocabularySize(),
+                        softmax_loss_function= sampledSoftmax if outputProjection else None  # If None, use default SoftMax
+                    )
+                    self.lossFcts.append(lossFct)
+                    self.lossSummaries.append(tf.summary.scalar('loss', lossFct))  # Keep track of the cost
+
+            if not self.args.test:
+                self.optOps.append(opt.minimize(self.lossFcts[bucketId]))
 
     def step(self, batch, match_encoder_decoder_input=False):
         """ Forward/training step operation.
@@ -239,40 +275,37 @@ class Model:
         Args:
             batch (Batch): Input data on testing mode, input and target on output mode
         Return:
-            (ops), dict: A tuple of the (training, loss) operators or (outputs,) in testing mode with the associated feed dictionary
+            (ops), dict: A tuple of the (training, loss, summary) operators or (outputs,) in testing mode with the associated feed dictionary
         """
 
         # Feed the dictionary
         feedDict = {}
         ops = None
 
+        # The batch arrays have the length of their bucket, which select the unrolled network to run
+        bucketId = batch.bucketId if batch.bucketId is not None else len(self.buckets) - 1
+
         if not self.args.test:  # Training
             if not self.args.finetune:
-                for i in range(self.args.maxLengthEnco):
-                    feedDict[self.encoderInputs[i]]  = batch.encoderSeqs[i]
-            for i in range(self.args.maxLengthDeco):
-                feedDict[self.decoderInputs[i]]  = batch.decoderSeqs[i]
-                feedDict[self.decoderTargets[i]] = batch.targetSeqs[i]
-                feedDict[self.decoderWeights[i]] = batch.weights[i]
-                if self.args.corpus == 'healthy-comments':
-                    feedDict[self.decoderContext[i]] = batch.contextSeqs[i]
-
-            ops = (self.optOp, self.lossFct)
-        else:  # Testing (batchSize == 1)
-            for i in range(self.args.maxLengthEnco):
-                feedDict[self.encoderInputs[i]]  = batch.encoderSeqs[i]
-            if match_encoder_decoder_input:
-                # use encoder input as decoder input
-                for i in range(self.args.maxLengthDeco):
-                    feedDict[self.decoderInputs[i]]  = batch.decoderSeqs[i]
-            else:
-                feedDict[self.decoderInputs[0]]  = [self.textData.goToken]
-                #print('decoder input size', len(batch.decoderSeqs[i]), batch.decoderSeqs[i], self.textData.goToken)
-                if self.args.corpus == 'healthy-comments':
-                    for i in range(self.args.maxLengthDeco):
-                        #print('context size', len(batch.contextSeqs[i]), batch.contextSeqs[i])
-                        #print(i, batch.contextSeqs[i])
-                        feedDict[self.decoderContext[i]] = batch.contextSeqs[i]
+                feedDict[self.encoderInputs]  = batch.encoderSeqs
+                if self.args.dynamicEncoder:
+                    feedDict[self.encoderLengths] = batch.encoderLengths
+            feedDict[self.decoderInputs]  = batch.decoderSeqs
+            feedDict[self.decoderTargets] = batch.targetSeqs
+            feedDict[self.decoderWeights] = batch.weights
+            if self.args.food_context:
+                feedDict[self.decoderContext] = batch.context
+
+            ops = (self.optOps[bucketId], self.lossFcts[bucketId], self.lossSummaries[bucketId])
+        else:  # Testing (any batch size, each query is decoded independently)
+            feedDict[self.encoderInputs]  = batch.encoderSeqs
+            if self.args.dynamicEncoder:
+                feedDict[self.encoderLengths] = batch.encoderLengths
+            # Only the first decoder input (<go>) is used, unless we use the encoder input as decoder input
+            # (match_encoder_decoder_input)
+            feedDict[self.decoderInputs]  = batch.decoderSeqs
+            if self.args.food_context:
+                feedDict[self.decoderContext] = batch.context
 
             ops = (self.outputs,)
 
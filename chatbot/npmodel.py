@@ -0,0 +1,338 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Numpy implementation of the testing graph of Model, run on the trained weights exported to a npz file. Tensorflow is
+not needed to load nor to run it.
+
+Each trained variable is saved under the name of its role in the network (ex: 'decoder/cell_0/weights'), with:
+ * options: json of the options the testing graph has been built with (same as the frozen model signature)
+ * eosId: the id of the <eos> token (for the early stop)
+
+Same computations as chatbot.decoders (BasicLSTMCell layers, the attention decoders with their optional food context,
+the greedy and the beam search decoding with or without the early stop), so the outputs match the ones of the
+testing graph up to the float32 rounding.
+"""
+
+import re
+import json
+import numpy as np
+
+
+WEIGHTS_FILENAME = 'weights.npz'
+
+OPTIONS_KEY = 'options'
+EOS_KEY = 'eosId'
+
+_LINEAR_KINDS = {  # Name of the variables of the linear layers, depending of the tensorflow version
+    'weights': 'weights', 'kernel': 'weights', 'Matrix': 'weights',
+    'biases': 'biases', 'bias': 'biases', 'Bias': 'biases'
+}
+
+LSTM_FORGET_BIAS = 1.0  # Default of BasicLSTMCell
+
+
+def weightRole(name):
+    """Find the role of a trained variable of Model
+    Args:
+        name (str): the variable name (ex: 'embedding_rnn_seq2seq/rnn/multi_rnn_cell/cell_0/basic_lstm_cell/weights')
+    Return:
+        str: the name of the weight in the numpy model (ex: 'encoder/cell_0/weights')
+    """
+    scope, _, last = name.rpartition('/')
+    kind = _LINEAR_KINDS.get(last)
+    part = 'decoder' if '_decoder/' in name else 'encoder'
+
+    cell = re.search(r'cell_(\d+)/', scope)
+    if scope.endswith('weights_softmax_projection') and kind:
+        return 'projection/' + kind
+    elif last == 'embedding':
+        return part + '/embedding'
+    elif last.startswith('AttnW_'):
+        return 'attention/W'
+    elif last.startswith('AttnV_'):
+        return 'attention/V'
+    elif cell and kind:
+        return '{}/cell_{}/{}'.format(part, cell.group(1), kind)
+    elif scope.endswith('output_projection_wrapper') and kind:
+        return 'decoder/output_wrapper/' + kind
+    elif scope.endswith('Attention_0') and kind:
+        return 'attention/query/' + kind
+    elif scope.endswith('AttnOutputProjection') and kind:
+        return 'attention/output/' + kind
+    elif scope.endswith('attention_decoder') and kind:  # Merge of the input and the attention
+        return 'attention/input/' + kind
+    raise ValueError('Unexpected variable in the model: {}'.format(name))
+
+
+def exportWeights(fileName, weights, options, eosId):
+    """Save the trained weights of the model for the numpy model
+    Args:
+        fileName (str): the npz file
+        weights (dict<str, np.array>): the values of the trainable variables of the testing model, by name
+        options (dict<str, Obj>): the options the testing graph has been built with
+        eosId (int): the id of the <eos> token
+    """
+    arrays = {}
+    for name, value in weights.items():
+        role = weightRole(name)
+        assert role not in arrays, 'Multiple variables for {}'.format(role)
+        arrays[role] = np.asarray(value, dtype=np.float32)
+    if 'attention/W' in arrays:  # 1x1 convolution kernel [1, 1, attnSize, attnSize]
+        arrays['attention/W'] = arrays['attention/W'].reshape(arrays['attention/W'].shape[-2:])
+    arrays[OPTIONS_KEY] = np.array(json.dumps(options))
+    arrays[EOS_KEY] = np.array(eosId)
+    np.savez(fileName, **arrays)
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _topK(values, k):
+    """Same as tf.nn.top_k on the last dimension (sorted, the lowest indices first for the ties)
+    """
+    indices = np.argsort(-values, axis=-1, kind='stable')[..., :k]
+    return np.take_along_axis(values, indices, axis=-1), indices
+
+
+class NumpyModel:
+    """Testing model run with numpy on the exported weights
+    The state of the cells is kept as a list of (c, h) for each layer
+    """
+    def __init__(self, fileName):
+        """
+        Args:
+            fileName (str): the npz file saved by exportWeights
+        """
+        print('Loading numpy model from {}...'.format(fileName))
+        with np.load(fileName) as data:
+            self.options = json.loads(str(data[OPTIONS_KEY]))
+            self.eosId = int(data[EOS_KEY])
+            self.weights = {name: data[name] for name in data.files if name not in (OPTIONS_KEY, EOS_KEY)}
+
+        self.numLayers = sum(1 for name in self.weights if re.match(r'encoder/cell_\d+/weights$', name))
+        self.hiddenSize = self.weights['encoder/cell_0/biases'].shape[0] // 4
+        self.numSymbols = self.weights['decoder/embedding'].shape[0]
+        self.attention = 'attention/W' in self.weights
+        self.context = bool(self.options['food_context']) and not self.options['attention']  # Context decoder
+
+        # Log probabilities of a finished hypothesis of the beam (only followed by <eos>)
+        with np.errstate(divide='ignore'):
+            self.frozenProbs = np.log(np.eye(self.numSymbols, dtype=np.float32)[self.eosId])
+
+    def predict(self, batch):
+        """ Decode the batch, same as running the testing graph of Model
+        Args:
+            batch (Batch): the encoded questions
+        Return:
+            list<np.array>: the [beamPath, beamSymbols, beamProbs] [nbSteps, batchSize, beamSize] with beam search,
+                otherwise the projected outputs [nbSteps, batchSize, vocabularySize]
+        """
+        with np.errstate(over='ignore', divide='ignore'):  # exp/log saturating to 0/inf as in tensorflow
+            attentionStates, state = self._encode(batch)
+
+            attention = None
+            attns = None
+            if self.attention:
+                attention = self._prepareAttention(attentionStates, batch.encoderLengths)
+                attns = np.zeros((attentionStates.shape[0], attentionStates.shape[2]), dtype=np.float32)
+            context = None
+            if self.context:
+                context = np.asarray(batch.context, dtype=np.float32)
+
+            # First step, fed with the first decoder input (<go>)
+            prev, state, attns = self._step(
+                self.weights['decoder/embedding'][batch.decoderSeqs[0]], state, attns, attention, context
+            )
+            if context is not None and self.options['first_step']:
+                context = np.zeros_like(context)
+
+            numSteps = batch.decoderSeqs.shape[0]
+            if self.options['beam_search']:
+                return self._beamSearch(prev, state, attns, attention, context, numSteps)
+            return self._greedySearch(prev, state, attns, attention, context, numSteps)
+
+    def _greedySearch(self, prev, state, attns, attention, context, numSteps):
+        """ Feed the most likely word of each step to the next one
+        """
+        outputs = [self._project(prev)]
+        finished = outputs[-1].argmax(axis=1) == self.eosId
+        while len(outputs) < numSteps and not (self.options['earlyStop'] and finished.all()):
+            prev, state, attns = self._step(
+                self.weights['decoder/embedding'][outputs[-1].argmax(axis=1)], state, attns, attention, context
+            )
+            outputs.append(self._project(prev))
+            finished |= outputs[-1].argmax(axis=1) == self.eosId
+        return np.stack(outputs)
+
+    def _beamSearch(self, prev, state, attns, attention, context, numSteps):
+        """ Keep the beamSize most likely hypotheses of each query, the hypotheses of a query are contiguous (query
+        major [batchSize * beamSize] rows)
+        """
+        beamSize = self.options['beam_size']
+        earlyStop = self.options['earlyStop']
+
+        # After the first step, each hypothesis has its own row
+        state = [(np.repeat(c, beamSize, axis=0), np.repeat(h, beamSize, axis=0)) for c, h in state]
+        if attention is not None:
+            attention = {name: np.repeat(value, beamSize, axis=0) if value is not None else None for name, value in attention.items()}
+            attns = self._attention(attention, state)
+        if context is not None:
+            context = np.repeat(context, beamSize, axis=0)
+
+        symbols, parents, logProbs = self._extractBeam(prev)
+        beamPath, beamSymbols, beamProbs = [parents], [symbols], [logProbs]
+        while len(beamPath) < numSteps - 1 and not (earlyStop and (symbols == self.eosId).all()):
+            prev, state, attns = self._step(
+                self.weights['decoder/embedding'][symbols.reshape(-1)], state, attns, attention, context
+            )
+            finished = symbols == self.eosId if earlyStop else None
+            symbols, parents, logProbs = self._extractBeam(prev, logProbs, finished)
+            beamPath.append(parents)
+            beamSymbols.append(symbols)
+            beamProbs.append(logProbs)
+        return [np.stack(beamPath), np.stack(beamSymbols), np.stack(beamProbs)]
+
+    def _extractBeam(self, prev, logProbs=None, finished=None):
+        """ Select the best continuations of the hypotheses of each query
+        Args:
+            prev (np.array): the outputs of the step [batchSize(*beamSize), outputSize]
+            logProbs (np.array): the log probability of each hypothesis [batchSize, beamSize] (None on the first step)
+            finished (np.array): whether each hypothesis ended [batchSize, beamSize] (None without early stop)
+        Return:
+            np.array, np.array, np.array: the symbols, the parent hypotheses and the log probabilities
+                [batchSize, beamSize]
+        """
+        beamSize = self.options['beam_size']
+        probs = np.log(_softmax(self._project(prev)))
+        if logProbs is not None:
+            if finished is not None:
+                probs[finished.reshape(-1)] = self.frozenProbs
+            probs = (probs + logProbs.reshape(-1, 1)).reshape(-1, beamSize * self.numSymbols)
+        bestProbs, indices = _topK(probs, beamSize)
+        return (indices % self.numSymbols).astype(np.int32), (indices // self.numSymbols).astype(np.int32), bestProbs
+
+    def _encode(self, batch):
+        """ Run the encoder on the inputs
+        Return:
+            np.array: the outputs of each step [batchSize, maxLengthEnco, hiddenSize] (zeros after the end of each
+                input with the dynamic encoder)
+            list<(np.array, np.array)>: the last state
+        """
+        inputs = batch.encoderSeqs
+        batchSize = inputs.shape[1]
+        zeros = np.zeros((batchSize, self.hiddenSize), dtype=np.float32)
+        state = [(zeros, zeros)] * self.numLayers
+        outputs = np.zeros((batchSize, inputs.shape[0], self.hiddenSize), dtype=np.float32)
+        for t in range(inputs.shape[0]):
+            output, nextState = self._cell('encoder', self.weights['encoder/embedding'][inputs[t]], state)
+            if self.options['dynamicEncoder']:  # The outputs and the states stop at the end of each input
+                valid = (t < batch.encoderLengths)[:, None]
+                output = np.where(valid, output, 0)
+                nextState = [
+                    (np.where(valid, c, prevC), np.where(valid, h, prevH))
+                    for (c, h), (prevC, prevH) in zip(nextState, state)
+                ]
+            outputs[:, t] = output
+            state = nextState
+        return outputs, state
+
+    def _cell(self, part, inputs, state):
+        """ Run the stacked LSTM cells (BasicLSTMCell in a MultiRNNCell) on one step
+        Args:
+            part (str): 'encoder' or 'decoder'
+            inputs (np.array): the inputs of the first layer [batchSize, inputSize]
+            state (list<(np.array, np.array)>): the (c, h) of each layer
+        Return:
+            np.array, list<(np.array, np.array)>: the output of the last layer (projected if the decoder cell is
+                wrapped in an OutputProjectionWrapper) and the new state
+        """
+        nextState = []
+        for layer, (c, h) in enumerate(state):
+            i, j, f, o = np.split(self._linear('{}/cell_{}'.format(part, layer), [inputs, h]), 4, axis=1)
+            c = c * _sigmoid(f + LSTM_FORGET_BIAS) + _sigmoid(i) * np.tanh(j)
+            h = np.tanh(c) * _sigmoid(o)
+            nextState.append((c, h))
+            inputs = h
+        if part == 'decoder' and 'decoder/output_wrapper/weights' in self.weights:
+            inputs = self._linear('decoder/output_wrapper', [inputs])
+        return inputs, nextState
+
+    def _step(self, inputs, state, attns, attention, context):
+        """ Run one decoder step
+        Args:
+            inputs (np.array): the embedded inputs [batchSize, embeddingSize]
+            state (list<(np.array, np.array)>): the state of the cells
+            attns (np.array): the previous attention read (None without attention)
+            attention (dict<str, np.array>): the attention states, see _prepareAttention (None without attention)
+            context (np.array): the food context (None if not used)
+        Return:
+            np.array, list<(np.array, np.array)>, np.array: the output, the state and the attention read
+        """
+        if attention is None:
+            output, state = self._cell('decoder', inputs, state)
+            return output, state, attns
+
+        x = self._linear('attention/input', [inputs] + ([context] if context is not None else []) + [attns])
+        cellOutput, state = self._cell('decoder', x, state)
+        attns = self._attention(attention, state)
+        output = self._linear('attention/output', [cellOutput, attns])
+        return output, state, attns
+
+    def _prepareAttention(self, attentionStates, lengths):
+        """ Compute the parts of the attention which only depend on the encoder outputs
+        Return:
+            dict<str, np.array>: the attention states, their features and the mask of the valid entries
+        """
+        mask = None
+        if self.options['dynamicEncoder']:  # No attention on the padding
+            mask = np.arange(attentionStates.shape[1])[None, :] < np.asarray(lengths)[:, None]
+        return {
+            'hidden': attentionStates,
+            'features': attentionStates @ self.weights['attention/W'],  # The 1x1 convolution
+            'mask': mask
+        }
+
+    def _attention(self, attention, state):
+        """ Read the attention states, queried by the decoder state
+        Return:
+            np.array: the attention-weighted vector [batchSize, attnSize]
+        """
+        query = np.concatenate([x for layerState in state for x in layerState], axis=1)
+        y = self._linear('attention/query', [query])
+        s = np.sum(self.weights['attention/V'] * np.tanh(attention['features'] + y[:, None, :]), axis=2)
+        if attention['mask'] is not None:
+            s = np.where(attention['mask'], s, np.finfo(s.dtype).min)
+        a = _softmax(s)
+        return np.sum(a[:, :, None] * attention['hidden'], axis=1)
+
+    def _linear(self, name, args):
+        """ Same as the tensorflow linear layer on the concatenated args
+        """
+        x = np.concatenate(args, axis=1) if len(args) > 1 else args[0]
+        return x @ self.weights[name + '/weights'] + self.weights[name + '/biases']
+
+    def _project(self, output):
+        """ Project the decoder output on the vocabulary (if the model uses an output projection)
+        """
+        if 'projection/weights' in self.weights:
+            return output @ self.weights['projection/weights'] + self.weights['projection/biases']
+        return output
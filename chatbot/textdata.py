@@ -24,80 +24,171 @@ import pickle  # Saving the data
 import math  # For float comparison
 import os  # Checking file existance
 import random
-import numpy as np
+import itertools
+import threading  # Batch prefetching
+import queue
+import multiprocessing  # Parallel corpus extraction
+import collections
+import copy
 import urllib
 import json
 
 from chatbot.cornelldata import CornellData
 from chatbot.mealdata import MealData
 from chatbot.healthydata import HealthyData
+from chatbot.mappeddata import mappedDatasetExists, saveMappedDataset, loadMappedDataset, loadResponseWords, MappedSamples
+from chatbot.bigrammodel import BigramModel
+
+
+def tokenizeText(line):
+    """Split the line into sentences of tokens (run on the worker processes when the extraction is parallel)
+    Args:
+        line (str): the text to tokenize
+    Return:
+        list<list<str>>: the tokens of each sentence
+    """
+    return [nltk.word_tokenize(sentence) for sentence in nltk.sent_tokenize(line)]
+
+
+def tokenizeTexts(texts, numWorkers=1):
+    """Tokenize the texts, on a pool of worker processes if numWorkers > 1
+    Args:
+        texts (list<str>): the texts
+        numWorkers (int): number of processes
+    Return:
+        dict<str, list<list<str>>>: the sentence tokens of each text
+    """
+    texts = list(dict.fromkeys(texts))  # Remove duplicates (keep the order)
+    if numWorkers <= 1:
+        return {text: tokenizeText(text) for text in tqdm(texts, desc="Tokenize")}
+
+    chunkSize = max(1, len(texts) // (numWorkers * 16))
+    with multiprocessing.Pool(numWorkers) as pool:
+        tokens = list(tqdm(
+            pool.imap(tokenizeText, texts, chunksize=chunkSize),
+            desc="Tokenize ({} workers)".format(numWorkers),
+            total=len(texts)
+        ))
+    return dict(zip(texts, tokens))
 
 
 class Batch:
     """Struct containing batches info
+    All the sequences are time-major numpy arrays ([maxLength, batchSize]) which can directly be fed to the model
     """
     def __init__(self):
-        self.encoderSeqs = []
-        self.decoderSeqs = []
-        self.contextSeqs = []
-        self.targetSeqs = []
-        self.weights = []
+        self.encoderSeqs = None  # int32 [maxLengthEnco, batchSize]
+        self.encoderLengths = None  # int32 [batchSize], length of each input (used by the dynamic encoder)
+        self.decoderSeqs = None  # int32 [maxLengthDeco, batchSize]
+        self.context = None  # float32 [batchSize, 64], food embedding of each sample (only with food_context)
+        self.targetSeqs = None  # int32 [maxLengthDeco, batchSize]
+        self.weights = None  # float32 [maxLengthDeco, batchSize]
+        self.bucketId = None  # Bucket the batch belong to (None for the largest)
+
+
+class BatchPrefetcher:
+    """Iterate over the results of a list of jobs (ex: creating the batches and their feed dictionaries), computed in
+    background threads while the caller process the previous ones. The results are returned in the same order as the
+    jobs and at most queueSize of them are kept in memory at the same time.
+    Threads are used (and not processes) because the results can contain unpicklable objects (like the placeholders
+    of the feed dictionary), most of the work is done by numpy which release the GIL.
+    """
+    def __init__(self, jobs, prepare, queueSize=4, numThreads=1):
+        """
+        Args:
+            jobs (list<Obj>): the arguments given to prepare
+            prepare (fct): function called on each job
+            queueSize (int): maximum number of results prepared in advance
+            numThreads (int): number of worker threads
+        """
+        self.jobs = jobs
+        self.prepare = prepare
+        self.numThreads = max(1, numThreads)
+        self.stopEvent = threading.Event()
+
+        # Each thread handle one job over numThreads and has its own queue, so the order can be restored
+        self.queues = [queue.Queue(maxsize=max(1, queueSize // self.numThreads)) for _ in range(self.numThreads)]
+        self.threads = [threading.Thread(target=self._work, args=(i,), daemon=True) for i in range(self.numThreads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self, threadId):
+        """Prepare the jobs of the given thread
+        """
+        for job in itertools.islice(self.jobs, threadId, None, self.numThreads):
+            try:
+                result = (True, self.prepare(job))
+            except Exception as e:  # Forwarded to the main thread
+                result = (False, e)
+            while not self.stopEvent.is_set():
+                try:
+                    self.queues[threadId].put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if self.stopEvent.is_set() or not result[0]:
+                return
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        try:
+            for i in range(len(self.jobs)):
+                success, result = self.queues[i % self.numThreads].get()
+                if not success:
+                    raise result
+                yield result
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the worker threads (the remaining jobs are dropped) and wait for them to finish their current job
+        """
+        self.stopEvent.set()
+        for thread in self.threads:
+            thread.join()
 
 
 class TextData:
     """Dataset class
-    Warning: No vocabulary limit
+    The vocabulary can be limited with --vocabularySize and --minCount (the other words are replaced by <unknown>)
     """
 
-    def __init__(self, args):
+    # Samples directory of each nutrition dataset variant => option used to create it
+    NUTRITION_VARIANTS = collections.OrderedDict([
+        ('food-descrip', 'encode_food_descrips'),
+        ('single-food-descrip', 'encode_single_food_descrip'),
+        ('food-id', 'encode_food_ids'),
+        ('meal', None),
+    ])
+    NUTRITION_CORPUS_DIR = '/usr/users/zcollins/Data_Files/allfood/'
+    NUTRITION_MAX_LENGTH = 100  # Sentence length of the nutrition datasets
+
+    def __init__(self, args, mealData=None, sentenceTokens=None, vocabulary=None, decoderVocabulary=None):
         """Load all conversations
         Args:
             args: parameters of the model
+            mealData (MealData): the nutrition corpus, if already loaded
+            sentenceTokens (dict<str, list<list<str>>>): the tokens of the corpus texts, if already tokenized
+            vocabulary (list<str>): if given, only this vocabulary is loaded (no samples), which is enough to encode
+                the questions and decode the answers (ex: with an exported model)
+            decoderVocabulary (list<str>): the words of the decoder vocabulary (with --decoderVocab), given with
+                vocabulary
         """
         # Model parameters
         self.args = args
+        self.mealData = mealData
+        self.sharedSentenceTokens = sentenceTokens
 
         # Path variables
         if self.args.corpus == 'cornell':
             self.corpusDir = os.path.join(self.args.rootDir, 'data/cornell/')
-        if self.args.all_data:
-            self.samplesDir = os.path.join(self.args.rootDir, 'data/samples_allData/')
-        else:
-            self.samplesDir = os.path.join(self.args.rootDir, 'data/samples/')
-        if self.args.corpus == 'nutrition':
-            self.corpusDir = '/usr/users/zcollins/Data_Files/allfood/'
-            if self.args.encode_food_descrips:
-                self.samplesDir += 'food-descrip'
-            elif self.args.encode_single_food_descrip:
-                self.samplesDir += 'single-food-descrip'
-            elif self.args.encode_food_ids:
-                self.samplesDir += 'food-id'
-            else:
-                self.samplesDir += 'meal'
-
-            if self.args.match_encoder_decoder_input:
-                self.samplesDir += '-match-decoder'
-
-            self.samplesDir += '/'
+        elif self.args.corpus == 'nutrition':
+            self.corpusDir = self.NUTRITION_CORPUS_DIR
         elif self.args.corpus == 'healthy-comments':
             self.corpusDir = '/usr/users/korpusik/nutrition/Talia_data/'
-            self.samplesDir += 'healthy-comments'
-
-            if self.args.motivate_only:
-                self.samplesDir += '-motivate'
-            elif self.args.advice_only:
-                self.samplesDir += '-advice'
-
-            if self.args.healthy_flag:
-                self.samplesDir += '-flag'
-            elif self.args.encode_food_ids:
-                self.samplesDir += '-foodID'
-            elif self.args.food_context:
-                self.samplesDir += '-context'
-
-            if self.args.augment:
-                self.samplesDir += '-augment'
-            
+        self.samplesDir = self._constructSamplesDir(self.args)
         self.samplesName = self._constructName()
         print(self.samplesDir, self.samplesName)
 
@@ -107,18 +198,134 @@ class TextData:
         self.unknownToken = -1  # Word dropped from vocabulary
 
         self.trainingSamples = []  # 2d array containing each question and his answer [[input,target]]
+        self.sampleLabels = None  # Healthy (1) or unhealthy (0) label of each sample (healthy-comments only)
+        self.sampleIds = None  # Samples used for training (all if None), see makeLighter
+        self.sentenceTokens = None  # Pre-tokenized texts (dict<str, list<list<str>>>), when extracted in parallel
+        self.textCache = collections.OrderedDict()  # Word ids of the last extracted texts (LRU), shared by the samples
+        self.textCacheHits = 0
+        self.textCacheMisses = 0
+        self.responseWords = None  # Tokens of the responses (healthy-comments only)
+        self.responseWordsFile = None
 
         self.word2id = {}
         self.id2word = {}  # For a rapid conversion
 
-        self.loadCorpus(self.samplesDir)
+        # Restricted vocabulary of the decoder (--decoderVocab), the decoder inputs/outputs use its own ids
+        self.decoderWordIds = None  # Word id of each decoder id
+        self.decoderIds = None  # Decoder id of each word id (the words never decoded are <unknown>)
+
+        self.buckets = self._constructBuckets()  # [(maxLengthEnco, maxLengthDeco)], sorted by size
+        self.bucketIds = None  # Bucket of each training sample (see _getBucketIds)
+
+        if vocabulary is not None:
+            self.setVocabulary(vocabulary)
+        else:
+            self.loadCorpus(self.samplesDir)
+
+        if self.args.decoderVocab:
+            if decoderVocabulary is not None:
+                self.setDecoderVocabulary([self.word2id[word] for word in decoderVocabulary])
+            else:
+                self.buildDecoderVocabulary()
 
         # Plot some stats:
         print('Loaded: {} words, {} QA'.format(len(self.word2id), len(self.trainingSamples)))
+        if self.decoderWordIds is not None:
+            print('Decoder vocabulary: {} words'.format(len(self.decoderWordIds)))
 
         if self.args.playDataset:
             self.playDataset()
 
+    @classmethod
+    def createNutritionVariants(cls, args):
+        """Create the datasets of all the given nutrition variants (--nutritionVariants) in one pass: the corpus is
+        only loaded and tokenized once
+        Args:
+            args: parameters of the model
+        """
+        variants = []
+        for variant in args.nutritionVariants:
+            matchDecoder = variant.endswith('-match-decoder')
+            name = variant[:-len('-match-decoder')] if matchDecoder else variant
+            if name not in cls.NUTRITION_VARIANTS:
+                raise ValueError('Unknown nutrition variant {}, should be one of {} (optionally with -match-decoder)'.format(variant, list(cls.NUTRITION_VARIANTS)))
+            variants.append((variant, name, matchDecoder))
+
+        mealData = MealData(cls.NUTRITION_CORPUS_DIR, args.numWorkers, os.path.join(args.rootDir, 'data/samples/'))
+
+        texts = list(mealData.getMeals())
+        if any(name == 'food-descrip' for _, name, _ in variants):
+            texts.extend(itertools.chain.from_iterable(mealData.getFoodDescrips()))
+        if any(name == 'single-food-descrip' for _, name, _ in variants):
+            texts.extend(mealData.getSingleFoodDescrips())
+            texts.extend(mealData.getAlignments())
+        sentenceTokens = tokenizeTexts(texts, args.numWorkers)
+
+        datasets = {}  # The -match-decoder variants have the same samples (only the decoder inputs change)
+        for variant, name, matchDecoder in variants:
+            print('Nutrition variant: {}'.format(variant))
+            variantArgs = copy.copy(args)
+            variantArgs.corpus = 'nutrition'
+            variantArgs.maxLength = cls.NUTRITION_MAX_LENGTH  # Same dataset name as the one loaded with --corpus nutrition
+            for option in cls.NUTRITION_VARIANTS.values():
+                if option:
+                    setattr(variantArgs, option, 0)
+            if cls.NUTRITION_VARIANTS[name]:
+                setattr(variantArgs, cls.NUTRITION_VARIANTS[name], 1)
+            variantArgs.match_encoder_decoder_input = int(matchDecoder)
+
+            samplesDir = cls._constructSamplesDir(variantArgs)
+            if name in datasets and not mappedDatasetExists(os.path.join(samplesDir, datasets[name].samplesName)):
+                print('Saving the samples of {} to {}...'.format(datasets[name].samplesDir, samplesDir))
+                datasets[name].saveDataset(samplesDir)
+            else:
+                datasets[name] = cls(variantArgs, mealData, sentenceTokens)
+
+    @classmethod
+    def _constructSamplesDir(cls, args):
+        """Return the directory of the datasets created with the given corpus options
+        Args:
+            args: parameters of the model
+        Return:
+            str: the samples directory
+        """
+        if args.all_data:
+            samplesDir = os.path.join(args.rootDir, 'data/samples_allData/')
+        else:
+            samplesDir = os.path.join(args.rootDir, 'data/samples/')
+        if args.corpus == 'nutrition':
+            if args.encode_food_descrips:
+                samplesDir += 'food-descrip'
+            elif args.encode_single_food_descrip:
+                samplesDir += 'single-food-descrip'
+            elif args.encode_food_ids:
+                samplesDir += 'food-id'
+            else:
+                samplesDir += 'meal'
+
+            if args.match_encoder_decoder_input:
+                samplesDir += '-match-decoder'
+
+            samplesDir += '/'
+        elif args.corpus == 'healthy-comments':
+            samplesDir += 'healthy-comments'
+
+            if args.motivate_only:
+                samplesDir += '-motivate'
+            elif args.advice_only:
+                samplesDir += '-advice'
+
+            if args.healthy_flag:
+                samplesDir += '-flag'
+            elif args.encode_food_ids:
+                samplesDir += '-foodID'
+            elif args.food_context:
+                samplesDir += '-context'
+
+            if args.augment:
+                samplesDir += '-augment'
+        return samplesDir
+
     def _constructName(self):
         """Return the name of the dataset that the program should use with the current parameters.
         Computer from the base name, the given tag (self.args.datasetTag) and the sentence length
@@ -126,100 +333,161 @@ class TextData:
         baseName = 'dataset'
         if self.args.datasetTag:
             baseName += '-' + self.args.datasetTag
-        return baseName + '-' + str(self.args.maxLength) + '.pkl'
+        baseName += '-' + str(self.args.maxLength)
+        if self.args.vocabularySize:
+            baseName += '-vocab' + str(self.args.vocabularySize)
+        if self.args.minCount > 1:
+            baseName += '-min' + str(self.args.minCount)
+        return baseName
+
+    def _constructBuckets(self):
+        """Return the encoder and decoder lengths of each bucket. The samples are padded to the length of the smallest
+        bucket they fit into. The last bucket always correspond to the maximum sentence length.
+        Return:
+            list<(int, int)>: the (encoder length, decoder length) of each bucket
+        """
+        lengths = sorted(set(length for length in (self.args.buckets or []) if 0 < length < self.args.maxLength))
+        lengths.append(self.args.maxLength)
+        return [(length, length + 2) for length in lengths]  # Same offset as maxLengthEnco/maxLengthDeco
+
+    def getBuckets(self):
+        """Return the bucket sizes
+        Return:
+            list<(int, int)>: the (encoder length, decoder length) of each bucket
+        """
+        return self.buckets
+
+    def _getBucketIds(self):
+        """Return the smallest bucket each training sample fit into (computed once, from the offsets of the sequences
+        with the memory mapped samples)
+        Return:
+            np.array: the bucket id of each sample
+        """
+        if self.bucketIds is None:
+            if isinstance(self.trainingSamples, MappedSamples):
+                lengths = np.maximum(np.diff(self.trainingSamples.inputOffsets), np.diff(self.trainingSamples.targetOffsets))
+            else:
+                lengths = np.fromiter(
+                    (max(len(sample[0]), len(sample[1])) for sample in self.trainingSamples),
+                    dtype=np.int64,
+                    count=len(self.trainingSamples)
+                )
+            encoLengths = [encoLength for encoLength, _ in self.buckets]
+            # The last bucket for the too long samples (should not happen, long sentences have been filtered)
+            self.bucketIds = np.minimum(np.searchsorted(encoLengths, lengths), len(self.buckets) - 1)
+        return self.bucketIds
 
     def makeLighter(self, ratioDataset):
         """Only keep a small fraction of the dataset, given by the ratio
+        The samples are not copied, only their ids are kept. The subsample only depends on the seed (--seed) and is
+        stratified by label when the samples have one (same healthy/unhealthy proportions than the full dataset)
+        Args:
+            ratioDataset (float): fraction of the samples to keep
         """
-        #if not math.isclose(ratioDataset, 1.0):
-        #    self.shuffle()  # Really ?
-        #    print('WARNING: Ratio feature not implemented !!!')
-        pass
+        if math.isclose(ratioDataset, 1.0):
+            self.sampleIds = None
+            return
+
+        rng = np.random.RandomState(self.args.seed if self.args.seed is not None else 0)
+        nbSamples = len(self.trainingSamples)
+        if self.sampleLabels is not None:
+            labels = np.asarray(self.sampleLabels)
+            groups = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+        else:
+            groups = [np.arange(nbSamples)]
+
+        sampleIds = []
+        for group in groups:
+            nbKept = max(1, int(round(ratioDataset * len(group))))
+            sampleIds.append(rng.choice(group, size=min(nbKept, len(group)), replace=False))
+        self.sampleIds = np.sort(np.concatenate(sampleIds))
+        print('Dataset reduced: {} samples kept over {}'.format(len(self.sampleIds), nbSamples))
 
     def shuffle(self):
-        """Shuffle the training samples
+        """Shuffle the order of the training samples (the samples themselves are not moved, they can be memory mapped)
         """
         print("Shuffling the dataset...")
-        random.shuffle(self.trainingSamples)
+        if self.sampleIds is None:
+            self.sampleIds = np.arange(len(self.trainingSamples))
+        np.random.shuffle(self.sampleIds)
 
-    def _createBatch(self, samples):
+    def _createBatch(self, samples, bucketId=None):
         """Create a single batch from the list of sample. The batch size is automatically defined by the number of
         samples given.
         The inputs should already be inverted. The target should already have <go> and <eos>
         Warning: This function should not make direct calls to args.batchSize !!!
         Args:
             samples (list<Obj>): a list of samples, each sample being on the form [input, target]
+            bucketId (int): the bucket the samples fit into, define the padding length (the largest one if None)
         Return:
             Batch: a batch object en
         """
 
         batch = Batch()
+        batch.bucketId = bucketId
         batchSize = len(samples)
+        if bucketId is None:
+            maxLengthEnco, maxLengthDeco = self.args.maxLengthEnco, self.args.maxLengthDeco
+        else:
+            maxLengthEnco, maxLengthDeco = self.buckets[bucketId]
 
-        # Create the batch tensor
-        for i in range(batchSize):
-            # Unpack the sample
-            sample = samples[i]
-            if not self.args.test and self.args.watsonMode:  # Watson mode: invert question and answer
-                sample = list(reversed(sample))
-            batch.encoderSeqs.append(list(reversed(sample[0])))  # Reverse inputs (and not outputs), little trick as defined on the original seq2seq paper
-            target_seq_with_go = [self.goToken] + sample[1] + [self.eosToken]
-            if self.args.match_encoder_decoder_input:
-                # use encoder input as decoder input
-                batch.decoderSeqs.append([self.goToken] + sample[0] + [self.eosToken])
-            else:
-                batch.decoderSeqs.append(target_seq_with_go)  # Add the <go> and <eos> tokens
-            if self.args.food_context:
-                if self.args.first_step:
-                    batch.contextSeqs.append([sample[2]]+[np.zeros(64,)]*(self.args.maxLengthDeco - 1)) # add food embedding context
-                else:
-                    batch.contextSeqs.append([sample[2]]*self.args.maxLengthDeco) # add food embedding context
-            batch.targetSeqs.append(target_seq_with_go[1:])  # target seq, but shifted to the left (ignore the <go>)
-
-            # Long sentences should have been filtered during the dataset creation
-            assert len(batch.encoderSeqs[i]) <= self.args.maxLengthEnco
-            assert len(batch.decoderSeqs[i]) <= self.args.maxLengthDeco
-
-            # Add padding & define weight
-            batch.encoderSeqs[i]   = [self.padToken] * (self.args.maxLengthEnco  - len(batch.encoderSeqs[i])) + batch.encoderSeqs[i]  # Left padding for the input
-            batch.weights.append([1.0] * len(batch.targetSeqs[i]) + [0.0] * (self.args.maxLengthDeco - len(batch.targetSeqs[i])))
-            batch.decoderSeqs[i] = batch.decoderSeqs[i] + [self.padToken] * (self.args.maxLengthDeco - len(batch.decoderSeqs[i]))
-            batch.targetSeqs[i]  = batch.targetSeqs[i]  + [self.padToken] * (self.args.maxLengthDeco - len(batch.targetSeqs[i]))
-
-        # Simple hack to reshape the batch
-        encoderSeqsT = []  # Corrected orientation
-        for i in range(self.args.maxLengthEnco):
-            encoderSeqT = []
-            for j in range(batchSize):
-                encoderSeqT.append(batch.encoderSeqs[j][i])
-            encoderSeqsT.append(encoderSeqT)
-        batch.encoderSeqs = encoderSeqsT
-
-        decoderSeqsT = []
-        targetSeqsT = []
-        weightsT = []
-        contextSeqsT = []
-        for i in range(self.args.maxLengthDeco):
-            decoderSeqT = []
-            targetSeqT = []
-            weightT = []
-            contextSeqT = []
-            for j in range(batchSize):
-                decoderSeqT.append(batch.decoderSeqs[j][i])
-                targetSeqT.append(batch.targetSeqs[j][i])
-                weightT.append(batch.weights[j][i])
-                if self.args.food_context:
-                    contextSeqT.append(batch.contextSeqs[j][i])
-                else:
-                    contextSeqT.append(np.zeros(64,))
-            decoderSeqsT.append(decoderSeqT)
-            targetSeqsT.append(targetSeqT)
-            weightsT.append(weightT)
-            contextSeqsT.append(contextSeqT)
-        batch.decoderSeqs = decoderSeqsT
-        batch.targetSeqs = targetSeqsT
-        batch.weights = weightsT
-        batch.contextSeqs = contextSeqsT
+        if not self.args.test and self.args.watsonMode:  # Watson mode: invert question and answer
+            samples = [list(reversed(sample)) for sample in samples]
+
+        inputSeqs = [sample[0] for sample in samples]
+        targetSeqs = [sample[1] for sample in samples]
+        if self.args.match_encoder_decoder_input:  # Use encoder input as decoder input
+            decoderSeqs = inputSeqs
+        else:
+            decoderSeqs = targetSeqs
+
+        # Long sentences should have been filtered during the dataset creation
+        inputLengths, inputWords, inputPos, inputCols = self._flattenSeqs(inputSeqs)
+        targetLengths, targetWords, targetPos, targetCols = self._flattenSeqs(targetSeqs)
+        assert np.all(inputLengths <= maxLengthEnco)
+        assert np.all(targetLengths + 2 <= maxLengthDeco)
+        if decoderSeqs is targetSeqs:
+            decoderLengths, decoderWords, decoderPos, decoderCols = targetLengths, targetWords, targetPos, targetCols
+        else:
+            decoderLengths, decoderWords, decoderPos, decoderCols = self._flattenSeqs(decoderSeqs)
+            assert np.all(decoderLengths + 2 <= maxLengthDeco)
+        batchIds = np.arange(batchSize)
+
+        # Encoder: reverse inputs (and not outputs), little trick as defined on the original seq2seq paper, and left
+        # padding (the last word of the sentence is always on the last step)
+        # The dynamic encoder only runs the valid steps of each input so the padding goes to the right instead, up to
+        # the longest input of the batch
+        batch.encoderLengths = inputLengths.astype(np.int32)
+        if self.args.dynamicEncoder:
+            maxLengthEnco = max(1, int(inputLengths.max()))
+            batch.encoderSeqs = np.full((maxLengthEnco, batchSize), self.padToken, dtype=np.int32)
+            batch.encoderSeqs[inputLengths[inputCols] - 1 - inputPos, inputCols] = inputWords
+        else:
+            batch.encoderSeqs = np.full((maxLengthEnco, batchSize), self.padToken, dtype=np.int32)
+            batch.encoderSeqs[maxLengthEnco - 1 - inputPos, inputCols] = inputWords
+
+        # Decoder: add the <go> and <eos> tokens
+        batch.decoderSeqs = np.full((maxLengthDeco, batchSize), self.padToken, dtype=np.int32)
+        batch.decoderSeqs[0, :] = self.goToken
+        batch.decoderSeqs[decoderPos + 1, decoderCols] = decoderWords
+        batch.decoderSeqs[decoderLengths + 1, batchIds] = self.eosToken
+
+        # Target: same as the decoder but shifted to the left (ignore the <go>)
+        batch.targetSeqs = np.full((maxLengthDeco, batchSize), self.padToken, dtype=np.int32)
+        batch.targetSeqs[targetPos, targetCols] = targetWords
+        batch.targetSeqs[targetLengths, batchIds] = self.eosToken
+
+        # Weights: only the words of the target and the <eos> token count
+        batch.weights = (np.arange(maxLengthDeco)[:, None] <= targetLengths[None, :]).astype(np.float32)
+
+        # The decoder has its own vocabulary
+        if self.decoderIds is not None:
+            batch.decoderSeqs = self.decoderIds[batch.decoderSeqs]
+            batch.targetSeqs = self.decoderIds[batch.targetSeqs]
+
+        # Food embedding context (once per sample, broadcasted to each decoder step by the model)
+        if self.args.food_context:
+            batch.context = np.asarray([sample[2] for sample in samples], dtype=np.float32)
 
         # # Debug
         # self.printBatch(batch)  # Input inverted, padding should be correct
@@ -228,31 +496,82 @@ class TextData:
 
         return batch
 
+    @staticmethod
+    def _flattenSeqs(seqs):
+        """Concatenate a list of sequences into a flat array, keeping track of the position of each word, to allow
+        filling a time-major batch in a single fancy indexing operation
+        Args:
+            seqs (list<list<int>>): the sequences to flatten
+        Return:
+            np.array: the length of each sequence
+            np.array: the concatenated words
+            np.array: the position of each word inside its sequence
+            np.array: the sequence (batch column) each word belong to
+        """
+        lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+        words = np.concatenate([np.asarray(seq, dtype=np.int32) for seq in seqs])  # Lists or mapped arrays
+        cols = np.repeat(np.arange(len(seqs)), lengths)
+        pos = np.arange(len(words)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return lengths, words, pos, cols
+
+    def getBatchesIds(self):
+        """Prepare the content of the batches for the current epoch, without creating them (so the batches can be
+        streamed during the epoch instead of having all of them in memory)
+        If multiple buckets are defined, the samples are grouped by length and each batch only contains samples from
+        the same bucket (the samples are shuffled within the buckets and the batches are shuffled between them)
+        Return:
+            list<(int, list<int>)>: the bucket and the sample ids of each batch for the next epoch
+        """
+        if self.sampleIds is not None:
+            sampleIds = self.sampleIds.tolist()
+        else:
+            sampleIds = list(range(len(self.trainingSamples)))
+        random.shuffle(sampleIds)
+
+        # Group the samples by bucket (keeping the shuffled order inside each bucket)
+        if len(self.buckets) == 1:
+            bucketSampleIds = [sampleIds]
+        else:
+            sampleIds = np.asarray(sampleIds, dtype=np.int64)
+            sampleBucketIds = self._getBucketIds()[sampleIds]
+            sampleIds = sampleIds[np.argsort(sampleBucketIds, kind='stable')]
+            bucketSizes = np.bincount(sampleBucketIds, minlength=len(self.buckets))
+            bucketSampleIds = [ids.tolist() for ids in np.split(sampleIds, np.cumsum(bucketSizes)[:-1])]
+
+        batchesIds = []
+        for bucketId, ids in enumerate(bucketSampleIds):
+            for i in range(0, len(ids), self.args.batchSize):
+                batchesIds.append((bucketId, ids[i:i + self.args.batchSize]))
+
+        if len(self.buckets) > 1:
+            random.shuffle(batchesIds)  # Mix the buckets
+        return batchesIds
+
+    def getBatch(self, batchIds):
+        """Create the batch containing the given samples
+        Args:
+            batchIds ((int, list<int>)): the bucket and the sample ids of the batch (as returned by getBatchesIds)
+        Return:
+            Batch: the batch
+        """
+        bucketId, sampleIds = batchIds
+        return self._createBatch([self.trainingSamples[i] for i in sampleIds], bucketId)
+
     def getBatches(self):
         """Prepare the batches for the current epoch
+        Warning: All the batches are created at once, use getBatchesIds/getBatch to stream them
         Return:
             list<Batch>: Get a list of the batches for the next epoch
         """
-        self.shuffle()
-
-        batches = []
-
-        def genNextSamples():
-            """ Generator over the mini-batch training samples
-            """
-            for i in range(0, self.getSampleSize(), self.args.batchSize):
-                yield self.trainingSamples[i:min(i + self.args.batchSize, self.getSampleSize())]
-
-        for samples in genNextSamples():
-            batch = self._createBatch(samples)
-            batches.append(batch)
-        return batches
+        return [self.getBatch(batchIds) for batchIds in self.getBatchesIds()]
 
     def getSampleSize(self):
         """Return the size of the dataset
         Return:
             int: Number of training samples
         """
+        if self.sampleIds is not None:
+            return len(self.sampleIds)
         return len(self.trainingSamples)
 
     def getVocabularySize(self):
@@ -262,23 +581,95 @@ class TextData:
         """
         return len(self.word2id)
 
+    def getDecoderVocabularySize(self):
+        """Return the number of words the decoder can use (the full vocabulary without --decoderVocab)
+        Return:
+            int: Number of words of the decoder vocabulary
+        """
+        if self.decoderWordIds is not None:
+            return len(self.decoderWordIds)
+        return self.getVocabularySize()
+
+    def getDecoderVocabulary(self):
+        """Return the words of the decoder vocabulary, in the order of the decoder ids
+        Return:
+            list<str>: the word of each decoder id (None without --decoderVocab)
+        """
+        if self.decoderWordIds is None:
+            return None
+        return [self.id2word[int(wordId)] for wordId in self.decoderWordIds]
+
+    def buildDecoderVocabulary(self):
+        """Restrict the decoder vocabulary to the words it is fed with: the words of the targets (and of the inputs
+        when they are also given to the decoder). Its ids follow the vocabulary order, the special tokens first
+        """
+        columns = [1]
+        if self.args.watsonMode or self.args.match_encoder_decoder_input:
+            columns.append(0)
+        if isinstance(self.trainingSamples, MappedSamples):  # No need to read the samples one by one
+            arrays = [self.trainingSamples.targets if column == 1 else self.trainingSamples.inputs for column in columns]
+        else:
+            arrays = [
+                np.fromiter(itertools.chain.from_iterable(sample[column] for sample in self.trainingSamples), dtype=np.int64)
+                for column in columns
+            ]
+        specialTokens = [self.padToken, self.goToken, self.eosToken, self.unknownToken]
+        words = np.unique(np.concatenate([np.asarray(array, dtype=np.int64) for array in arrays]))
+        words = words[~np.isin(words, specialTokens)]
+        self.setDecoderVocabulary(specialTokens + words.tolist())
+
+    def setDecoderVocabulary(self, wordIds):
+        """Set the decoder vocabulary
+        Args:
+            wordIds (list<int>): the word id of each decoder id (should contain the special tokens)
+        """
+        self.decoderWordIds = np.asarray(wordIds, dtype=np.int32)
+        self.decoderIds = np.full(len(self.word2id), wordIds.index(self.unknownToken), dtype=np.int32)
+        self.decoderIds[self.decoderWordIds] = np.arange(len(wordIds), dtype=np.int32)
+
+    def toDecoderIds(self, wordIds):
+        """Convert word ids to decoder ids (no change without --decoderVocab)
+        """
+        if self.decoderIds is not None:
+            return self.decoderIds[wordIds]
+        return wordIds
+
+    def fromDecoderIds(self, decoderIds):
+        """Convert decoder ids (ex: the outputs of the model) to word ids (no change without --decoderVocab)
+        """
+        if self.decoderWordIds is not None:
+            return self.decoderWordIds[decoderIds]
+        return decoderIds
+
     def loadCorpus(self, dirName):
         """Load/create the conversations data
         Args:
             dirName (str): The directory where to load/save the model
         """
-        datasetExist = False
-        if os.path.exists(os.path.join(dirName, self.samplesName)):
-            datasetExist = True
-
-        if not datasetExist:  # First time we load the database: creating all files
+        datasetName = os.path.join(dirName, self.samplesName)
+
+        if mappedDatasetExists(datasetName) or os.path.exists(datasetName + '.pkl'):
+            if mappedDatasetExists(datasetName):
+                print('Loading dataset from {}...'.format(datasetName))
+                self.loadDataset(dirName)
+            else:  # Old format: converted once
+                print('Loading dataset from {}.pkl...'.format(datasetName))
+                self.loadPickleDataset(datasetName + '.pkl')
+                print('Converting dataset to binary format...')
+                self.saveDataset(dirName)
+            if self.args.finetune and not self.args.test:
+                self.trainingSamples = []
+                self.sampleLabels = None
+                mealData = MealData(self.NUTRITION_CORPUS_DIR, self.args.numWorkers, os.path.join(self.args.rootDir, 'data/samples/'))
+                self.createCorpus(mealData.getMeals())
+        else:  # First time we load the database: creating all files
             print('Training samples not found. Creating dataset...')
             # Corpus creation
             if self.args.corpus == 'cornell':
                 cornellData = CornellData(self.corpusDir)
                 self.createCorpus(cornellData.getConversations())
             elif self.args.corpus == 'nutrition':
-                mealData = MealData(self.corpusDir)
+                mealData = self.mealData or MealData(self.corpusDir, self.args.numWorkers, os.path.join(self.args.rootDir, 'data/samples/'))
         
                 if self.args.encode_food_descrips:
                     self.createCorpus(zip(mealData.getFoodDescrips(), mealData.getMeals()))
@@ -289,56 +680,100 @@ class TextData:
                 else:
                     self.createCorpus(mealData.getMeals())
             elif self.args.corpus == 'healthy-comments':
-                self.healthyData = HealthyData(self.corpusDir, self.args.usda_vecs, self.args.healthy_flag, self.args.augment, self.args.motivate_only, self.args.advice_only, self.args.all_data)
+                self.healthyData = HealthyData(self.corpusDir, self.args.usda_vecs, self.args.healthy_flag, self.args.augment, self.args.motivate_only, self.args.advice_only, self.args.all_data, os.path.join(self.args.rootDir, 'data/samples/amt-table.npz'))
+                self.responseWords = self.healthyData.getWords()
                 if self.args.encode_food_ids:
                     self.createCorpus(zip(self.healthyData.getFoodIDs(), self.healthyData.getResponses()))
                 else:
-                    self.createCorpus(zip(self.healthyData.getMeals(), self.healthyData.getResponses(), self.healthyData.getFoodEmb()))
+                    self.sampleLabels = []
+                    self.createCorpus(zip(self.healthyData.getMeals(), self.healthyData.getResponses(), self.healthyData.getFoodEmb(), self.healthyData.getLabels()))
+
+            self.filterVocabulary()
 
             # Saving
             print('Saving dataset...')
             self.saveDataset(dirName)  # Saving tf samples
-        else:
-            print('Loading dataset from {}...'.format(dirName))
-            self.loadDataset(dirName)
-            if self.args.finetune and not self.args.test:
-                self.trainingSamples = []
-                mealData = MealData('/usr/users/zcollins/Data_Files/allfood/')
-                self.createCorpus(mealData.getMeals())
 
         assert self.padToken == 0
 
     def saveDataset(self, dirName):
-        """Save samples to file
+        """Save samples to file (binary format, see mappeddata.py)
         Args:
             dirName (str): The directory where to load/save the model
         """
-
-        with open(os.path.join(dirName, self.samplesName), 'wb') as handle:
-            data = {  # Warning: If adding something here, also modifying loadDataset
-                "word2id": self.word2id,
-                "id2word": self.id2word,
-                "trainingSamples": self.trainingSamples,
-                "responseWords": self.healthyData.getWords()
-                }
-            pickle.dump(data, handle, -1)  # Using the highest protocol available
+        saveMappedDataset(
+            os.path.join(dirName, self.samplesName),
+            self.id2word,
+            self.trainingSamples,
+            self.getResponseWords(),
+            self.sampleLabels
+        )
+        if self.getResponseWords() is not None:
+            self.getBigramModel()  # Built once with the dataset
 
     def loadDataset(self, dirName):
-        """Load samples from file
+        """Load samples from file. The samples are memory mapped and only read when used
         Args:
             dirName (str): The directory where to load the model
         """
-        with open(os.path.join(dirName, self.samplesName), 'rb') as handle:
-            data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
+        words, self.trainingSamples, self.responseWordsFile, self.sampleLabels = loadMappedDataset(os.path.join(dirName, self.samplesName))
+        self.responseWords = None  # Loaded only if needed
+        self.setVocabulary(words)
+
+    def setVocabulary(self, words):
+        """Replace the vocabulary
+        Args:
+            words (list<str>): the word of each id (containing the special tokens)
+        """
+        self.id2word = dict(enumerate(words))
+        self.word2id = {word: wordId for wordId, word in enumerate(words)}
+        self._restoreSpecialTokens()
+
+    def loadPickleDataset(self, fileName):
+        """Load samples from the previous (pickle) dataset format
+        Args:
+            fileName (str): The pickle file
+        """
+        with open(fileName, 'rb') as handle:
+            data = pickle.load(handle)
             self.word2id = data["word2id"]
             self.id2word = data["id2word"]
             self.trainingSamples = data["trainingSamples"]
-            self.responseWords = data["responseWords"]
+            self.responseWords = data.get("responseWords")
+        self._restoreSpecialTokens()
+
+    def _restoreSpecialTokens(self):
+        """Restore the special word ids after loading the vocabulary
+        """
+        self.padToken = self.word2id["<pad>"]
+        self.goToken = self.word2id["<go>"]
+        self.eosToken = self.word2id["<eos>"]
+        self.unknownToken = self.word2id["<unknown>"]  # Restore special words
+
+    def getResponseWords(self):
+        """Return the tokens of all responses (used for the MMI language model), loaded from the disk the first time
+        Return:
+            list<str>: the tokens (None if the corpus has no responses)
+        """
+        if self.responseWords is None and self.responseWordsFile:
+            self.responseWords = loadResponseWords(self.responseWordsFile)
+        return self.responseWords
 
-            self.padToken = self.word2id["<pad>"]
-            self.goToken = self.word2id["<go>"]
-            self.eosToken = self.word2id["<eos>"]
-            self.unknownToken = self.word2id["<unknown>"]  # Restore special words
+    def getBigramModel(self):
+        """Return the bigram language model of the responses (used for MMI), built from the response tokens and saved
+        with the dataset the first time
+        Return:
+            BigramModel: the model (None if the corpus has no responses)
+        """
+        fileName = os.path.join(self.samplesDir, self.samplesName, 'bigrams.npz')
+        if os.path.exists(fileName):
+            return BigramModel.load(fileName)
+        if self.getResponseWords() is None:
+            return None
+        print('Building the bigram model...')
+        model = BigramModel.fromTokens(self.getResponseWords(), self.word2id)
+        model.save(fileName)
+        return model
 
     def createCorpus(self, conversations):
         """Extract all data from the given vocabulary
@@ -350,23 +785,111 @@ class TextData:
         self.unknownToken = self.getWordId("<unknown>")  # Word dropped from vocabulary
 
         # Preprocessing data
+        self.sentenceTokens = self.sharedSentenceTokens
+        if self.sentenceTokens is None and self.args.numWorkers > 1:
+            conversations = list(conversations)  # Iterated twice
+            self.sentenceTokens = self.tokenizeCorpus(conversations)
 
-        
+        # The ids are always assigned on the main process, following the corpus order, so the vocabulary and the
+        # samples are the same whatever the number of workers
         for conversation in tqdm(conversations, desc="Extract conversations"):
             if self.args.corpus == 'cornell':
                 self.extractConversation(conversation)
             elif self.args.encode_food_descrips or self.args.encode_food_ids:
                 self.extractFoods(conversation[0], conversation[1])
             elif self.args.corpus == 'healthy-comments' and not self.args.finetune:
-                self.extractHealthyComments(conversation[0], conversation[1], conversation[2])
+                self.extractHealthyComments(conversation[0], conversation[1], conversation[2], conversation[3])
             elif self.args.encode_single_food_descrip:
                 self.extractFoods([conversation[0]], conversation[1])
             else:
                 # encode and decode meals
                 self.extractMeal(conversation)
 
+        self.sentenceTokens = None
+        if self.textCacheHits or self.textCacheMisses:
+            print('Text cache: {} hits, {} misses'.format(self.textCacheHits, self.textCacheMisses))
+        self.textCache.clear()
+        self.textCacheHits = 0
+        self.textCacheMisses = 0
+
         # The dataset will be saved in the same order it has been extracted
 
+    def filterVocabulary(self):
+        """Only keep the most frequent words of the extracted samples (--vocabularySize, --minCount), the other ones
+        are replaced by <unknown>. The kept words are renumbered in order, so the ids stay contiguous
+        """
+        if not self.args.vocabularySize and self.args.minCount <= 1:
+            return
+
+        # Count the words over all samples (not only the unique texts)
+        counts = np.zeros(len(self.word2id), dtype=np.int64)
+        for sample in self.trainingSamples:
+            np.add.at(counts, np.asarray(sample[0], dtype=np.int64), 1)
+            np.add.at(counts, np.asarray(sample[1], dtype=np.int64), 1)
+
+        specialTokens = [self.padToken, self.goToken, self.eosToken, self.unknownToken]
+        keep = counts >= self.args.minCount
+        keep[specialTokens] = False
+        if self.args.vocabularySize:
+            nbWords = max(self.args.vocabularySize - len(specialTokens), 0)
+            candidates = np.flatnonzero(keep)
+            if len(candidates) > nbWords:
+                order = np.argsort(-counts[candidates], kind='mergesort')  # Stable: ties keep the extraction order
+                keep[:] = False
+                keep[candidates[order[:nbWords]]] = True
+        keep[specialTokens] = True
+
+        # Mapping old id => new id
+        oldIds = np.flatnonzero(keep)  # Special tokens first (ids 0 to 3)
+        newIds = np.full(len(self.word2id), self.unknownToken, dtype=np.int64)
+        newIds[oldIds] = np.arange(len(oldIds))
+        print('Vocabulary filtered: {} words kept over {}'.format(len(oldIds), len(self.word2id)))
+
+        self.id2word = {newId: self.id2word[int(oldId)] for newId, oldId in enumerate(oldIds)}
+        self.word2id = {word: wordId for wordId, word in self.id2word.items()}
+
+        remapped = {}  # The samples can share the same lists (see extractText)
+        def remap(words):
+            key = id(words)
+            if key not in remapped:  # The original list is kept in the dict, so its id is not reused
+                remapped[key] = (words, [int(wordId) for wordId in newIds[np.asarray(words, dtype=np.int64)]])
+            return remapped[key][1]
+        for sample in self.trainingSamples:
+            sample[0] = remap(sample[0])
+            sample[1] = remap(sample[1])
+
+    def tokenizeCorpus(self, conversations):
+        """Tokenize all the texts of the corpus on a pool of worker processes
+        Args:
+            conversations (list<Obj>): the conversations given to createCorpus
+        Return:
+            dict<str, list<list<str>>>: the sentence tokens of each text
+        """
+        texts = []
+        for conversation in conversations:
+            texts.extend(self._conversationTexts(conversation))
+        return tokenizeTexts(texts, self.args.numWorkers)
+
+    def _conversationTexts(self, conversation):
+        """Return the texts which will be tokenized when extracting the conversation (same cases as createCorpus)
+        Args:
+            conversation (Obj): a conversation given to createCorpus
+        Return:
+            list<str>: the texts
+        """
+        if self.args.corpus == 'cornell':
+            return [line["text"] for line in conversation["lines"]]
+        elif self.args.encode_food_descrips:
+            return list(conversation[0]) + [conversation[1]]
+        elif self.args.encode_food_ids:
+            return [conversation[1]]
+        elif self.args.corpus == 'healthy-comments' and not self.args.finetune:
+            return [conversation[0], conversation[1]]
+        elif self.args.encode_single_food_descrip:
+            return [conversation[0], conversation[1]]
+        else:
+            return [conversation]
+
     def extractConversation(self, conversation):
         """Extract the sample lines from the conversations
         Args:
@@ -395,17 +918,19 @@ class TextData:
         if inputWords and targetWords:  # Filter wrong samples (if one of the list is empty)
                 self.trainingSamples.append([inputWords, targetWords])
 
-    def extractHealthyComments(self, meal, response, foods):
+    def extractHealthyComments(self, meal, response, foods, label):
         """Extract the sample meal descriptions and healthy/unhealthy comments
         Args:
             meal (str): the meal description text
             response (str): the healthy/unhealthy commentary
+            label (int): 1 if the meal is healthy, 0 otherwise
         """
         inputWords  = self.extractText(meal)
         targetWords = self.extractText(response, True)
 
         if inputWords and targetWords:  # Filter wrong samples (if one of the list is empty)
                 self.trainingSamples.append([inputWords, targetWords, foods])
+                self.sampleLabels.append(label)
 
     def extractFoods(self, foods, meal):
         """Extract the sample's matching food descriptions
@@ -426,16 +951,40 @@ class TextData:
 
     def extractText(self, line, isTarget=False):
         """Extract the words from a sample lines
+        The texts are often repeated in the corpus (same meal for each response), so the result is cached and the
+        same list is returned for identical texts (the returned list should not be modified)
         Args:
             line (str): a line containing the text to extract
             isTarget (bool): Define the question on the answer
         Return:
             list<int>: the list of the word ids of the sentence
         """
+        key = (line, isTarget)
+        words = self.textCache.get(key)
+        if words is not None:
+            self.textCacheHits += 1
+            self.textCache.move_to_end(key)
+            return words
+        self.textCacheMisses += 1
+
+        words = self._extractText(line, isTarget)
+
+        if self.args.tokenCacheSize > 0:
+            self.textCache[key] = words
+            if len(self.textCache) > self.args.tokenCacheSize:
+                self.textCache.popitem(last=False)  # Remove the least recently used
+        return words
+
+    def _extractText(self, line, isTarget):
+        """Tokenize the line and convert it into word ids (see extractText)
+        """
         words = []
 
         # Extract sentences
-        sentencesToken = nltk.sent_tokenize(line)
+        if self.sentenceTokens is not None:
+            sentencesToken = self.sentenceTokens[line]  # Already tokenized by the workers
+        else:
+            sentencesToken = nltk.sent_tokenize(line)
 
         # We add sentence by sentence until we reach the maximum length
         for i in range(len(sentencesToken)):
@@ -444,7 +993,9 @@ class TextData:
             if not isTarget:
                 i = len(sentencesToken)-1 - i
 
-            tokens = nltk.word_tokenize(sentencesToken[i])
+            tokens = sentencesToken[i]
+            if self.sentenceTokens is None:
+                tokens = nltk.word_tokenize(tokens)
 
             # If the total length is not too big, we still can add one more sentence
             if len(words) + len(tokens) <= self.args.maxLength:
@@ -513,7 +1064,7 @@ class TextData:
             str: the sentence
         """
 
-        if not sequence:
+        if len(sequence) == 0:
             return ''
 
         if not clean:
@@ -552,6 +1103,35 @@ class TextData:
         Return:
             Batch: a batch object containing the sentence, or none if something went wrong
         """
+        sample = self._sentence2sample(sentence)
+        if sample is None:
+            return None
+        return self._createBatch([sample])  # Mono batch, no target output
+
+    def sentences2enco(self, sentences):
+        """Encode several sequences into a single batch, so the model answers all of them at once
+        Return:
+            Batch: a batch object containing the valid sentences, or none if there is none
+            list<int>: the position of each sentence in the batch (None if something went wrong with the sentence)
+        """
+        samples = []
+        positions = []
+        for sentence in sentences:
+            sample = self._sentence2sample(sentence)
+            if sample is None:
+                positions.append(None)
+            else:
+                positions.append(len(samples))
+                samples.append(sample)
+        if not samples:
+            return None, positions
+        return self._createBatch(samples), positions
+
+    def _sentence2sample(self, sentence):
+        """Convert a sentence into a sample (input without target)
+        Return:
+            list<Obj>: the sample, or none if the sentence is empty or too long
+        """
 
         if sentence == '':
             return None
@@ -566,8 +1146,7 @@ class TextData:
         for token in tokens:
             wordIds.append(self.getWordId(token, create=False))  # Create the vocabulary and the training sentences
 
-        # Third step: creating the batch (add padding, reverse)
-        sample = []
+        # Third step: creating the sample (the batch adds the padding and reverse)
         # predict foods, then sum food embeddings
         if self.args.food_context:
             #output_map = self.args.model.run_model([sentence])
@@ -576,11 +1155,8 @@ class TextData:
             foodIDs = json.loads(urllib.request.urlopen("http://128.30.34.150:5000/lana/api/v1.0/query_IDs?raw_text="+meal).read().decode('utf-8'))
             print('foods', foodIDs)
             embeddings = np.sum([self.args.usda_vecs[foodID] for foodID in foodIDs], axis=0)
-            batch = self._createBatch([[wordIds, [], embeddings]])
-        else:
-            batch = self._createBatch([[wordIds, []]])  # Mono batch, no target output
-
-        return batch
+            return [wordIds, [], embeddings]
+        return [wordIds, []]
 
     def deco2sentence(self, decoderOutputs):
         """Decode the output of the decoder and return a human friendly sentence
@@ -592,8 +1168,55 @@ class TextData:
         for out in decoderOutputs:
             sequence.append(np.argmax(out))  # Adding each predicted word ids
 
+        if self.decoderWordIds is not None:  # The outputs are decoder ids
+            sequence = self.fromDecoderIds(sequence).tolist()
         return sequence  # We return the raw sentence. Let the caller do some cleaning eventually
 
+    def beam2sequences(self, path, symbol, probs):
+        """Backtrack all the hypotheses of the beam search at once
+        Each hypothesis ends at the first <eos> of its beam column (the last step is never checked), or at the last step
+        Args:
+            path (np.array): [nbSteps, beamSize] position of the parent hypothesis at the previous step
+            symbol (np.array): [nbSteps, beamSize] word id (decoder id with --decoderVocab) chosen at each step
+            probs (np.array): [nbSteps, beamSize] log probability of each step
+        Return:
+            np.array: int32 [beamSize, nbSteps] word ids of each hypothesis (padded after its length)
+            np.array: int [beamSize] length of each hypothesis
+            np.array: [beamSize] total log probability of each hypothesis
+        """
+        path = np.asarray(path)
+        symbol = self.fromDecoderIds(np.asarray(symbol))
+        probs = np.asarray(probs)
+        nbSteps, beamSize = symbol.shape
+
+        isEos = symbol == self.eosToken
+        isEos[-1] = False
+        lastIds = np.where(isEos.any(axis=0), isEos.argmax(axis=0), nbSteps)
+        lengths = np.minimum(lastIds + 1, nbSteps)
+
+        sequences = np.full((beamSize, nbSteps), self.padToken, dtype=np.int32)
+        logProbs = np.zeros(beamSize, dtype=probs.dtype)
+        curr = np.arange(beamSize)
+        for i in range(nbSteps - 1, -1, -1):  # Follow the parents of the active hypotheses
+            active = i <= lastIds
+            sequences[active, i] = symbol[i, curr[active]]
+            logProbs[active] += probs[i, curr[active]]
+            curr = np.where(active, path[i, curr], curr)
+        return sequences, lengths, logProbs
+
+    def sequenceKey(self, sequence):
+        """Return the words of the sequence, as returned by sequence2str(clean=True), to compare sequences
+        Return:
+            tuple<int>: the word ids
+        """
+        key = []
+        for wordId in sequence:
+            if wordId == self.eosToken:
+                break
+            elif wordId != self.padToken and wordId != self.goToken:
+                key.append(wordId)
+        return tuple(key)
+
     def playDataset(self):
         """Print a random dialogue from the dataset
         """
@@ -25,8 +25,34 @@ Warning: it does not check the performances of the program
 import unittest
 import io
 import sys
+import os
+import math
+import collections
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import nltk
+import numpy as np
+try:
+    import tensorflow as tf
+except ImportError:  # Only the models run with numpy can be tested
+    tf = None
+try:
+    nltk.word_tokenize('Hello world.')
+    nltkData = True
+except LookupError:  # The tokenizer models have not been downloaded
+    nltkData = False
 
 from chatbot import chatbot
+from chatbot.textdata import TextData, BatchPrefetcher, tokenizeTexts
+from chatbot.cornelldata import CornellData
+from chatbot.mappeddata import saveMappedDataset, loadMappedDataset, loadResponseWords, loadVocabulary, MappedSamples
+from chatbot.bigrammodel import BigramModel, START_TOKEN
+from chatbot.healthydata import load_usda_vecs, FoodNeighborIndex
+from chatbot.npmodel import NumpyModel, exportWeights, WEIGHTS_FILENAME
+from chatbot.frozenmodel import GRAPH_OPTIONS, DECODER_VOCAB_FILENAME
 
 
 class TestChatbot(unittest.TestCase):
@@ -62,5 +88,965 @@ class TestChatbot(unittest.TestCase):
     def test_testing_daemon(self):
         pass
 
+
+class TestMappedData(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.dirName = os.path.join(self.tmpDir.name, 'dataset')
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hello', 'world', 'é"[)=è^$*::!']
+        self.samples = [
+            [[4, 5], [1, 5, 4, 2]],
+            [[], [1, 2]],  # Empty input
+            [[6, 4, 4], []],  # Empty target
+            [[5], [1, 6, 2]],
+        ]
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def assertSamplesEqual(self, samples, expected):
+        self.assertEqual(len(samples), len(expected))
+        for sample, expectedSample in zip(samples, expected):
+            self.assertEqual(len(sample), len(expectedSample))
+            self.assertEqual(list(sample[0]), list(expectedSample[0]))
+            self.assertEqual(list(sample[1]), list(expectedSample[1]))
+            if len(expectedSample) > 2:
+                np.testing.assert_array_equal(sample[2], np.asarray(expectedSample[2], dtype=np.float32))
+
+    def test_round_trip(self):
+        saveMappedDataset(self.dirName, dict(enumerate(self.words)), self.samples)
+        words, samples, responseWordsFile, labels = loadMappedDataset(self.dirName)
+
+        self.assertEqual(words, self.words)
+        self.assertIsInstance(samples, MappedSamples)
+        self.assertSamplesEqual(samples, self.samples)
+        self.assertSamplesEqual(list(samples), self.samples)  # Iterator
+        self.assertIsNone(responseWordsFile)
+        self.assertIsNone(labels)
+
+    def test_round_trip_context(self):
+        rng = np.random.RandomState(0)
+        samples = [sample + [rng.randn(8)] for sample in self.samples]
+        responseWords = ['hello', 'world', 'é"[)=è^$*::!', 'hello']
+        saveMappedDataset(self.dirName, dict(enumerate(self.words)), samples, responseWords, [1, 0, 0, 1])
+        words, mappedSamples, responseWordsFile, labels = loadMappedDataset(self.dirName)
+
+        self.assertEqual(words, self.words)
+        self.assertSamplesEqual(mappedSamples, samples)
+        self.assertEqual(loadResponseWords(responseWordsFile), responseWords)
+        self.assertEqual(labels.tolist(), [1, 0, 0, 1])
+
+    def test_empty_sequences(self):
+        samples = [[[], []], [[], []]]  # No word at all (arrays not memory mapped)
+        saveMappedDataset(self.dirName, dict(enumerate(self.words)), samples)
+        _, mappedSamples, _, _ = loadMappedDataset(self.dirName)
+        self.assertSamplesEqual(mappedSamples, samples)
+
+        saveMappedDataset(self.dirName, dict(enumerate(self.words)), [])
+        _, mappedSamples, _, _ = loadMappedDataset(self.dirName)
+        self.assertEqual(len(mappedSamples), 0)
+        self.assertEqual(list(mappedSamples), [])
+
+    def test_indexing(self):
+        saveMappedDataset(self.dirName, dict(enumerate(self.words)), self.samples)
+        _, samples, _, _ = loadMappedDataset(self.dirName)
+
+        self.assertSamplesEqual([samples[-1], samples[-4]], [self.samples[-1], self.samples[0]])
+        with self.assertRaises(IndexError):
+            samples[len(self.samples)]
+        with self.assertRaises(IndexError):
+            samples[-len(self.samples) - 1]
+
+    def test_pickle_conversion(self):
+        args = chatbot.Chatbot().parseArgs(['--rootDir', self.tmpDir.name, '--maxLength', '4'])
+        samplesDir = os.path.join(self.tmpDir.name, 'data/samples/')
+        os.makedirs(samplesDir)
+        responseWords = ['hello', 'world']
+        with open(os.path.join(samplesDir, 'dataset-4.pkl'), 'wb') as handle:  # Previous format
+            pickle.dump({
+                'word2id': {word: wordId for wordId, word in enumerate(self.words)},
+                'id2word': dict(enumerate(self.words)),
+                'trainingSamples': self.samples,
+                'responseWords': responseWords
+            }, handle, -1)
+
+        for _ in range(2):  # Converted the first time, then loaded from the binary format
+            textData = TextData(args)
+            self.assertEqual([textData.id2word[i] for i in range(len(self.words))], self.words)
+            self.assertEqual(textData.word2id['<eos>'], 2)
+            self.assertSamplesEqual(textData.trainingSamples, self.samples)
+            self.assertEqual(textData.getResponseWords(), responseWords)
+        self.assertIsInstance(textData.trainingSamples, MappedSamples)
+
+        textData.shuffle()  # Only the order of the ids changes
+        self.assertEqual(sorted(textData.sampleIds.tolist()), list(range(len(self.samples))))
+        self.assertSamplesEqual(textData.trainingSamples, self.samples)
+
+
+class TestUsdaVectors(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.model = os.path.join(self.tmpDir.name, 'model')
+        rng = np.random.RandomState(0)
+        self.foods = ['{:05d}'.format(i) for i in range(20)]
+        self.vecs = {food: rng.randn(6).tolist() for food in self.foods}  # float64, as parsed before the conversion
+        with open(self.model + '_foods', 'w') as f:
+            f.write('\n'.join(self.foods) + '\n')
+        with open(self.model + '_embeddings', 'w') as f:
+            f.write('\n'.join(' '.join(repr(val) for val in self.vecs[food]) for food in self.foods) + '\n')
+        with open(self.model + '_vecs_dict', 'wb') as f:
+            pickle.dump({food: np.array(vec) for food, vec in self.vecs.items()}, f)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def assertSameVectors(self, usdaVecs):
+        self.assertEqual(sorted(usdaVecs.keys()), self.foods)
+        for food in self.foods:
+            self.assertEqual(usdaVecs[food].dtype, np.float32)
+            np.testing.assert_array_equal(usdaVecs[food], np.float32(self.vecs[food]))
+        np.testing.assert_array_equal(usdaVecs.gather(self.foods[::-3]), np.float32([self.vecs[food] for food in self.foods[::-3]]))
+
+    def test_sources(self):
+        for source in ['text', 'dict']:  # The dict is the one of MealData
+            for _ in range(2):  # Converted, then loaded
+                self.assertSameVectors(load_usda_vecs(self.model, source))
+        self.assertTrue(os.path.exists(self.model + '_vecs.npy'))
+        self.assertTrue(os.path.exists(self.model + '_vecs_dict.npy'))
+
+    def test_cache_dir(self):
+        cacheDir = os.path.join(self.tmpDir.name, 'cache')
+        self.assertSameVectors(load_usda_vecs(self.model, cache_dir=cacheDir))
+        self.assertTrue(os.path.exists(os.path.join(cacheDir, 'model_vecs.npy')))
+        self.assertFalse(os.path.exists(self.model + '_vecs.npy'))
+
+        with open(self.model + '_embeddings', 'w') as f:  # More recent than the cache
+            f.write('\n'.join(' '.join(['1.5'] * 6) for food in self.foods) + '\n')
+        os.utime(self.model + '_embeddings', (0, os.path.getmtime(os.path.join(cacheDir, 'model_vecs_foods.txt')) + 10))
+        np.testing.assert_array_equal(load_usda_vecs(self.model, cache_dir=cacheDir)[self.foods[0]], [1.5] * 6)
+
+    def test_unwritable_cache(self):
+        cacheDir = os.path.join(self.model + '_foods', 'cache')  # Cannot be created (not writable)
+        self.assertSameVectors(load_usda_vecs(self.model, 'dict', cache_dir=cacheDir))
+        self.assertSameVectors(load_usda_vecs(self.model, cache_dir=cacheDir))
+
+
+class TestFoodNeighborIndex(unittest.TestCase):
+    def findNeighbor(self, food, vec, usdaVecs):
+        """Previous search of the neighbors (float64 euclidean distance to each food)
+        """
+        neighbors = queue.PriorityQueue()
+        for usdaFood, usdaVec in usdaVecs.items():
+            if food == usdaFood or usdaFood == 0:
+                continue
+            neighbors.put((nltk.cluster.util.euclidean_distance(np.array(vec), np.array(usdaVec)), usdaFood))
+        return neighbors
+
+    def assertSameNeighbors(self, usdaVecs):
+        index = FoodNeighborIndex.from_vecs(usdaVecs)
+        for food, vec in usdaVecs.items():
+            expected = self.findNeighbor(food, vec, usdaVecs)
+            self.assertEqual(index.nearest(food, vec), expected.get()[1])
+
+        queries = np.random.RandomState(1).randn(5, 8) * 10
+        for vec, neighbors in zip(queries, index.query(queries, k=4)):
+            expected = self.findNeighbor(None, vec, usdaVecs)
+            expectedNeighbors = [expected.get() for _ in range(4)]
+            self.assertEqual([food for _, food in neighbors], [food for _, food in expectedNeighbors])
+            np.testing.assert_allclose([dist for dist, _ in neighbors], [dist for dist, _ in expectedNeighbors])
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        self.assertSameNeighbors({'{:03d}'.format(i): rng.randn(8) * 10 for i in range(100)})
+
+    def test_close_vectors(self):
+        rng = np.random.RandomState(0)
+        center = rng.randn(8) * 1e4  # Large norm, small distances: the expansion cancels
+        usdaVecs = {'{:03d}'.format(i): center + rng.randn(8) * 1e-3 for i in range(50)}
+        usdaVecs['050'] = usdaVecs['010'].copy()  # Tie
+        usdaVecs[0] = center  # Never a neighbor
+        self.assertSameNeighbors(usdaVecs)
+
+
+class TestBigramModel(unittest.TestCase):
+    def setUp(self):
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>', 'eat', 'more', 'fruit', 'less', 'salt', 'never']
+        self.word2id = {word: wordId for wordId, word in enumerate(self.words)}
+        responses = [
+            'eat more fruit',
+            'eat less salt',
+            'eat more more fruit',
+            'less salt please',  # Unknown words
+            'fruit',
+            'eat kale',
+        ]
+        self.tokens = []
+        for response in responses:
+            self.tokens.append(START_TOKEN)
+            self.tokens.extend(response.split())
+
+    def nltkPenalty(self, probDist, candidate, maxWords):
+        """Previous scoring of the candidates (nltk MLE bigrams)
+        """
+        penalty = 0.0
+        prevWord = START_TOKEN
+        for wordId in candidate[:maxWords]:
+            currWord = self.words[wordId]
+            bigramP = probDist[prevWord].prob(currWord)
+            if bigramP > 0:
+                penalty += math.log(bigramP)
+            prevWord = currWord
+        return penalty
+
+    def test_penalties(self):
+        probDist = nltk.ConditionalProbDist(nltk.ConditionalFreqDist(nltk.bigrams(self.tokens)), nltk.MLEProbDist)
+        model = BigramModel.fromTokens(self.tokens, self.word2id)
+
+        rng = np.random.RandomState(0)
+        candidates = [
+            [4, 5, 6],  # Seen bigrams
+            [4, 5, 5, 5, 6],
+            [7, 8, 2],  # <eos> never seen
+            [9, 0, 3],  # Never seen word, <pad> and <unknown>
+            [6, 4],  # Unseen first bigram
+            [],
+        ] + [list(rng.randint(len(self.words), size=rng.randint(1, 6))) for _ in range(50)]
+        maxLength = max(len(candidate) for candidate in candidates)
+        padded = np.zeros((len(candidates), maxLength), dtype=np.int64)
+        for i, candidate in enumerate(candidates):
+            padded[i, :len(candidate)] = candidate
+        lengths = [len(candidate) for candidate in candidates]
+
+        for maxWords in [0, 1, 2, 3, maxLength, maxLength + 5]:  # Truncation of gamma_wt
+            expected = [self.nltkPenalty(probDist, candidate, maxWords) for candidate in candidates]
+            np.testing.assert_allclose(model.penalties(padded, lengths, maxWords), expected)
+
+    def test_save_load(self):
+        model = BigramModel.fromTokens(self.tokens, self.word2id)
+        with tempfile.TemporaryDirectory() as dirName:
+            fileName = os.path.join(dirName, 'bigrams.npz')
+            model.save(fileName)
+            loaded = BigramModel.load(fileName)
+        np.testing.assert_array_equal(loaded.keys, model.keys)
+        np.testing.assert_array_equal(loaded.logProbs, model.logProbs)
+        self.assertEqual(loaded.vocabularySize, model.vocabularySize)
+
+    def test_no_bigram(self):
+        model = BigramModel.fromTokens([START_TOKEN, 'kale'], self.word2id)
+        np.testing.assert_array_equal(model.penalties([[4, 5]], [2], 2), [0.0])
+
+
+class TestBeam2Sequences(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>', 'a', 'b', 'c', 'd']
+        self.textData = self.createTextData()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def createTextData(self, decoderVocabulary=None):
+        args = chatbot.Chatbot().parseArgs([
+            '--rootDir', self.tmpDir.name,
+            '--decoderVocab', str(int(decoderVocabulary is not None))
+        ])
+        return TextData(args, vocabulary=self.words, decoderVocabulary=decoderVocabulary)
+
+    def oldBeam2sequences(self, path, symbol, probs):
+        """Previous backtracking of the beam (one hypothesis and one step at a time)
+        """
+        beamSize = len(path[0])
+        paths = []
+        log_probs = []
+        num_steps = len(path)
+        lastTokenIndex = [num_steps]*beamSize
+        for kk in range(beamSize):
+            paths.append([])
+            log_probs.append(0.0)
+            for i in range(num_steps-1):
+                if symbol[i][kk] == self.textData.eosToken:
+                    lastTokenIndex[kk] = i
+                    break
+        curr = list(range(beamSize))
+        for i in range(num_steps-1, -1, -1):
+            for kk in range(beamSize):
+                if i > lastTokenIndex[kk]:
+                    continue
+                paths[kk].append(symbol[i][curr[kk]])
+                log_probs[kk] = log_probs[kk] + probs[i][curr[kk]]
+                curr[kk] = path[i][curr[kk]]
+        return [[int(wordId) for wordId in reply[::-1]] for reply in paths], log_probs
+
+    def assertBeamEqual(self, path, symbol, probs, textData=None, wordSymbol=None):
+        textData = textData or self.textData
+        sequences, lengths, logProbs = textData.beam2sequences(path, symbol, probs)
+        replies, expectedLogProbs = self.oldBeam2sequences(path, symbol if wordSymbol is None else wordSymbol, probs)
+
+        self.assertEqual([sequences[kk, :lengths[kk]].tolist() for kk in range(len(sequences))], replies)
+        self.assertTrue((sequences[np.arange(sequences.shape[1])[None, :] >= lengths[:, None]] == textData.padToken).all())
+        np.testing.assert_allclose(logProbs, expectedLogProbs, rtol=1e-6)
+
+    def test_hand_built(self):
+        path = np.array([
+            [0, 0, 0],
+            [0, 0, 1],  # Same parent
+            [2, 1, 1],
+            [0, 0, 2],
+        ])
+        symbol = np.array([
+            [4, 2, 5],  # <eos> at the first step
+            [6, 6, 2],  # Tie
+            [2, 4, 4],
+            [2, 2, 2],  # Last step: not an end
+        ])
+        probs = np.log(np.array([
+            [0.5, 0.3, 0.2],
+            [0.4, 0.4, 0.2],
+            [0.6, 0.2, 0.2],
+            [0.9, 0.05, 0.05],
+        ], dtype=np.float32))
+        self.assertBeamEqual(path, symbol, probs)
+
+        sequences, lengths, _ = self.textData.beam2sequences(path, symbol, probs)
+        self.assertEqual(lengths.tolist(), [3, 1, 2])
+        self.assertEqual(sequences[1].tolist(), [2, 0, 0, 0])
+
+    def test_single_step(self):
+        self.assertBeamEqual(np.zeros((1, 3), dtype=np.int32), np.array([[2, 4, 2]]), np.zeros((1, 3), dtype=np.float32))
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            nbSteps, beamSize = rng.randint(1, 8), rng.randint(1, 6)
+            path = rng.randint(beamSize, size=(nbSteps, beamSize))
+            symbol = rng.randint(2, 6, size=(nbSteps, beamSize))  # Many <eos> and ties
+            probs = np.log(rng.choice([0.25, 0.5], size=(nbSteps, beamSize))).astype(np.float32)
+            self.assertBeamEqual(path, symbol, probs)
+
+    def test_decoder_vocabulary(self):
+        textData = self.createTextData(['<pad>', '<go>', '<eos>', '<unknown>', 'd', 'b'])
+        rng = np.random.RandomState(1)
+        path = rng.randint(3, size=(5, 3))
+        symbol = rng.randint(2, 6, size=(5, 3))  # Decoder ids
+        probs = np.log(rng.uniform(size=(5, 3))).astype(np.float32)
+        self.assertBeamEqual(path, symbol, probs, textData, wordSymbol=textData.fromDecoderIds(symbol))
+
+
+@unittest.skipIf(tf is None, 'tensorflow is not installed')
+class TestNumpyModel(unittest.TestCase):
+    """Compare the numpy model with the testing graph it has been exported from
+    """
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>'] + ['w{}'.format(i) for i in range(16)]
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def assertSameOutputs(self, options, decoderVocabulary=None):
+        from chatbot.model import Model
+
+        args = chatbot.Chatbot().parseArgs([
+            '--test', 'daemon',
+            '--rootDir', self.tmpDir.name,
+            '--maxLength', '4',
+            '--hiddenSize', '8',
+            '--embeddingSize', '6',
+            '--numLayers', '2',
+            '--beam_size', '3',
+            '--decoderVocab', str(int(decoderVocabulary is not None))
+        ] + options)
+        args.maxLengthEnco = args.maxLength
+        args.maxLengthDeco = args.maxLength + 2
+        if args.attention or args.food_context:
+            args.softmaxSamples = 8  # Projection of the outputs (as done by the chatbot)
+        textData = TextData(args, vocabulary=self.words, decoderVocabulary=decoderVocabulary)
+
+        rng = np.random.RandomState(0)
+        samples = []
+        for length in [4, 2, 1]:
+            sample = [rng.randint(4, len(self.words), size=length).tolist(), []]
+            if args.food_context:
+                sample.append(rng.randn(64))
+            samples.append(sample)
+        batch = textData._createBatch(samples)
+
+        fileName = os.path.join(self.tmpDir.name, WEIGHTS_FILENAME)
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            model = Model(args, textData)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                ops, feedDict = model.step(batch)
+                outputs = sess.run(ops[0], feedDict)
+                variables = tf.trainable_variables()
+                exportWeights(
+                    fileName,
+                    {variable.op.name: value for variable, value in zip(variables, sess.run(variables))},
+                    {option: getattr(args, option) for option in GRAPH_OPTIONS},
+                    int(textData.toDecoderIds(textData.eosToken))
+                )
+
+        npOutputs = NumpyModel(fileName).predict(batch)
+        if args.beam_search:
+            outputs = outputs[-3:]  # Beam path, symbols and probs
+        self.assertEqual(len(outputs), len(npOutputs))
+        for output, npOutput in zip(outputs, npOutputs):
+            self.assertEqual(np.shape(output), np.shape(npOutput))
+            np.testing.assert_allclose(npOutput, output, rtol=1e-4, atol=1e-5)
+
+    def test_plain(self):
+        self.assertSameOutputs([])
+
+    def test_greedy(self):
+        self.assertSameOutputs(['--beam_search', '0'])
+
+    def test_greedy_early_stop(self):
+        self.assertSameOutputs(['--beam_search', '0', '--earlyStop', '1'])
+
+    def test_early_stop(self):
+        self.assertSameOutputs(['--earlyStop', '1'])
+
+    def test_attention(self):
+        self.assertSameOutputs(['--attention', '1'])
+        self.assertSameOutputs(['--attention', '1', '--beam_search', '0'])
+
+    def test_food_context(self):
+        self.assertSameOutputs(['--food_context', '1'])
+        self.assertSameOutputs(['--food_context', '1', '--beam_search', '0'])
+
+    def test_food_context_first_step(self):
+        self.assertSameOutputs(['--food_context', '1', '--first_step', '1'])
+
+    def test_dynamic_encoder(self):
+        self.assertSameOutputs(['--dynamicEncoder', '1'])
+        self.assertSameOutputs(['--dynamicEncoder', '1', '--attention', '1'])
+
+    def test_decoder_vocabulary(self):
+        self.assertSameOutputs([], decoderVocabulary=['<pad>', '<go>', '<eos>', '<unknown>', 'w3', 'w1', 'w7'])
+
+
+class TestMakeLighter(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hello', 'world']
+        self.samples = [[[4, 5], [5, 4]] for _ in range(400)]
+        self.labels = [1] * 100 + [0] * 300
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def createTextData(self, seed=None, labels=None):
+        options = ['--seed', str(seed)] if seed is not None else []
+        args = chatbot.Chatbot().parseArgs(['--rootDir', self.tmpDir.name, '--maxLength', '4'] + options)
+        textData = TextData(args, vocabulary=self.words)
+        textData.trainingSamples = self.samples
+        textData.sampleLabels = labels
+        return textData
+
+    def test_labels(self):
+        for labels in [self.labels, np.asarray(self.labels, dtype=np.int8)]:  # As extracted or loaded
+            for ratio in [0.1, 0.25, 0.5]:
+                textData = self.createTextData(labels=labels)
+                textData.makeLighter(ratio)
+                keptLabels = np.asarray(self.labels)[textData.sampleIds]
+                self.assertEqual(textData.getSampleSize(), int(400 * ratio))
+                self.assertEqual(np.sum(keptLabels == 1), int(100 * ratio))
+                self.assertEqual(np.sum(keptLabels == 0), int(300 * ratio))
+
+        textData = self.createTextData(labels=[1] * 399 + [0])
+        textData.makeLighter(0.1)
+        self.assertIn(399, textData.sampleIds.tolist())  # At least one sample of each label
+
+    def test_seed(self):
+        def sampleIds(seed, labels=None):
+            textData = self.createTextData(seed, labels)
+            textData.makeLighter(0.1)
+            self.assertEqual(textData.sampleIds.tolist(), sorted(set(textData.sampleIds.tolist())))
+            return textData.sampleIds.tolist()
+        for labels in [None, self.labels]:
+            self.assertEqual(sampleIds(1, labels), sampleIds(1, labels))
+            self.assertEqual(sampleIds(None, labels), sampleIds(0, labels))
+            self.assertNotEqual(sampleIds(1, labels), sampleIds(2, labels))
+
+        textData = self.createTextData(1, self.labels)
+        textData.makeLighter(1.0)
+        self.assertIsNone(textData.sampleIds)
+        self.assertEqual(textData.getSampleSize(), 400)
+
+    def test_pickle_conversion(self):
+        samplesDir = os.path.join(self.tmpDir.name, 'data/samples/')
+        os.makedirs(samplesDir)
+        with open(os.path.join(samplesDir, 'dataset-4.pkl'), 'wb') as handle:  # Previous format: no labels
+            pickle.dump({
+                'word2id': {word: wordId for wordId, word in enumerate(self.words)},
+                'id2word': dict(enumerate(self.words)),
+                'trainingSamples': self.samples[:100]
+            }, handle, -1)
+
+        counts = np.zeros(100)
+        for seed in range(200):  # Converted the first time, then loaded from the binary format
+            args = chatbot.Chatbot().parseArgs(['--rootDir', self.tmpDir.name, '--maxLength', '4', '--seed', str(seed)])
+            textData = TextData(args)
+            self.assertIsNone(textData.sampleLabels)
+            textData.makeLighter(0.2)
+            self.assertEqual(textData.getSampleSize(), 20)
+            counts[textData.sampleIds] += 1
+        self.assertTrue(np.all(np.abs(counts / 200 - 0.2) < 0.15))  # Uniform sampling
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.prepared = []
+
+    def prepare(self, job):
+        with self.lock:
+            self.prepared.append(job)
+        if job == 'error':
+            raise ValueError('cannot prepare the job')
+        time.sleep(0.001 * (job % 3))  # The threads finish their jobs in a different order
+        return job * 2
+
+    def test_order(self):
+        jobs = list(range(50))
+        for queueSize, numThreads in [(1, 1), (4, 1), (4, 3), (2, 8)]:
+            prefetcher = BatchPrefetcher(jobs, self.prepare, queueSize, numThreads)
+            self.assertEqual(len(prefetcher), len(jobs))
+            self.assertEqual(list(prefetcher), [job * 2 for job in jobs])
+            self.assertFalse(any(thread.is_alive() for thread in prefetcher.threads))
+        self.assertEqual(list(BatchPrefetcher([], self.prepare, 4, 2)), [])
+
+    def test_early_stop(self):
+        queueSize, numThreads = 4, 2
+        prefetcher = BatchPrefetcher(list(range(100)), self.prepare, queueSize, numThreads)
+        steps = iter(prefetcher)
+        self.assertEqual([next(steps) for _ in range(3)], [0, 2, 4])
+        steps.close()  # Ex: interrupted training
+        self.assertFalse(any(thread.is_alive() for thread in prefetcher.threads))
+        self.assertLessEqual(len(self.prepared), 3 + queueSize + numThreads)  # The remaining jobs are dropped
+
+    def test_exception(self):
+        jobs = list(range(5)) + ['error'] + list(range(5, 50))
+        prefetcher = BatchPrefetcher(jobs, self.prepare, 4, 3)
+        results = []
+        with self.assertRaises(ValueError):
+            for result in prefetcher:
+                results.append(result)
+        self.assertEqual(results, [job * 2 for job in range(5)])  # The jobs before the error are still returned
+        self.assertFalse(any(thread.is_alive() for thread in prefetcher.threads))
+
+
+class TestCreateBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>'] + ['w{}'.format(i) for i in range(8)]
+        rng = np.random.RandomState(0)
+        self.samples = [
+            [rng.randint(4, len(self.words), size=rng.randint(0, 5)).tolist(),
+             rng.randint(4, len(self.words), size=rng.randint(0, 5)).tolist(),
+             rng.randn(64)]
+            for _ in range(20)
+        ]
+        self.samples.append([[4, 5, 6, 7, 8], [9, 10, 11, 4, 5], rng.randn(64)])  # Exactly maxLength long
+        self.samples.append([[], [], rng.randn(64)])
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def createTextData(self, options=()):
+        args = chatbot.Chatbot().parseArgs(['--rootDir', self.tmpDir.name, '--maxLength', '5'] + list(options))
+        args.maxLengthEnco = args.maxLength
+        args.maxLengthDeco = args.maxLength + 2
+        return TextData(args, vocabulary=self.words)
+
+    @staticmethod
+    def loopBatch(textData, samples):
+        """Create the batch sample by sample (previous implementation)
+        """
+        args = textData.args
+        encoderSeqs, decoderSeqs, targetSeqs, weights = [], [], [], []
+        for sample in samples:
+            sample = [list(seq) for seq in sample[:2]]
+            if not args.test and args.watsonMode:
+                sample = list(reversed(sample))
+            encoderSeq = list(reversed(sample[0]))
+            targetSeq = [textData.goToken] + sample[1] + [textData.eosToken]
+            if args.match_encoder_decoder_input:
+                decoderSeq = [textData.goToken] + sample[0] + [textData.eosToken]
+            else:
+                decoderSeq = targetSeq
+            targetSeq = targetSeq[1:]
+            encoderSeqs.append([textData.padToken] * (args.maxLengthEnco - len(encoderSeq)) + encoderSeq)
+            weights.append([1.0] * len(targetSeq) + [0.0] * (args.maxLengthDeco - len(targetSeq)))
+            decoderSeqs.append(decoderSeq + [textData.padToken] * (args.maxLengthDeco - len(decoderSeq)))
+            targetSeqs.append(targetSeq + [textData.padToken] * (args.maxLengthDeco - len(targetSeq)))
+        return [np.asarray(seqs).T for seqs in (encoderSeqs, decoderSeqs, targetSeqs, weights)]
+
+    def assertBatchEqual(self, textData, samples):
+        batch = textData._createBatch(samples)
+        encoderSeqs, decoderSeqs, targetSeqs, weights = self.loopBatch(textData, samples)
+        self.assertEqual(batch.encoderSeqs.dtype, np.int32)
+        self.assertEqual(batch.weights.dtype, np.float32)
+        np.testing.assert_array_equal(batch.encoderSeqs, encoderSeqs)
+        np.testing.assert_array_equal(batch.decoderSeqs, decoderSeqs)
+        np.testing.assert_array_equal(batch.targetSeqs, targetSeqs)
+        np.testing.assert_array_equal(batch.weights, weights)
+        if not textData.args.match_encoder_decoder_input:  # Targets shifted by one
+            np.testing.assert_array_equal(batch.targetSeqs[:-1], batch.decoderSeqs[1:])
+            self.assertTrue(np.all(batch.targetSeqs[-1] == textData.padToken))
+        return batch
+
+    def test_flatten(self):
+        seqs = [sample[0] for sample in self.samples]
+        lengths, words, pos, cols = TextData._flattenSeqs(seqs)
+        self.assertEqual(lengths.tolist(), [len(seq) for seq in seqs])
+        self.assertEqual(words.tolist(), [word for seq in seqs for word in seq])
+        self.assertEqual(pos.tolist(), [i for seq in seqs for i in range(len(seq))])
+        self.assertEqual(cols.tolist(), [j for j, seq in enumerate(seqs) for _ in seq])
+
+    def test_plain(self):
+        self.assertBatchEqual(self.createTextData(), self.samples)
+        self.assertBatchEqual(self.createTextData(), self.samples[-2:-1])  # Single sample without padding
+
+    def test_watson(self):
+        self.assertBatchEqual(self.createTextData(['--watsonMode']), [sample[:2] for sample in self.samples])
+
+    def test_match_decoder(self):
+        self.assertBatchEqual(self.createTextData(['--match_encoder_decoder_input', '1']), self.samples)
+
+    def test_food_context(self):
+        batch = self.assertBatchEqual(self.createTextData(['--food_context', '1']), self.samples)
+        np.testing.assert_allclose(batch.context, [sample[2] for sample in self.samples], rtol=1e-6)
+
+    def test_mapped_samples(self):
+        dirName = os.path.join(self.tmpDir.name, 'dataset')
+        saveMappedDataset(dirName, dict(enumerate(self.words)), self.samples)
+        _, samples, _, _ = loadMappedDataset(dirName)
+        self.assertBatchEqual(self.createTextData(), [samples[i] for i in range(len(samples))])
+
+
+class TestBuckets(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.words = ['<pad>', '<go>', '<eos>', '<unknown>'] + ['w{}'.format(i) for i in range(6)]
+        rng = np.random.RandomState(0)
+        self.samples = [
+            [rng.randint(4, len(self.words), size=rng.randint(0, 7)).tolist(),
+             rng.randint(4, len(self.words), size=rng.randint(0, 7)).tolist()]
+            for _ in range(50)
+        ]
+        self.samples.append([[4, 5, 6, 7], [4, 5]])  # Exactly the size of a bucket
+        self.samples.append([[4], [4, 5, 6, 7, 8, 9]])  # Longest target
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def createTextData(self, samples):
+        args = chatbot.Chatbot().parseArgs([
+            '--rootDir', self.tmpDir.name,
+            '--maxLength', '6',
+            '--buckets', '2', '4',
+            '--batchSize', '4'
+        ])
+        args.maxLengthEnco = args.maxLength
+        args.maxLengthDeco = args.maxLength + 2
+        textData = TextData(args, vocabulary=self.words)
+        textData.trainingSamples = samples
+        return textData
+
+    def assertBatches(self, textData):
+        self.assertEqual(textData.getBuckets(), [(2, 4), (4, 6), (6, 8)])
+        batchesIds = textData.getBatchesIds()
+        self.assertEqual(sorted(i for _, sampleIds in batchesIds for i in sampleIds), list(range(len(self.samples))))
+        for bucketId, sampleIds in batchesIds:
+            self.assertLessEqual(len(sampleIds), 4)
+            encoLength, decoLength = textData.getBuckets()[bucketId]
+            minLength = textData.getBuckets()[bucketId - 1][0] if bucketId > 0 else -1
+            for i in sampleIds:  # Smallest bucket the sample fit into
+                length = max(len(self.samples[i][0]), len(self.samples[i][1]))
+                self.assertTrue(minLength < length <= encoLength)
+
+            batch = textData.getBatch((bucketId, sampleIds))
+            self.assertEqual(batch.bucketId, bucketId)
+            self.assertEqual(batch.encoderSeqs.shape, (encoLength, len(sampleIds)))
+            self.assertEqual(batch.decoderSeqs.shape, (decoLength, len(sampleIds)))
+            self.assertEqual(batch.targetSeqs.shape, (decoLength, len(sampleIds)))
+            self.assertEqual(batch.weights.shape, (decoLength, len(sampleIds)))
+            for j, i in enumerate(sampleIds):
+                inputs, targets = self.samples[i]
+                self.assertEqual(batch.encoderSeqs[:, j].tolist(), [0] * (encoLength - len(inputs)) + inputs[::-1])
+                self.assertEqual(batch.decoderSeqs[:, j].tolist(), [1] + targets + [2] + [0] * (decoLength - len(targets) - 2))
+
+    def test_list_samples(self):
+        self.assertBatches(self.createTextData(self.samples))
+
+    def test_mapped_samples(self):
+        dirName = os.path.join(self.tmpDir.name, 'dataset')
+        saveMappedDataset(dirName, dict(enumerate(self.words)), self.samples)
+        _, samples, _, _ = loadMappedDataset(dirName)
+        textData = self.createTextData(samples)
+        self.assertBatches(textData)
+        self.assertEqual(textData._getBucketIds().tolist(), [
+            next(bucketId for bucketId, length in enumerate([2, 4, 6]) if max(map(len, sample)) <= length)
+            for sample in self.samples
+        ])
+
+
+class CornellCorpusTestCase(unittest.TestCase):
+    """Create the datasets from a small corpus (with the cornell format, in a temporary root directory)
+    """
+    conversations = [
+        ['hi !', 'hi , how are you ?', 'fine , and you ?', 'fine .'],
+        ['how are you ?', 'fine , thanks .'],
+        ['hi !', 'bye !'],
+        ['who are you ?', 'a friend . who are you ?', 'nobody .'],
+        ['hi !', 'hi , how are you ?'],
+    ]
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        corpusDir = os.path.join(self.tmpDir.name, 'data/cornell/')
+        os.makedirs(corpusDir)
+        with open(os.path.join(corpusDir, 'movie_lines.txt'), 'w', encoding='iso-8859-1') as linesFile, \
+                open(os.path.join(corpusDir, 'movie_conversations.txt'), 'w', encoding='iso-8859-1') as convFile:
+            lineNum = 0
+            for conversation in self.conversations:
+                lineIds = []
+                for text in conversation:
+                    lineIds.append('L{}'.format(lineNum))
+                    linesFile.write(' +++$+++ '.join([lineIds[-1], 'u0', 'm0', 'SOMEONE', text]) + '\n')
+                    lineNum += 1
+                convFile.write(' +++$+++ '.join(['u0', 'u1', 'm0', str(lineIds)]) + '\n')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def parseArgs(self, options=()):
+        return chatbot.Chatbot().parseArgs(['--rootDir', self.tmpDir.name, '--maxLength', '10'] + list(options))
+
+    def splitTokens(self):
+        """Tokenize the corpus texts on the spaces (the texts are already tokenized)
+        """
+        cornellData = CornellData(os.path.join(self.tmpDir.name, 'data/cornell/'))
+        return {
+            line['text']: [line['text'].split()]
+            for conversation in cornellData.getConversations() for line in conversation['lines']
+        }
+
+
+class TestFilterVocabulary(CornellCorpusTestCase):
+    def getWords(self, textData):
+        return [
+            [[textData.id2word[wordId] for wordId in sample[i]] for i in range(2)]
+            for sample in textData.trainingSamples
+        ]
+
+    def assertFiltered(self, minCount=1, vocabularySize=0):
+        textData = TextData(self.parseArgs(), sentenceTokens=self.splitTokens())
+        allWords = self.getWords(textData)
+        options = ['--minCount', str(minCount), '--vocabularySize', str(vocabularySize)]
+        filteredData = TextData(self.parseArgs(options), sentenceTokens=self.splitTokens())
+
+        # Most frequent words over all the samples, the ties in the extraction order
+        counts = collections.Counter(word for sample in allWords for seq in sample for word in seq)
+        kept = [word for word in list(textData.word2id)[4:] if counts[word] >= minCount]
+        if vocabularySize:
+            kept = sorted(kept, key=lambda word: -counts[word])[:vocabularySize - 4]
+        kept = set(kept)
+
+        # Special tokens first, then the kept words in the extraction order
+        words, samples, _, _ = loadMappedDataset(os.path.join(filteredData.samplesDir, filteredData.samplesName))
+        self.assertEqual(words[:4], ['<pad>', '<go>', '<eos>', '<unknown>'])
+        self.assertEqual([filteredData.word2id[word] for word in words[:4]], [0, 1, 2, 3])
+        self.assertEqual(words[4:], [word for word in textData.word2id if word in kept])
+        self.assertEqual(filteredData.word2id, {word: wordId for wordId, word in enumerate(words)})
+
+        # Same samples (saved and in memory), with the filtered words replaced by <unknown>
+        expected = [[[word if word in kept else '<unknown>' for word in seq] for seq in sample] for sample in allWords]
+        self.assertEqual(self.getWords(filteredData), expected)
+        self.assertEqual([[[words[wordId] for wordId in seq] for seq in sample[:2]] for sample in samples], expected)
+        return kept
+
+    def test_min_count(self):
+        self.assertEqual(self.assertFiltered(minCount=100), set())
+        kept = self.assertFiltered(minCount=3)
+        self.assertIn('you', kept)
+        self.assertNotIn('nobody', kept)
+
+    def test_vocabulary_size(self):
+        self.assertEqual(self.assertFiltered(vocabularySize=7), {'you', '?', 'are'})
+        self.assertEqual(self.assertFiltered(vocabularySize=11), {'you', '?', 'are', 'hi', ',', '.', '!'})  # Ties cut
+        self.assertEqual(len(self.assertFiltered(minCount=3, vocabularySize=100)), len(self.assertFiltered(minCount=3)))
+
+    def test_response_words(self):
+        words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'rare', 'bye']
+        args = self.parseArgs(['--minCount', '2'])
+        textData = TextData(args, vocabulary=words)
+        shared = [4, 6]
+        textData.trainingSamples = [[[4, 5], shared], [[6], shared], [shared, [4]]]
+        textData.responseWords = [START_TOKEN, 'hi', 'rare', START_TOKEN, 'hi', 'bye']
+        textData.filterVocabulary()
+        textData.saveDataset(textData.samplesDir)
+
+        datasetDir = os.path.join(textData.samplesDir, textData.samplesName)
+        words, samples, responseWordsFile, _ = loadMappedDataset(datasetDir)
+        self.assertEqual(words, ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'bye'])
+        self.assertEqual([[list(seq) for seq in sample] for sample in samples], [[[4, 3], [4, 5]], [[5], [4, 5]], [[4, 5], [4]]])
+        self.assertEqual(shared, [4, 6])  # The shared lists are replaced, not modified
+        self.assertEqual(loadResponseWords(responseWordsFile), textData.responseWords)
+
+        bigramModel = BigramModel.load(os.path.join(datasetDir, 'bigrams.npz'))  # Built with the filtered vocabulary
+        self.assertEqual(bigramModel.vocabularySize, len(words))
+        expected = BigramModel.fromTokens(textData.responseWords, {word: wordId for wordId, word in enumerate(words)})
+        np.testing.assert_array_equal(bigramModel.keys, expected.keys)
+        self.assertTrue(np.all(bigramModel.keys < bigramModel.nbIds ** 2))
+
+
+class TestTextCache(CornellCorpusTestCase):
+    def test_eviction(self):
+        args = self.parseArgs(['--tokenCacheSize', '2'])
+        textData = TextData(args, vocabulary=['<pad>', '<go>', '<eos>', '<unknown>'])
+        hi, bye, fine = 'hi !', 'bye !', 'fine .'
+        textData.sentenceTokens = {text: [text.split()] for text in [hi, bye, fine]}
+
+        hiWords = textData.extractText(hi)
+        self.assertIs(textData.extractText(hi), hiWords)  # Same list for the same text
+        self.assertIsNot(textData.extractText(hi, True), hiWords)  # The targets are extracted differently
+        byeWords = textData.extractText(bye)
+        self.assertEqual(list(textData.textCache), [(hi, True), (bye, False)])  # (hi, False) evicted
+        self.assertIs(textData.extractText(hi, True), textData.textCache[(hi, True)])
+        self.assertEqual(list(textData.textCache), [(bye, False), (hi, True)])  # Least recently used first
+
+        textData.extractText(fine)
+        self.assertEqual(list(textData.textCache), [(hi, True), (fine, False)])
+        self.assertEqual(textData.extractText(bye), byeWords)  # Extracted again
+        self.assertIsNot(textData.extractText(hi), hiWords)
+        self.assertEqual(textData.extractText(hi), hiWords)
+        self.assertEqual((textData.textCacheHits, textData.textCacheMisses), (3, 6))
+        self.assertEqual(len(textData.textCache), 2)
+
+        args.tokenCacheSize = 0  # No cache
+        textData.textCache.clear()
+        self.assertIsNot(textData.extractText(hi), textData.extractText(hi))
+        self.assertEqual(len(textData.textCache), 0)
+
+    def test_shared_lists(self):
+        args = self.parseArgs()
+        args.maxLengthEnco = args.maxLength
+        args.maxLengthDeco = args.maxLength + 2
+        textData = TextData(args, sentenceTokens=self.splitTokens())
+        samples = list(textData.trainingSamples)
+        self.assertEqual(len(textData.textCache), 0)  # Cleared after the extraction
+
+        # The repeated texts share the same list
+        hiSamples = [sample for sample in samples if [textData.id2word[wordId] for wordId in sample[0]] == ['hi', '!']]
+        self.assertEqual(len(hiSamples), 3)
+        hiWords = hiSamples[0][0]
+        self.assertIs(hiSamples[1][0], hiWords)
+        self.assertIs(hiSamples[2][0], hiWords)
+        sharedLists = [seq for sample in samples for seq in sample[:2]]
+        sharedCopies = [list(seq) for seq in sharedLists]
+
+        textData._createBatch(samples)
+        textData.args.watsonMode = True
+        textData._createBatch(samples)
+        textData.args.minCount = 3
+        textData.filterVocabulary()
+        self.assertEqual(sharedLists, sharedCopies)  # Never modified
+
+        # The filtered samples get new lists, still shared
+        self.assertIsNot(hiSamples[0][0], hiWords)
+        self.assertIs(hiSamples[1][0], hiSamples[0][0])
+        self.assertIs(hiSamples[2][0], hiSamples[0][0])
+
+
+@unittest.skipIf(not nltkData, 'the nltk tokenizer models are not installed')
+class TestParallelTokenization(CornellCorpusTestCase):
+    def test_tokenize_texts(self):
+        texts = [text for conversation in self.conversations for text in conversation] + ['Hello world. How are you?']
+        tokens = tokenizeTexts(texts)
+        self.assertEqual(list(tokens), list(dict.fromkeys(texts)))
+        self.assertEqual(tokens['Hello world. How are you?'], [['Hello', 'world', '.'], ['How', 'are', 'you', '?']])
+        for numWorkers in [2, 3, 50]:
+            self.assertEqual(tokenizeTexts(texts, numWorkers), tokens)
+
+    def test_create_corpus(self):
+        serialData = TextData(self.parseArgs(['--datasetTag', 'serial']))
+        for numWorkers in [2, 3]:
+            parallelData = TextData(self.parseArgs(['--datasetTag', 'parallel{}'.format(numWorkers), '--numWorkers', str(numWorkers)]))
+            self.assertEqual(parallelData.word2id, serialData.word2id)
+            self.assertEqual(parallelData.id2word, serialData.id2word)
+            self.assertEqual(parallelData.trainingSamples, serialData.trainingSamples)
+
+            # Same saved datasets
+            serialWords, serialSamples, _, _ = loadMappedDataset(os.path.join(serialData.samplesDir, serialData.samplesName))
+            words, samples, _, _ = loadMappedDataset(os.path.join(parallelData.samplesDir, parallelData.samplesName))
+            self.assertEqual(words, serialWords)
+            self.assertEqual([[list(seq) for seq in sample] for sample in samples], [[list(seq) for seq in sample] for sample in serialSamples])
+
+
+class TinyChatbotTestCase(unittest.TestCase):
+    """Run the chatbot on a small dataset (created in a temporary root directory)
+    """
+    options = []
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'how', 'are', 'you', 'fine', 'thanks', 'bye']
+        samples = [[[4], [4]], [[5, 6, 7], [8, 9]], [[10], [10]]]
+        saveMappedDataset(os.path.join(self.tmpDir.name, 'data/samples/dataset-3'), dict(enumerate(words)), samples)
+        self.args = [
+            '--rootDir', self.tmpDir.name,
+            '--maxLength', '3',
+            '--modelTag', 'unit-test',
+            '--hiddenSize', '8',
+            '--embeddingSize', '6',
+            '--beam_size', '3'
+        ] + self.options
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def runChatbot(self, args):
+        tf.reset_default_graph()
+        bot = chatbot.Chatbot()
+        bot.main(self.args + args)
+        return bot
+
+
+@unittest.skipIf(tf is None, 'tensorflow is not installed')
+class TestExportModel(TinyChatbotTestCase):
+    def test_reset(self):
+        bot = self.runChatbot(['--numEpochs', '1', '--saveEvery', '1', '--batchSize', '2'])
+        self.runChatbot(['--exportModel'])
+        exportDir = os.path.join(bot.modelDir, bot.FROZEN_DIR_NAME)
+        self.assertTrue(os.path.isdir(exportDir))
+
+        self.runChatbot(['--numEpochs', '1', '--saveEvery', '1', '--batchSize', '2', '--reset'])
+        self.assertFalse(os.path.exists(exportDir))
+        self.assertTrue(os.path.exists(bot._getModelName()))
+
+
+@unittest.skipIf(tf is None, 'tensorflow is not installed')
+class TestDecoderVocabulary(TinyChatbotTestCase):
+    options = ['--decoderVocab', '1']
+
+    def test_restore(self):
+        bot = self.runChatbot(['--numEpochs', '1', '--saveEvery', '1', '--batchSize', '2'])
+        decoderWordIds = bot.textData.decoderWordIds.tolist()
+        fileName = os.path.join(bot.modelDir, DECODER_VOCAB_FILENAME)
+        self.assertEqual(loadVocabulary(fileName), ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'fine', 'thanks', 'bye'])
+
+        bot = self.runChatbot(['--test', 'daemon'])
+        self.assertEqual(bot.textData.decoderWordIds.tolist(), decoderWordIds)
+        bot.daemonClose()
+
+        with open(fileName, 'w') as f:  # Not the vocabulary of the saved model anymore
+            f.write('<pad>\n<go>\n<eos>\n<unknown>\nhi\n')
+        with self.assertRaises(RuntimeError):
+            self.runChatbot(['--test', 'daemon'])
+
+
 if __name__ == '__main__':
     unittest.main()